@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+DynamoDBCommunicator send and receive time for messages around and above
+the 400 KB item limit, which are split over chunk items.
+
+With --bucket the same sizes also go through S3Communicator, to see where
+S3 gets faster. Runs against AWS, or a local stand-in with --endpoint-url
+(DynamoDB Local, moto_server), where the table and bucket are created.
+"""
+
+import argparse
+import json
+import time
+import uuid
+
+import boto3
+
+from bulletin import DynamoDBCommunicator, S3Communicator
+
+MEGABYTE = 1000*1000
+
+
+def measure(communicator, size):
+    payload = b"a" * size
+    send_times, receive_times = [], []
+    for _ in range(args.repeat):
+        key = f"benchmark-{uuid.uuid4().hex}"
+        start = time.perf_counter()
+        communicator.send(key, payload)
+        send_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        assert len(communicator.receive(key)) == size
+        receive_times.append(time.perf_counter() - start)
+        communicator.cleanup(key)
+    return min(send_times), min(receive_times)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-t', '--table', type=str, default='bulletin-benchmark')
+parser.add_argument('-b', '--bucket', type=str, default=None, help='compare with S3 in this bucket')
+parser.add_argument('--endpoint-url', type=str, default=None, help='local DynamoDB / S3 stand-in')
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[100_000, 400_000, 1*MEGABYTE, 2*MEGABYTE, 4*MEGABYTE])
+parser.add_argument('-c', '--chunk-size', type=int, default=350_000)
+parser.add_argument('-w', '--workers', type=int, default=16)
+parser.add_argument('-r', '--repeat', type=int, default=3)
+args = parser.parse_args()
+
+resource = boto3.resource("dynamodb", endpoint_url=args.endpoint_url)
+communicators = {"dynamodb": DynamoDBCommunicator(args.table, resource, args.chunk_size, args.workers)}
+if args.bucket:
+    communicators["s3"] = S3Communicator(args.bucket, boto3.client("s3", endpoint_url=args.endpoint_url), args.workers)
+
+if args.endpoint_url:
+    try:
+        resource.create_table(TableName=args.table, BillingMode="PAY_PER_REQUEST",
+                              KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+                              AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}]).wait_until_exists()
+    except resource.meta.client.exceptions.ResourceInUseException:
+        pass
+    if args.bucket:
+        boto3.client("s3", endpoint_url=args.endpoint_url).create_bucket(Bucket=args.bucket)
+
+for size in args.sizes:
+    for method, communicator in communicators.items():
+        send_time, receive_time = measure(communicator, size)
+        print(json.dumps({
+            "method": method,
+            "size": size,
+            "chunks": -(-size // args.chunk_size) if method == "dynamodb" and size > args.chunk_size else 1,
+            "send_time": send_time,
+            "receive_time": receive_time,
+        }))
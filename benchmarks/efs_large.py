@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+EFSCommunicator with large messages: copying vs memory mapped reads and
+single vs parallel chunk files, on tmpfs and on local disk.
+
+Each message is received in a fresh process that hashes it block by block,
+which reports the receive time, its peak RSS and the private (anonymous)
+part of its RSS. Mapped pages are file backed and can be dropped again,
+copies can't. Point --paths at an EFS mount to measure it there.
+"""
+
+import argparse
+import hashlib
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bulletin import EFSCommunicator
+
+MEGABYTE = 1000*1000
+
+MODES = {
+    "read": {},
+    "zero_copy": {"zero_copy": True},
+    "chunks": {"chunks": 4},
+}
+
+
+def memory(field):
+    # VmHWM is the peak RSS of this process, ru_maxrss would include the parent's from before exec
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def receive(path, mode, key):
+    communicator = EFSCommunicator(path, **MODES[mode])
+    start = time.perf_counter()
+    data = communicator.receive(key)
+    received = time.perf_counter() - start
+    digest = hashlib.md5()
+    view = memoryview(data)
+    for offset in range(0, len(view), MEGABYTE):
+        digest.update(view[offset:offset + MEGABYTE])
+    print(json.dumps({
+        "receive_time": received,
+        "peak_rss": memory("VmHWM"),
+        "rss_anon": memory("RssAnon"),
+    }))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--paths', type=str, nargs='+', default=["/dev/shm", "/var/tmp"], help='tmpfs and disk')
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[16*MEGABYTE, 128*MEGABYTE, 512*MEGABYTE])
+parser.add_argument('-m', '--modes', type=str, nargs='+', default=list(MODES), choices=list(MODES))
+parser.add_argument('--receive', type=str, nargs=3, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.receive:
+    receive(*args.receive)
+    sys.exit()
+
+for path in args.paths:
+    directory = tempfile.mkdtemp(dir=path)
+    try:
+        for size in args.sizes:
+            payload = b"a" * size
+            for mode in args.modes:
+                sender = EFSCommunicator(directory, **MODES[mode])
+                key = f"benchmark-{mode}-{size}"
+                start = time.perf_counter()
+                sender.send(key, payload)
+                send_time = time.perf_counter() - start
+
+                child = subprocess.run([sys.executable, __file__, "--receive", directory, mode, key],
+                                       capture_output=True, check=True, text=True)
+                sender.cleanup(key)
+                print(json.dumps({"path": path, "size": size, "mode": mode, "send_time": send_time, **json.loads(child.stdout)}))
+            del payload
+    finally:
+        shutil.rmtree(directory)
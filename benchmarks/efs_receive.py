@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Cost of one EFSCommunicator receive poll by number of messages in flight.
+
+Fills a directory with --in-flight messages and times polls for a key that
+isn't there: "listdir" is the old receive (list the shared directory, look
+for the key), "open" is the current one with all messages in one directory
+(fanout 0) and spread over hashed subdirectories (fanout 256). Also reports
+the delay from send to receive with inotify and with polling. Run on an EFS
+mount with --path, inotify is only used on local filesystems.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+from bulletin import EFSCommunicator
+
+
+def poll_time(poll):
+    times = []
+    for _ in range(args.polls):
+        start = time.perf_counter()
+        poll()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def delivery_time(sender, receiver):
+    times = []
+    for _ in range(args.deliveries):
+        key = uuid.uuid4().hex
+        received = {}
+        thread = threading.Thread(target=lambda: received.update(at=receiver.receive(key) and time.perf_counter()))
+        thread.start()
+        time.sleep(0.05)
+        start = time.perf_counter()
+        sender.send(key, b"a")
+        thread.join()
+        times.append(received["at"] - start)
+        receiver.cleanup(key)
+    return statistics.median(times)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, default=None, help='directory to use (default: a temporary one)')
+parser.add_argument('-n', '--in-flight', type=int, nargs='+', default=[0, 1000, 10000, 50000])
+parser.add_argument('--polls', type=int, default=200)
+parser.add_argument('--deliveries', type=int, default=20)
+args = parser.parse_args()
+
+for in_flight in args.in_flight:
+    for fanout in (0, 256):
+        path = tempfile.mkdtemp(dir=args.path)
+        try:
+            communicator = EFSCommunicator(path, fanout)
+            for i in range(in_flight):
+                communicator.send(f"in-flight-{i}", b"a")
+            missing = communicator.path("missing")
+
+            results = {"open": poll_time(lambda: communicator._read(missing))}
+            if fanout == 0:
+                results["listdir"] = poll_time(lambda: "missing" in os.listdir(path))
+            for method, seconds in results.items():
+                print(json.dumps({"in_flight": in_flight, "fanout": fanout, "method": method, "poll_time": seconds}))
+
+            print(json.dumps({
+                "in_flight": in_flight,
+                "fanout": fanout,
+                "delivery_inotify": delivery_time(communicator, EFSCommunicator(path, fanout)),
+                "delivery_polling": delivery_time(communicator, EFSCommunicator(path, fanout, watch=False)),
+            }))
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""
+Parsing cost of relay wire formats.
+
+Compares the v1 parser (split on '#', which copies the data) with the v2
+frame parser and the view-based v1 parser, which both return a memoryview
+of the payload. Runs in-process, no server needed.
+"""
+
+import argparse
+import json
+import time
+
+from bulletin.framing import frame_header, parse_frame, parse_v1
+
+
+def split_v1(message: bytes):
+    split = message.split(b"#", 2)
+    return split[0].decode("utf-8"), split[1].decode("utf-8"), split[2]
+
+
+def measure(parse, message, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        parse(message)
+    return (time.perf_counter() - start) / number
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[100, 10_000, 1_000_000, 100_000_000])
+parser.add_argument('-n', '--number', type=int, default=None, help='parses per size (default: scaled to size)')
+parser.add_argument('-c', '--channel', type=str, default='benchmark-channel')
+args = parser.parse_args()
+
+channel = args.channel.encode("utf-8")
+for size in args.sizes:
+    payload = bytes(size)
+    # v1 bodies are what follows the 16 byte length, v2 frames include the header
+    v1 = frame_header(1, "publish", channel, size)[16:] + payload
+    v2 = frame_header(2, "publish", channel, size) + payload
+    number = args.number or max(10, min(100_000, 1_000_000_000 // max(size, 1) // 100))
+
+    print(json.dumps({
+        "message_size": size,
+        "number": number,
+        "v1_split_time": measure(split_v1, v1, number),
+        "v1_view_time": measure(parse_v1, v1, number),
+        "v2_frame_time": measure(parse_frame, v2, number),
+    }))
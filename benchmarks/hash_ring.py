@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""
+Balance and stability of the consistent hash ring behind
+ShardedRelayCommunicator.
+
+For each ring size N reports how evenly the keys spread over the nodes
+(largest share relative to 1/N) and which fraction of keys moves when an
+(N+1)th node is added, ideally 1/(N+1). Runs in-process, no server needed.
+"""
+
+import argparse
+import json
+import time
+
+from bulletin.hashring import HashRing
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--nodes', type=int, nargs='+', default=[2, 4, 8, 16])
+parser.add_argument('-v', '--virtual-nodes', type=int, nargs='+', default=[1, 16, 128])
+parser.add_argument('-k', '--keys', type=int, default=100_000)
+args = parser.parse_args()
+
+keys = [f"channel-{i}" for i in range(args.keys)]
+for virtual_nodes in args.virtual_nodes:
+    for n in args.nodes:
+        nodes = [f"10.0.0.{i}:12345" for i in range(n + 1)]
+        ring = HashRing(nodes[:n], virtual_nodes)
+
+        start = time.perf_counter()
+        before = [ring.node(key) for key in keys]
+        lookup_time = (time.perf_counter() - start) / len(keys)
+
+        counts = {}
+        for node in before:
+            counts[node] = counts.get(node, 0) + 1
+
+        ring.add(nodes[n])
+        moved = sum(1 for key, node in zip(keys, before) if ring.node(key) != node)
+
+        print(json.dumps({
+            "nodes": n,
+            "virtual_nodes": virtual_nodes,
+            "max_share_vs_fair": max(counts.values()) / (len(keys) / n),
+            "moved_fraction": moved / len(keys),
+            "ideal_moved_fraction": 1 / (n + 1),
+            "lookup_time": lookup_time,
+        }))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Cost of recording what a communicator did: the events list communicators
+used to append to, and Metrics. Reports the time per event from one and
+from several threads, the memory after --events events, the time of usage,
+and how far the histogram's percentiles are from the exact ones.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import tracemalloc
+
+from bulletin.metrics import Metrics, Histogram
+
+NAMES = ["s3:GetObject", "s3:PutObject", "s3:DeleteObject", "s3:SlowDown"]
+
+
+def tally(events):
+    # what usage did with the list
+    event_counts = {}
+    for event in events:
+        if event not in event_counts:
+            event_counts[event] = 0
+        event_counts[event] += 1
+    return event_counts
+
+
+def run(record, count, threads):
+    def work():
+        for i in range(count // threads):
+            record(NAMES[i % len(NAMES)])
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / count
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--events', type=int, default=1_000_000)
+parser.add_argument('-t', '--threads', type=int, nargs='+', default=[1, 8])
+args = parser.parse_args()
+
+for threads in args.threads:
+    events = []
+    metrics = Metrics()
+    tracemalloc.start()
+    list_time = run(events.append, args.events, threads)
+    list_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    metrics_time = run(metrics.event, args.events, threads)
+    metrics_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    tally(events)
+    list_usage = time.perf_counter() - start
+    start = time.perf_counter()
+    metrics.counts()
+    metrics_usage = time.perf_counter() - start
+
+    print(json.dumps({"threads": threads, "events": args.events, "method": "list",
+                      "event_time": list_time, "memory": list_memory, "usage_time": list_usage}))
+    print(json.dumps({"threads": threads, "events": args.events, "method": "metrics",
+                      "event_time": metrics_time, "memory": metrics_memory, "usage_time": metrics_usage}))
+
+histogram = Histogram()
+latencies = [random.lognormvariate(-4, 1.5) for _ in range(args.events)]
+start = time.perf_counter()
+for latency in latencies:
+    histogram.add(latency)
+add_time = (time.perf_counter() - start) / len(latencies)
+latencies.sort()
+for percent in (50, 90, 99, 99.9):
+    exact = latencies[min(int(percent / 100 * len(latencies)), len(latencies) - 1)]
+    print(json.dumps({"percentile": percent, "exact": exact, "histogram": histogram.percentile(percent),
+                      "relative_error": abs(histogram.percentile(percent) / exact - 1), "add_time": add_time}))
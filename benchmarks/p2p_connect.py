@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Connection setup latency of P2PCommunicator.
+
+Pairs two communicators on a locally started p2p server, over loopback so
+there is no NAT, and measures the time from the first call until both
+sides hold a working connection: rendezvous, simultaneous open and the
+HELLO exchange. Each pair gets a fresh key. With --reuse both sides name
+their peer and keep their end in a PeerPool, so only the first pair pays
+for the rendezvous.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bulletin import P2PCommunicator, PeerPool
+
+
+def connect(host, port, key, timeout, peer, pool):
+    communicator = P2PCommunicator(host, port, connect_timeout=timeout, peer=peer, pool=pool)
+    try:
+        communicator._connect(key)
+        return time.perf_counter()
+    except (OSError, ConnectionError):
+        return None
+    finally:
+        if communicator.socket:
+            communicator.cleanup(key)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='p2p server to use (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('-n', '--pairs', type=int, default=200)
+parser.add_argument('-t', '--timeout', type=float, default=10.0, help='connect_timeout of each communicator')
+parser.add_argument('--reuse', action='store_true', help='pool connections between pairs')
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "p2p", "--host", host, "--port", str(args.port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    latencies = []
+    failed = 0
+    # one pool per side, in a real deployment they live in different processes
+    pools = [PeerPool(), PeerPool()]
+    peer = uuid.uuid4().hex if args.reuse else None
+    with ThreadPoolExecutor(2) as executor, contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(args.pairs):
+            key = uuid.uuid4().hex
+            start = time.perf_counter()
+            ends = list(executor.map(lambda side: connect(host, args.port, key, args.timeout, peer, pools[side]), range(2)))
+            if None in ends:
+                failed += 1
+            else:
+                latencies.append(max(ends) - start)
+
+    latencies.sort()
+    print(json.dumps({
+        "pairs": args.pairs,
+        "reuse": args.reuse,
+        "failed": failed,
+        "mean": statistics.mean(latencies) if latencies else None,
+        "p50": latencies[len(latencies) // 2] if latencies else None,
+        "p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+        "max": latencies[-1] if latencies else None,
+    }))
+finally:
+    if server:
+        server.kill()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+Full mesh setup time between N ranks over loopback.
+
+"pairwise" connects every pair with its own keyed rendezvous. Each rank
+goes through its links in the same global order, so the N*(N-1)/2 links
+come up one after another. "group" registers all ranks in one group
+rendezvous and punches all links in parallel. Reports the time until
+every rank holds a connection to every other rank.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bulletin import P2PCommunicator
+
+
+def pairwise(host, port, run, rank, size):
+    links = {}
+    for i in range(size):
+        for j in range(i + 1, size):
+            if rank in (i, j):
+                peer = j if rank == i else i
+                links[peer] = P2PCommunicator(host, port)
+                links[peer]._connect(f"{run}-{i}-{j}")
+    return links
+
+
+def group(host, port, run, rank, size):
+    return P2PCommunicator.group(host, run, rank, size, port=port)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='p2p server to use (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('-n', '--ranks', type=int, nargs='+', default=[2, 4, 8, 16])
+parser.add_argument('-r', '--repeat', type=int, default=3)
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "p2p", "--host", host, "--port", str(args.port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    for size in args.ranks:
+        for name, setup in (("pairwise", pairwise), ("group", group)):
+            times = []
+            for _ in range(args.repeat):
+                run = uuid.uuid4().hex
+                with ThreadPoolExecutor(size) as executor, contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    meshes = list(executor.map(lambda rank: setup(host, args.port, run, rank, size), range(size)))
+                    times.append(time.perf_counter() - start)
+                for links in meshes:
+                    for communicator in links.values():
+                        communicator.socket.close()
+
+            print(json.dumps({
+                "setup": name,
+                "ranks": size,
+                "links": size * (size - 1) // 2,
+                "time": min(times),
+            }))
+finally:
+    if server:
+        server.kill()
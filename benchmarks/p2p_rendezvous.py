@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Rendezvous throughput of the P2P server.
+
+Runs the client side of the rendezvous handshake (address, public address
+echo, peer info) for many key pairs at once and reports how many pairings
+per second the server brokers. --stalled opens connections that never
+finish their handshake before the run starts, they should not slow down
+the other clients. No hole punching is attempted.
+"""
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bulletin.p2p_utils import addr_to_string, send_msg, recv_msg
+
+
+def handshake(host, port, key):
+    s = socket.create_connection((host, port))
+    try:
+        send_msg(s, addr_to_string(s.getsockname()) + b"|" + key)
+        send_msg(s, recv_msg(s))
+        return recv_msg(s)
+    finally:
+        s.close()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='p2p server to benchmark (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('-p', '--pairs', type=int, nargs='+', default=[100, 1000, 5000])
+parser.add_argument('-c', '--concurrency', type=int, default=64, help='clients in flight at once')
+parser.add_argument('--stalled', type=int, default=10, help='connections that never finish the handshake')
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "p2p", "--host", host, "--port", str(args.port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    stalled = [socket.create_connection((host, args.port)) for _ in range(args.stalled)]
+    # half a length prefix, the old accept loop would block on it
+    for s in stalled:
+        s.sendall(b"\x00\x00")
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for pairs in args.pairs:
+            run = uuid.uuid4().hex[:8]
+            # both sides of a pair are next to each other, so they are in flight together
+            keys = [f"{run}-{i // 2}".encode("utf-8") for i in range(2 * pairs)]
+            start = time.time()
+            results = list(executor.map(lambda key: handshake(host, args.port, key), keys))
+            elapsed = time.time() - start
+
+            print(json.dumps({
+                "pairs": pairs,
+                "concurrency": args.concurrency,
+                "stalled": args.stalled,
+                "time": elapsed,
+                "pairings_per_second": pairs / elapsed,
+                "failed": sum(1 for r in results if r is None),
+            }))
+
+    for s in stalled:
+        s.close()
+finally:
+    if server:
+        server.kill()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Throughput of striped P2P transfers over loopback.
+
+Connects a sender and a receiver P2PCommunicator with --streams K through
+a locally started p2p server, then times sending payloads of each size.
+Compare K=1 with K>1. Loopback has no congestion window to ramp up or per
+flow limit, so it shows the striping overhead rather than the gain seen
+between Lambdas.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from bulletin import P2PCommunicator
+
+MEGABYTE = 1000*1000
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='p2p server to use (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('-k', '--streams', type=int, nargs='+', default=[1, 2, 4, 8])
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10*MEGABYTE, 100*MEGABYTE, 500*MEGABYTE])
+parser.add_argument('-c', '--chunk-size', type=int, default=4*MEGABYTE)
+parser.add_argument('-r', '--repeat', type=int, default=3)
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "p2p", "--host", host, "--port", str(args.port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    for streams in args.streams:
+        key = uuid.uuid4().hex
+        sender = P2PCommunicator(host, args.port, streams=streams, chunk_size=args.chunk_size)
+        receiver = P2PCommunicator(host, args.port, streams=streams, chunk_size=args.chunk_size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            connecting = threading.Thread(target=receiver._connect, args=(key,))
+            connecting.start()
+            sender._connect(key)
+            connecting.join()
+
+        for size in args.sizes:
+            payload = b"a" * size
+            times = []
+            for _ in range(args.repeat):
+                received = {}
+                thread = threading.Thread(target=lambda: received.update(data=receiver.receive(key)))
+                start = time.perf_counter()
+                thread.start()
+                sender.send(key, payload)
+                thread.join()
+                times.append(time.perf_counter() - start)
+                assert len(received["data"]) == size
+
+            print(json.dumps({
+                "streams": streams,
+                "chunk_size": args.chunk_size,
+                "size": size,
+                "time": min(times),
+                "throughput_mb_s": size / min(times) / MEGABYTE,
+            }))
+
+        sender.cleanup(key)
+        receiver.cleanup(key)
+finally:
+    if server:
+        server.kill()
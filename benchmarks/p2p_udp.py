@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+TCP vs UDP P2P transport over loopback.
+
+For each transport (and, for UDP, each simulated loss rate) pairs a sender
+and a receiver through a locally started p2p server and reports connection
+setup time, median round trip of small messages and throughput of larger
+payloads. Loss is simulated by UDPStream dropping outgoing packets; TCP
+always runs without loss.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from bulletin import P2PCommunicator
+
+MEGABYTE = 1000*1000
+
+
+def connect(transport, options):
+    key = uuid.uuid4().hex
+    a = P2PCommunicator(host, args.port, transport=transport, udp_options=options)
+    b = P2PCommunicator(host, args.port, transport=transport, udp_options=options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        thread = threading.Thread(target=b._connect, args=(key,))
+        thread.start()
+        a._connect(key)
+        thread.join()
+    return a, b, key, time.perf_counter() - start
+
+
+def echo(communicator, key, count):
+    for _ in range(count):
+        communicator.send(key, communicator.receive(key))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='p2p server to use (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('-l', '--loss', type=float, nargs='+', default=[0, 0.01, 0.05])
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1*MEGABYTE, 10*MEGABYTE, 50*MEGABYTE])
+parser.add_argument('--mss', type=int, default=1200, help='UDP segment size')
+parser.add_argument('--window', type=int, default=256, help='UDP segments in flight')
+parser.add_argument('--pings', type=int, default=200)
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "p2p", "--host", host, "--port", str(args.port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    runs = [("tcp", None)] + [("udp", {"loss": loss, "mss": args.mss, "window": args.window}) for loss in args.loss]
+    for transport, options in runs:
+        a, b, key, setup = connect(transport, options)
+
+        responder = threading.Thread(target=echo, args=(b, key, args.pings))
+        responder.start()
+        round_trips = []
+        for _ in range(args.pings):
+            start = time.perf_counter()
+            a.send(key, b"x" * 100)
+            a.receive(key)
+            round_trips.append(time.perf_counter() - start)
+        responder.join()
+
+        throughput = {}
+        for size in args.sizes:
+            payload = b"a" * size
+            received = {}
+            thread = threading.Thread(target=lambda: received.update(data=b.receive(key)))
+            start = time.perf_counter()
+            thread.start()
+            a.send(key, payload)
+            thread.join()
+            assert len(received["data"]) == size
+            throughput[size] = size / (time.perf_counter() - start) / MEGABYTE
+
+        print(json.dumps({
+            "transport": transport,
+            "loss": options["loss"] if options else 0,
+            "setup": setup,
+            "round_trip_p50": statistics.median(round_trips),
+            "throughput_mb_s": throughput,
+        }))
+        a.cleanup(key)
+        b.cleanup(key)
+finally:
+    if server:
+        server.kill()
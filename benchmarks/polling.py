@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+Receive latency and number of polls per polling strategy.
+
+The receiver starts waiting and the sender sends after a random delay, one
+of --delays seconds +-50%, like a peer that is still computing for a while
+or not at all. Mixing short and long delays shows whether a strategy that
+learned from long waits still finds early messages quickly. Latency is the
+time from the end of send to the return of receive, polls the requests
+receive made. The adaptive strategy learns during the run, including its
+warmup. Uses EFSCommunicator without inotify in a temporary directory (or
+--path) by default, or S3 with --method s3.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+import boto3
+
+from bulletin import EFSCommunicator, S3Communicator
+from bulletin.polling import FixedPolling, ExponentialPolling, AdaptivePolling, legacy_polling
+
+STRATEGIES = {
+    "legacy": legacy_polling,
+    "fixed": lambda: FixedPolling(0.01),
+    "exponential": lambda: ExponentialPolling(),
+    "adaptive": lambda: AdaptivePolling(),
+}
+
+POLL_EVENTS = {"efs": "efs:open", "s3": "s3:GetObject"}
+
+
+def communicator():
+    if args.method == "s3":
+        return S3Communicator(args.bucket, boto3.client("s3", endpoint_url=args.endpoint_url))
+    return EFSCommunicator(path, watch=False)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--method', type=str, default='efs', choices=list(POLL_EVENTS))
+parser.add_argument('--path', type=str, default=None, help='directory for efs (default: a temporary one)')
+parser.add_argument('-b', '--bucket', type=str, default='bulletin-benchmark')
+parser.add_argument('--endpoint-url', type=str, default=None, help='local S3 stand-in')
+parser.add_argument('-s', '--strategies', type=str, nargs='+', default=list(STRATEGIES), choices=list(STRATEGIES))
+parser.add_argument('-d', '--delays', type=float, nargs='+', default=[0.01, 0.5], help='seconds between receive and send, mixed')
+parser.add_argument('-m', '--messages', type=int, default=50)
+args = parser.parse_args()
+
+path = tempfile.mkdtemp(dir=args.path)
+if args.method == "s3" and args.endpoint_url:
+    boto3.client("s3", endpoint_url=args.endpoint_url).create_bucket(Bucket=args.bucket)
+
+for strategy in args.strategies:
+    sender, receiver = communicator(), communicator()
+    receiver.polling = STRATEGIES[strategy]()
+    latencies, polls = [], []
+    for _ in range(args.messages):
+        key = uuid.uuid4().hex
+        received = {}
+        before = receiver.usage.get(POLL_EVENTS[args.method], 0)
+        thread = threading.Thread(target=lambda: received.update(data=receiver.receive(key), at=time.perf_counter()))
+        thread.start()
+        time.sleep(random.choice(args.delays) * random.uniform(0.5, 1.5))
+        sender.send(key, b"a")
+        sent = time.perf_counter()
+        thread.join()
+        latencies.append(received["at"] - sent)
+        polls.append(receiver.usage.get(POLL_EVENTS[args.method], 0) - before)
+        receiver.cleanup(key)
+
+    print(json.dumps({
+        "method": args.method,
+        "strategy": strategy,
+        "latency_p50": statistics.median(latencies),
+        "latency_p95": statistics.quantiles(latencies, n=20)[18],
+        "polls_mean": statistics.mean(polls),
+    }))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+RedisCommunicator blocking (XADD / XREAD BLOCK) vs polling (SET / GET) receive.
+
+The receiver starts waiting --delay seconds before the message is sent, as
+in a pipeline where the consumer is ready first. Reports the latency from
+the start of send to the return of receive, and the number of commands
+receive issued, after checking that a key sent to twice gives the second
+message. Starts a local redis-server unless --host is given, any
+Redis compatible server works.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import threading
+import time
+import uuid
+
+from bulletin import RedisCommunicator
+
+
+def measure(blocking):
+    sender = RedisCommunicator(host, args.port, blocking=blocking)
+    receiver = RedisCommunicator(host, args.port, blocking=blocking)
+    payload = b"a" * args.size
+    latencies, commands = [], []
+    for _ in range(args.messages):
+        key = uuid.uuid4().hex
+        received = {}
+        before = sum(receiver.usage.values())
+        thread = threading.Thread(target=lambda: received.update(data=receiver.receive(key), at=time.perf_counter()))
+        thread.start()
+        time.sleep(args.delay)
+        start = time.perf_counter()
+        sender.send(key, payload)
+        thread.join()
+        assert received["data"] == payload
+        latencies.append(received["at"] - start)
+        commands.append(sum(receiver.usage.values()) - before)
+        sender.cleanup(key)
+    return latencies, commands
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='Redis server to use (default: start redis-server locally)')
+parser.add_argument('--port', type=int, default=6379)
+parser.add_argument('-m', '--messages', type=int, default=100)
+parser.add_argument('-s', '--size', type=int, default=1000)
+parser.add_argument('-d', '--delay', type=float, default=0.05, help='seconds the receiver waits before the send')
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(["redis-server", "--port", str(args.port), "--save", ""],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    for blocking in (True, False):
+        # a key used again without cleanup gives the latest message
+        communicator = RedisCommunicator(host, args.port, blocking=blocking)
+        key = uuid.uuid4().hex
+        communicator.send(key, b"first")
+        communicator.send(key, b"second")
+        assert communicator.receive(key) == b"second"
+        communicator.cleanup(key)
+
+        latencies, commands = measure(blocking)
+        print(json.dumps({
+            "mode": "blocking" if blocking else "polling",
+            "size": args.size,
+            "latency_p50": statistics.median(latencies),
+            "latency_p99": statistics.quantiles(latencies, n=100)[98],
+            "commands_per_receive": statistics.mean(commands),
+        }))
+finally:
+    if server:
+        server.kill()
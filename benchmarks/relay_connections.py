@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Connection-count scaling benchmark for the relay server.
+
+Opens N client connections (N/2 subscribers, N/2 publishers, one channel per
+pair), publishes one message per pair and measures how long it takes until
+every subscriber got its message. Starts a local relay server unless --host
+is given.
+"""
+
+import argparse
+import json
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+
+def frame(action: str, channel: str, data: bytes) -> bytes:
+    message = action.encode("utf-8") + b"#" + channel.encode("utf-8") + b"#" + data
+    return str(len(message)).rjust(16).encode("utf-8") + message
+
+
+def connect(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.connect((host, port))
+    return s
+
+
+def server_stats(pid):
+    stats = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            if name in ("Threads", "VmRSS"):
+                stats[name.lower()] = value.strip()
+    return stats
+
+
+def run(host, port, connections, message_size, server_pid=None):
+    pairs = connections // 2
+    payload = b"a" * message_size
+    selector = selectors.DefaultSelector()
+
+    start = time.time()
+    subscribers = []
+    for i in range(pairs):
+        s = connect(host, port)
+        s.sendall(frame("subscribe", f"bench-{i}", b""))
+        subscribers.append(s)
+    publishers = [connect(host, port) for _ in range(pairs)]
+    connect_time = time.time() - start
+
+    for i, s in enumerate(subscribers):
+        s.setblocking(False)
+        # [received, expected] bytes
+        selector.register(s, selectors.EVENT_READ, [0, len(frame("publish", f"bench-{i}", payload))])
+
+    start = time.time()
+    for i, s in enumerate(publishers):
+        s.sendall(frame("publish", f"bench-{i}", payload))
+
+    remaining = pairs
+    while remaining:
+        for key, _ in selector.select(timeout=30):
+            s, progress = key.fileobj, key.data
+            progress[0] += len(s.recv(1 << 20))
+            if progress[0] >= progress[1]:
+                selector.unregister(s)
+                remaining -= 1
+    delivery_time = time.time() - start
+
+    result = {
+        "connections": pairs * 2,
+        "message_size": message_size,
+        "connect_time": connect_time,
+        "delivery_time": delivery_time,
+    }
+    if server_pid:
+        result.update(server_stats(server_pid))
+
+    for s in subscribers + publishers:
+        s.close()
+
+    return result
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='relay server to benchmark (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('--mode', type=str, default='event-loop', choices=['event-loop', 'threaded'])
+parser.add_argument('-c', '--connections', type=int, nargs='+', default=[100, 500, 1000, 2000, 4000])
+parser.add_argument('-s', '--size', type=int, default=1000)
+args = parser.parse_args()
+
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "relay", "--host", host, "--port", str(args.port), "--mode", args.mode],
+        stdout=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    for n in args.connections:
+        print(json.dumps(run(host, args.port, n, args.size, server.pid if server else None)))
+finally:
+    if server:
+        server.kill()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Fan-out latency of the relay server with slow subscribers.
+
+One publisher sends a burst of messages to a channel with many subscribers,
+some of which read slowly. Reports how long the fast subscribers take to get
+the whole burst, for either overflow policy of the relay server.
+"""
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+def frame(action: str, channel: str, data: bytes) -> bytes:
+    message = action.encode("utf-8") + b"#" + channel.encode("utf-8") + b"#" + data
+    return str(len(message)).rjust(16).encode("utf-8") + message
+
+
+def recv_frame(s):
+    header = b""
+    while len(header) < 16:
+        data = s.recv(16 - len(header))
+        if not data:
+            raise EOFError()
+        header += data
+    size = int(header)
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = s.recv_into(view[received:], size - received)
+        if not n:
+            raise EOFError()
+        received += n
+    return buffer
+
+
+def subscriber(s, count, delay, results, index, start):
+    received = 0
+    try:
+        for _ in range(count):
+            recv_frame(s)
+            received += 1
+            time.sleep(delay)
+    except (EOFError, OSError):
+        pass
+    results[index] = (received, time.time() - start[0])
+
+
+def run(host, port, subscribers, slow, count, size, delay):
+    channel = f"fanout-{time.time()}"
+    sockets = [socket.create_connection((host, port)) for _ in range(subscribers)]
+    for s in sockets:
+        s.sendall(frame("subscribe", channel, b""))
+    time.sleep(0.5)
+
+    results = {}
+    start = [time.time()]
+    threads = [
+        threading.Thread(target=subscriber, args=(s, count, delay if i < slow else 0, results, i, start))
+        for i, s in enumerate(sockets)
+    ]
+    [t.start() for t in threads]
+
+    publisher = socket.create_connection((host, port))
+    payload = b"a" * size
+    for _ in range(count):
+        publisher.sendall(frame("publish", channel, payload))
+    publish_time = time.time() - start[0]
+
+    [t.join() for t in threads]
+    fast = sorted(results[i][1] for i in range(slow, subscribers))
+
+    for s in sockets + [publisher]:
+        s.close()
+
+    return {
+        "subscribers": subscribers,
+        "slow": slow,
+        "messages": count,
+        "message_size": size,
+        "publish_time": publish_time,
+        "fast_p50": fast[len(fast) // 2],
+        "fast_max": fast[-1],
+        "slow_received": [results[i][0] for i in range(slow)],
+    }
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='relay server to benchmark (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('--overflow', type=str, default='block', choices=['block', 'disconnect'])
+parser.add_argument('--queue-limit', type=int, default=8_000_000)
+parser.add_argument('-c', '--subscribers', type=int, default=32)
+parser.add_argument('--slow', type=int, default=1, help='number of slow subscribers')
+parser.add_argument('--delay', type=float, default=0.1, help='seconds a slow subscriber waits after each message')
+parser.add_argument('-m', '--messages', type=int, default=50)
+parser.add_argument('-s', '--size', type=int, default=200_000)
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "relay", "--host", host, "--port", str(args.port),
+         "--overflow", args.overflow, "--queue-limit", str(args.queue_limit)],
+        stdout=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    print(json.dumps(run(host, args.port, args.subscribers, args.slow, args.messages, args.size, args.delay)))
+finally:
+    if server:
+        server.kill()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Gather through the relay server: a root rank receives one message from
+each of N workers.
+
+"shared" receives all channels in parallel threads over a single
+RelayCommunicator connection, "per-sender" opens one communicator per
+worker like the e2e master_gather does.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from bulletin import RelayCommunicator
+
+
+def run(host, port, mode, workers, size):
+    run_id = uuid.uuid4().hex[:8]
+    channels = [f"gather-{run_id}-{i}" for i in range(workers)]
+    payload = bytes(size)
+
+    start = time.time()
+    if mode == "shared":
+        root = RelayCommunicator(host, port)
+        receivers = [root] * workers
+    else:
+        receivers = [RelayCommunicator(host, port) for _ in range(workers)]
+    connected = time.time()
+
+    def work(i):
+        communicator = RelayCommunicator(host, port)
+        communicator.send(channels[i], payload)
+        communicator.close()
+
+    senders = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+    for sender in senders:
+        sender.start()
+
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(lambda i: receivers[i].receive(channels[i]), range(workers)))
+    total = time.time() - start
+
+    for sender in senders:
+        sender.join()
+    for communicator in set(receivers):
+        communicator.close()
+
+    assert all(len(r) == size for r in results)
+    return {
+        "mode": mode,
+        "workers": workers,
+        "message_size": size,
+        "connect_time": connected - start,
+        "total_time": total,
+        "root_connections": len(set(receivers)),
+    }
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='relay server to benchmark (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('-w', '--workers', type=int, nargs='+', default=[4, 16, 64])
+parser.add_argument('-s', '--size', type=int, default=100_000)
+parser.add_argument('-n', '--number', type=int, default=3)
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "relay", "--host", host, "--port", str(args.port)],
+        stdout=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    for workers in args.workers:
+        for mode in ["shared", "per-sender"]:
+            for _ in range(args.number):
+                print(json.dumps(run(host, args.port, mode, workers, args.size)))
+finally:
+    if server:
+        server.kill()
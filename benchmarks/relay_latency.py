@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end latency of single large publishes through the relay server.
+
+Measures the time from the first byte a publisher sends until a subscriber
+holds the whole message. With cut-through forwarding this should be close to
+one transfer time; run with --mode threaded for store-and-forward numbers.
+"""
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+def frame_header(action: str, channel: str, size: int) -> bytes:
+    prefix = action.encode("utf-8") + b"#" + channel.encode("utf-8") + b"#"
+    return str(len(prefix) + size).rjust(16).encode("utf-8") + prefix
+
+
+def recv_frame(s):
+    header = b""
+    while len(header) < 16:
+        header += s.recv(16 - len(header))
+    size = int(header)
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        received += s.recv_into(view[received:], min(size - received, 1 << 20))
+    return buffer
+
+
+def run(host, port, size, index):
+    channel = f"latency-{index}"
+    payload = memoryview(bytearray(size))
+
+    subscriber = socket.create_connection((host, port))
+    publisher = socket.create_connection((host, port))
+    subscriber.sendall(frame_header("subscribe", channel, 0))
+    time.sleep(0.2)
+
+    received = {}
+    def receive():
+        recv_frame(subscriber)
+        received["time"] = time.time()
+    thread = threading.Thread(target=receive)
+    thread.start()
+
+    start = time.time()
+    publisher.sendall(frame_header("publish", channel, size))
+    publisher.sendall(payload)
+    sent = time.time()
+    thread.join()
+
+    subscriber.close()
+    publisher.close()
+    return {
+        "message_size": size,
+        "send_time": sent - start,
+        "total_time": received["time"] - start,
+    }
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='relay server to benchmark (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('--mode', type=str, default='event-loop', choices=['event-loop', 'threaded'])
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000, 100_000_000])
+parser.add_argument('-n', '--number', type=int, default=5)
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "relay", "--host", host, "--port", str(args.port), "--mode", args.mode],
+        stdout=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    for size in args.sizes:
+        for i in range(args.number):
+            print(json.dumps(run(host, args.port, size, i)))
+finally:
+    if server:
+        server.kill()
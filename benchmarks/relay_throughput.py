@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Aggregate throughput benchmark for the relay server.
+
+Runs P client processes, each doing publish/subscribe ping-pong on its own
+pair of channels for a fixed time, and reports the total number of relayed
+messages per second. Compare e.g. --workers 1 and --workers 4 on a 4 core VM.
+"""
+
+import argparse
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+
+
+def frame(action: str, channel: str, data: bytes) -> bytes:
+    message = action.encode("utf-8") + b"#" + channel.encode("utf-8") + b"#" + data
+    return str(len(message)).rjust(16).encode("utf-8") + message
+
+
+def connect(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.connect((host, port))
+    return s
+
+
+def recv_frame(s):
+    header = b""
+    while len(header) < 16:
+        header += s.recv(16 - len(header))
+    size = int(header)
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        received += s.recv_into(view[received:])
+    return buffer
+
+
+def client(host, port, index, message_size, duration):
+    ping, pong = f"ping-{index}", f"pong-{index}"
+    payload = b"a" * message_size
+
+    # one socket per channel and direction, like separate communicators
+    ping_sub, pong_sub = connect(host, port), connect(host, port)
+    ping_pub, pong_pub = connect(host, port), connect(host, port)
+    ping_sub.sendall(frame("subscribe", ping, b""))
+    pong_sub.sendall(frame("subscribe", pong, b""))
+    time.sleep(0.5)
+
+    count = 0
+    end = time.time() + duration
+    while time.time() < end:
+        ping_pub.sendall(frame("publish", ping, payload))
+        recv_frame(ping_sub)
+        pong_pub.sendall(frame("publish", pong, payload))
+        recv_frame(pong_sub)
+        count += 2
+
+    for s in (ping_sub, pong_sub, ping_pub, pong_pub):
+        s.close()
+    return count
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default=None, help='relay server to benchmark (default: start one locally)')
+parser.add_argument('--port', type=int, default=12345)
+parser.add_argument('-w', '--workers', type=int, default=1, help='relay workers when starting a local server')
+parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count())
+parser.add_argument('-s', '--size', type=int, default=1000)
+parser.add_argument('-d', '--duration', type=float, default=10)
+args = parser.parse_args()
+
+server = None
+host = args.host
+if host is None:
+    host = "127.0.0.1"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "bulletin", "relay", "--host", host, "--port", str(args.port), "--workers", str(args.workers)],
+        stdout=subprocess.DEVNULL)
+    time.sleep(1)
+
+try:
+    with multiprocessing.Pool(args.processes) as pool:
+        counts = pool.starmap(client, [(host, args.port, i, args.size, args.duration) for i in range(args.processes)])
+finally:
+    if server:
+        server.kill()
+
+messages = sum(counts)
+print(json.dumps({
+    "workers": args.workers,
+    "processes": args.processes,
+    "message_size": args.size,
+    "messages_per_second": messages / args.duration,
+    "megabytes_per_second": messages * args.size / args.duration / 1e6,
+}))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Aggregate S3Communicator request rate by number of ranks.
+
+Every rank is a thread with its own communicator and limiter, like a
+separate Lambda, and exchanges small objects under collective style keys
+({key}-{rank}-{n}). Run with --shards 0 for keys as given, the default
+spreads them over hashed prefixes. Throttling shows up as slowdowns in the
+output. Runs against real S3, or a local stand-in with --endpoint-url.
+"""
+
+import argparse
+import json
+import threading
+import time
+import uuid
+
+import boto3
+from botocore.config import Config
+
+from bulletin import S3Communicator
+from bulletin.ratelimit import TokenBucket
+
+
+def rank(communicator, key, rank, results):
+    for n in range(args.messages):
+        message = f"{key}-{rank}-{n}"
+        communicator.send(message, payload)
+        assert communicator.receive(message) == payload
+        communicator.cleanup(message)
+    results[rank] = communicator.usage
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', '--bucket', type=str, default='bulletin-benchmark')
+parser.add_argument('--endpoint-url', type=str, default=None, help='local S3 stand-in')
+parser.add_argument('-r', '--ranks', type=int, nargs='+', default=[1, 4, 16, 64])
+parser.add_argument('--shards', type=int, nargs='+', default=[0, 16])
+parser.add_argument('-m', '--messages', type=int, default=50, help='objects per rank')
+parser.add_argument('-s', '--size', type=int, default=1000)
+args = parser.parse_args()
+
+payload = b"a" * args.size
+if args.endpoint_url:
+    boto3.client("s3", endpoint_url=args.endpoint_url).create_bucket(Bucket=args.bucket)
+
+for shards in args.shards:
+    for ranks in args.ranks:
+        key = uuid.uuid4().hex
+        communicators = [
+            S3Communicator(args.bucket, boto3.client("s3", endpoint_url=args.endpoint_url, config=Config(retries={"total_max_attempts": 1})),
+                           shards=shards, limiter=TokenBucket())
+            for _ in range(ranks)
+        ]
+        results = {}
+        threads = [threading.Thread(target=rank, args=(communicators[i], key, i, results)) for i in range(ranks)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        requests = sum(count for usage in results.values() for event, count in usage.items() if event != "s3:SlowDown")
+        print(json.dumps({
+            "shards": shards,
+            "ranks": ranks,
+            "time": elapsed,
+            "requests_per_s": requests / elapsed,
+            "slowdowns": sum(usage.get("s3:SlowDown", 0) for usage in results.values()),
+        }))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+S3Communicator transfer time by payload size and thread pool size.
+
+Workers 0 is the single PutObject / GetObject baseline, other values use
+multipart uploads and ranged GETs of --part-size with that many threads.
+Runs against real S3, or a local stand-in with --endpoint-url (e.g.
+moto_server or MinIO, the bucket is created there).
+"""
+
+import argparse
+import json
+import time
+import uuid
+
+import boto3
+from botocore.config import Config
+
+from bulletin import S3Communicator
+
+MEGABYTE = 1000*1000
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', '--bucket', type=str, default='bulletin-benchmark')
+parser.add_argument('--endpoint-url', type=str, default=None, help='local S3 stand-in')
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1*MEGABYTE, 16*MEGABYTE, 64*MEGABYTE, 256*MEGABYTE])
+parser.add_argument('-w', '--workers', type=int, nargs='+', default=[0, 4, 16])
+parser.add_argument('-p', '--part-size', type=int, default=8*MEGABYTE)
+parser.add_argument('-r', '--repeat', type=int, default=3)
+args = parser.parse_args()
+
+if args.endpoint_url:
+    boto3.client("s3", endpoint_url=args.endpoint_url).create_bucket(Bucket=args.bucket)
+
+for workers in args.workers:
+    client = boto3.client("s3", endpoint_url=args.endpoint_url, config=Config(max_pool_connections=max(workers, 10)))
+    if workers == 0:
+        # everything fits in one part, so one request each way
+        communicator = S3Communicator(args.bucket, client, 1, threshold=2**63, part_size=2**63)
+    else:
+        communicator = S3Communicator(args.bucket, client, workers, threshold=args.part_size, part_size=args.part_size)
+
+    for size in args.sizes:
+        payload = b"a" * size
+        send_times, receive_times = [], []
+        for _ in range(args.repeat):
+            key = f"benchmark-{uuid.uuid4().hex}"
+            start = time.perf_counter()
+            communicator.send(key, payload)
+            send_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            assert len(communicator.receive(key)) == size
+            receive_times.append(time.perf_counter() - start)
+            communicator.cleanup(key)
+
+        print(json.dumps({
+            "workers": workers,
+            "part_size": args.part_size if workers else None,
+            "size": size,
+            "send_time": min(send_times),
+            "receive_time": min(receive_times),
+            "send_mb_s": size / min(send_times) / MEGABYTE,
+            "receive_mb_s": size / min(receive_times) / MEGABYTE,
+        }))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Throughput and memory of receiving one large message from a socket.
+
+Compares the old receive loop, which appends every recv to a growing bytes
+object, with p2p_utils.recvall, which fills a preallocated buffer with
+recv_into. A sender thread writes the message over loopback TCP. Peak memory
+is the traced allocation peak of the receiving side (tracemalloc).
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+import tracemalloc
+
+from bulletin.p2p_utils import recvall
+
+BUFF_SIZE = 1000*1000
+
+
+def recv_concat(sock, size):
+    message = b""
+    while len(message) < size:
+        data = sock.recv(min(size - len(message), BUFF_SIZE))
+        if not data:
+            return None
+        message += data
+    return message
+
+
+def run(receive, size, payload):
+    server = socket.create_server(("127.0.0.1", 0))
+    sender = socket.create_connection(server.getsockname())
+    receiver, _ = server.accept()
+    server.close()
+
+    thread = threading.Thread(target=sender.sendall, args=(payload[:size],))
+    tracemalloc.start()
+    start = time.perf_counter()
+    thread.start()
+    message = receive(receiver, size)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    thread.join()
+
+    assert len(message) == size
+    sender.close()
+    receiver.close()
+    return elapsed, peak
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000, 100_000_000, 500_000_000])
+parser.add_argument('-n', '--number', type=int, default=3)
+parser.add_argument('--concat-limit', type=int, default=500_000_000, help='skip the old receive loop above this size')
+args = parser.parse_args()
+
+# one shared payload, slices of a memoryview are sent without copying
+payload = memoryview(bytearray(max(args.sizes)))
+methods = {"concat": recv_concat, "recv_into": recvall}
+for size in args.sizes:
+    for name, receive in methods.items():
+        if name == "concat" and size > args.concat_limit:
+            continue
+        for i in range(args.number):
+            elapsed, peak = run(receive, size, payload)
+            print(json.dumps({
+                "method": name,
+                "message_size": size,
+                "time": elapsed,
+                "throughput_mb_s": size / elapsed / 1e6,
+                "peak_memory": peak,
+            }))
@@ -2,17 +2,51 @@ import sys
 import argparse
 import bulletin
 
+
+def prefix_ttl(value):
+    prefix, _, seconds = value.rpartition('=')
+    try:
+        return prefix, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected PREFIX=SECONDS, got {value!r}")
+
+
 parser = argparse.ArgumentParser(description='Bulletin', prog='bulletin')
 parser.add_argument('server', type=str, help='p2p or relay')
 parser.add_argument('--host', type=str, help='host to listen on', default='0.0.0.0')
 parser.add_argument('--port', type=int, help='port to listen on', default=12345)
+parser.add_argument('--mode', type=str, help='relay server mode: event-loop or threaded', default='event-loop', choices=['event-loop', 'threaded'])
+parser.add_argument('--workers', type=int, help='relay worker processes, channels are sharded between them', default=1)
+parser.add_argument('--queue-limit', type=int, help='max bytes queued per relay subscriber', default=8*bulletin.MEGABYTE)
+parser.add_argument('--overflow', type=str, help='when a subscriber queue is full: block the publisher or disconnect the subscriber', default='block', choices=['block', 'disconnect'])
+parser.add_argument('--history-limit', type=int, help='max bytes of unsubscribed relay messages kept in memory', default=512*bulletin.MEGABYTE)
+parser.add_argument('--spill-limit', type=int, help='max bytes of unsubscribed relay messages kept in spill files', default=4000*bulletin.MEGABYTE)
+parser.add_argument('--spill-threshold', type=int, help='relay messages at least this big are spilled to disk', default=16*bulletin.MEGABYTE)
+parser.add_argument('--spill-dir', type=str, help='directory for spill files', default=None)
+parser.add_argument('--history-ttl', type=float, help='seconds unsubscribed relay messages are kept', default=600)
+parser.add_argument('--history-ttl-prefix', type=prefix_ttl, action='append', default=[], metavar='PREFIX=SECONDS', help='--history-ttl for channels starting with PREFIX, repeatable, the longest matching prefix wins')
+parser.add_argument('--handshake-timeout', type=float, help='seconds a p2p client has to finish the rendezvous handshake', default=10)
+parser.add_argument('--pairing-ttl', type=float, help='seconds a p2p client waits for its peer', default=300)
 
 args = parser.parse_args()
 
 if args.server == 'p2p':
-    bulletin.P2PServer(args.host, args.port).run()
+    bulletin.P2PServer(args.host, args.port, args.handshake_timeout, args.pairing_ttl).run()
 elif args.server == 'relay':
-    bulletin.RelayServer(args.host, args.port).run()
+    history = bulletin.MessageHistory(
+        max_bytes=args.history_limit,
+        max_spill_bytes=args.spill_limit,
+        ttl=args.history_ttl,
+        ttls=dict(args.history_ttl_prefix),
+        spill_threshold=args.spill_threshold,
+        spill_dir=args.spill_dir)
+
+    if args.mode == 'threaded':
+        bulletin.RelayServer(args.host, args.port, history).run()
+    elif args.workers > 1:
+        bulletin.ShardedRelayServer(args.host, args.port, args.workers, args.queue_limit, args.overflow, history).run()
+    else:
+        bulletin.EventLoopRelayServer(args.host, args.port, args.queue_limit, args.overflow, history).run()
 else:
     print("Invalid server type (use 'p2p' or 'relay')")
     sys.exit(1)
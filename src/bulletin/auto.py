@@ -1,5 +1,6 @@
 import yaml
-from .bulletin import Communicator, S3Communicator, DynamoDBCommunicator, EFSCommunicator, RedisCommunicator, RelayCommunicator, P2PCommunicator
+from .bulletin import Communicator, S3Communicator, DynamoDBCommunicator, EFSCommunicator, RedisCommunicator, RelayCommunicator, ShardedRelayCommunicator, P2PCommunicator, MEGABYTE
+from .polling import polling_strategy
 
 
 class BulletinRule:
@@ -80,9 +81,9 @@ class AutoCommunicator(Communicator):
         self._get_communicator(len(data)).send(key, data)
         self.sizes[key] = len(data)
 
-    def receive(self, key: str, expected_size: int) -> bytes:
+    def receive(self, key: str, expected_size: int, deadline: "float | None" = None) -> bytes:
         self.sizes[key] = expected_size
-        return self._get_communicator(expected_size).receive(key)
+        return self._get_communicator(expected_size).receive(key, deadline)
 
     def cleanup(self, key: str):
         self._get_communicator(self.sizes[key]).cleanup(key)
@@ -96,23 +97,57 @@ class AutoCommunicator(Communicator):
 
         return self.communicators[method]
 
-    @property
-    def usage(self) -> dict[str, int]:
-        return self._get_communicator(list(self.sizes.values())[0]).usage
-
     def _create_communicator(self, name: str) -> Communicator:
+        communicator = self._new_communicator(name)
+        # one set of metrics for all backends, usage and traces cover every one of them
+        communicator.metrics = self.metrics
+        section = self.config.config.get(name, {})
+        if "polling" in section:
+            # a name, or a dict of the name under strategy and its options
+            polling = section["polling"]
+            if isinstance(polling, str):
+                polling = {"strategy": polling}
+            polling = dict(polling)
+            communicator.polling = polling_strategy(polling.pop("strategy"), name, **polling)
+        if "timeout" in section:
+            communicator.timeout = section["timeout"]
+        return communicator
+
+    def _new_communicator(self, name: str) -> Communicator:
         if name == "s3":
-            return S3Communicator(self.config.config["s3"]["bucket"])
+            s3 = self.config.config["s3"]
+            return S3Communicator(s3["bucket"], max_workers=s3.get("max_workers", 16),
+                                  threshold=s3.get("threshold", 16*MEGABYTE), part_size=s3.get("part_size", 8*MEGABYTE),
+                                  shards=s3.get("shards", 16))
         elif name == "dynamodb":
-            return DynamoDBCommunicator(self.config.config["dynamodb"]["table"])
+            dynamodb = self.config.config["dynamodb"]
+            return DynamoDBCommunicator(dynamodb["table"], chunk_size=dynamodb.get("chunk_size", 350_000),
+                                        max_workers=dynamodb.get("max_workers", 16))
         elif name == "efs":
-            return EFSCommunicator(self.config.config["efs"]["mount_path"])
+            efs = self.config.config["efs"]
+            return EFSCommunicator(efs["mount_path"], fanout=efs.get("fanout", 256), watch=efs.get("watch", True),
+                                   zero_copy=efs.get("zero_copy", False), block_size=efs.get("block_size", 8*MEGABYTE),
+                                   chunks=efs.get("chunks", 1))
         elif name == "redis":
-            return RedisCommunicator(self.config.config["redis"]["host"], self.config.config["redis"]["port"])
+            redis = self.config.config["redis"]
+            return RedisCommunicator(redis["host"], redis["port"], blocking=redis.get("blocking", True),
+                                     timeout=redis.get("timeout", 900.0))
         elif name == "relay":
-            return RelayCommunicator(self.config.config["relay"]["host"], self.config.config["relay"]["port"])
+            relay = self.config.config["relay"]
+            if "hosts" in relay:
+                return ShardedRelayCommunicator(relay["hosts"], relay.get("port", 12345), relay.get("virtual_nodes", 128))
+            return RelayCommunicator(relay["host"], relay["port"])
         elif name == "p2p":
-            return P2PCommunicator(self.config.config["p2p"]["host"], self.config.config["p2p"]["port"])
+            p2p = self.config.config["p2p"]
+            relay = None
+            if p2p.get("relay_fallback"):
+                # the relay from the relay section carries the peers that can't punch through
+                if "relay" not in self.communicators:
+                    self.communicators["relay"] = self._create_communicator("relay")
+                relay = self.communicators["relay"]
+            return P2PCommunicator(p2p["host"], p2p["port"], connect_timeout=p2p.get("connect_timeout", 60.0),
+                                   streams=p2p.get("streams", 1), chunk_size=p2p.get("chunk_size", 4*MEGABYTE),
+                                   relay=relay, punch_timeout=p2p.get("punch_timeout", 10.0))
 
 
 # config = BulletinConfig.from_file("bulletin/src/bulletin/bulletin_policy.yml")
@@ -1,39 +1,60 @@
+import errno
+import mmap
+import select
+import selectors
 import socket
+import struct
 import time
 import os
+import random
 from abc import ABC, abstractmethod
-from threading import Event, Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Thread
 import boto3
-
-from .p2p_utils import string_to_addr, addr_to_string, send_msg, recv_msg
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+
+from .p2p_utils import string_to_addr, addr_to_string, send_msg, recv_msg, recvall, recv_into, send_buffers
+from .hashring import HashRing
+from .ratelimit import TokenBucket, shared_limiter
+from .peers import PeerConnection, PeerPool, peer_pool
+from .udp import UDPStream
+from .watch import DirectoryWatch, remote_filesystem
+from .polling import PollingStrategy, FixedPolling, ExponentialPolling, AdaptivePolling, legacy_polling, polling_strategy
+from .metrics import Metrics, ChromeTrace, Histogram, measured
+from .framing import PROTOCOL_VERSION, V1_HEADER_SIZE, FRAME, STRIPE, ACTIONS, REJOIN_OFFER, REJOIN_ACK, hello, parse_hello, frame_header, parse_frame_header
 
 MEGABYTE = 1000*1000
 BUFF_SIZE = 1*MEGABYTE
 
 class Communicator(ABC):
-    events: list[str]
+    metrics: Metrics
+    polling: PollingStrategy
+    timeout: "float | None"
 
     def __init__(self):
-        self.events = []
+        # requests made, and count, bytes and latency of sends, receives and cleanups
+        self.metrics = Metrics()
+        # retries of requests that failed for a moment
         self.poll_limit = 1000
+        # spacing of polls for a message in receive
+        self.polling = legacy_polling()
+        # seconds receive waits when not given a deadline, as long as a Lambda function may run. None waits forever
+        self.timeout = 900.0
 
     @property
     def usage(self) -> dict[str, int]:
-        """Tally events"""
-        event_counts = {}
-        for event in self.events:
-            if event not in event_counts:
-                event_counts[event] = 0
-            event_counts[event] += 1
-
-        return event_counts
+        """Number of requests by kind, see metrics for more"""
+        return self.metrics.counts()
 
     @abstractmethod
     def send(self, key: str, data: bytes):
         pass
 
     @abstractmethod
-    def receive(self, key: str) -> bytes:
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        """Raises TimeoutError when the message isn't there by deadline, a time.time() timestamp"""
         pass
 
     @abstractmethod
@@ -43,210 +64,1141 @@ class Communicator(ABC):
     def backoff_sleep(self, i):
         time.sleep(2**(i/50)/1000)
 
+    def until(self, deadline: "float | None") -> "float | None":
+        """time.monotonic() at which a receive with deadline gives up, timeout from now without one"""
+        if deadline is not None:
+            return time.monotonic() + deadline - time.time()
+        if self.timeout is not None:
+            return time.monotonic() + self.timeout
+        return None
+
+    def poll(self, check, until: "float | None", sent_at=None):
+        """
+        Calls check until it returns something other than None and returns
+        that, sleeping as polling says in between. Raises TimeoutError once
+        until (see until()) has passed. sent_at(result) is the time.time()
+        the message was sent, or None, for polling to learn how long the
+        backend takes to show messages.
+        """
+        start = time.monotonic()
+        started = time.time()
+        slept = 0.0
+        attempt = 0
+        while True:
+            result = check()
+            now = time.monotonic()
+            if result is not None:
+                sent = sent_at(result) if sent_at else None
+                # a message that was there before we looked says nothing about the lag. Clocks of
+                # other machines can be off a little, so it is never negative
+                if sent is not None and sent >= started:
+                    # it showed up at some point during the last sleep
+                    self.polling.observe(max(time.time() - slept / 2 - sent, 0.0))
+                return result
+            if until is not None and now >= until:
+                raise TimeoutError("no message before the deadline")
+
+            slept = self.polling.interval(attempt, now - start)
+            if until is not None:
+                slept = min(slept, until - now)
+            time.sleep(slept)
+            attempt += 1
+
 
 class S3Communicator(Communicator):
     bucket: str
-
-    def __init__(self, bucket: str):
+    max_workers: int
+    threshold: int
+    part_size: int
+    shards: int
+    limiter: TokenBucket
+
+    # Error codes S3 answers with when a prefix gets more requests than it can take
+    THROTTLING_CODES = {"SlowDown", "503", "ServiceUnavailable", "RequestLimitExceeded", "Throttling", "ThrottlingException"}
+    # Attempts of a throttled or dropped request before giving up
+    MAX_ATTEMPTS = 10
+
+    def __init__(self, bucket: str, client=None, max_workers=16, threshold=16*MEGABYTE, part_size=8*MEGABYTE,
+                 shards=16, limiter: "TokenBucket | None" = None):
+        """
+        Payloads larger than threshold are uploaded as a multipart upload of
+        part_size parts and downloaded with part_size byte range GETs, up to
+        max_workers at a time. S3 wants parts of at least 5 MiB. client
+        replaces the boto3 S3 client, e.g. with one whose endpoint_url points
+        at a local S3 stand-in.
+
+        Keys are spread over shards object key prefixes by their hash, S3
+        scales request rates per prefix. Both sides need the same shards, 0
+        keeps keys as given. Every request goes through limiter, by default
+        the one shared by all S3Communicators of the bucket in the process.
+        """
         super().__init__()
         self.bucket = bucket
-        self.client = boto3.client("s3")
-
+        self.max_workers = max_workers
+        self.threshold = threshold
+        self.part_size = part_size
+        self.shards = shards
+        self.limiter = limiter or shared_limiter(f"s3:{bucket}")
+        # one connection per worker, botocore keeps 10 by default. Retries are
+        # left to _request so that throttling reaches the limiter
+        self.client = client or boto3.client("s3", config=Config(max_pool_connections=max(max_workers, 10),
+                                                                  retries={"total_max_attempts": 1}))
+        self.executor = None
+
+    def object_key(self, key: str) -> str:
+        if not self.shards:
+            return key
+        width = len(f"{self.shards - 1:x}")
+        return f"{HashRing.position(key) % self.shards:0{width}x}/{key}"
+
+    @measured("s3")
     def send(self, key: str, data: bytes):
-        self.events.append("s3:PutObject")
-        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        key = self.object_key(key)
+        if len(data) <= self.threshold:
+            # when it was sent, for receivers to learn how long S3 takes to show it. LastModified has whole
+            # seconds only. Multipart uploads would have to stamp the start of the upload, so they don't
+            self._request("put_object", Bucket=self.bucket, Key=key, Body=data, Metadata={"sent": repr(time.time())})
+            return
+
+        upload_id = self._request("create_multipart_upload", Bucket=self.bucket, Key=key)["UploadId"]
+        view = memoryview(data).cast("B")
+
+        def upload_part(number):
+            offset = (number - 1) * self.part_size
+            response = self._request("upload_part", Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                     Body=bytes(view[offset:offset + self.part_size]))
+            return {"PartNumber": number, "ETag": response["ETag"]}
 
-    def receive(self, key: str) -> bytes:
-        for i in range(self.poll_limit):
+        try:
+            parts = list(self._executor().map(upload_part, range(1, -(-len(view) // self.part_size) + 1)))
+            # the object only shows up for receivers once it is complete
+            self._request("complete_multipart_upload", Bucket=self.bucket, Key=key, UploadId=upload_id,
+                          MultipartUpload={"Parts": parts})
+        except BaseException:
+            self._request("abort_multipart_upload", Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    @measured("s3")
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        key = self.object_key(key)
+        response = self.poll(lambda: self._get_first_part(key), self.until(deadline), self._sent_at)
+        if not response:
+            # empty object
+            return b""
+
+        size = int(response["ContentRange"].rpartition("/")[2])
+        first = response["Body"].read()
+        if size == len(first):
+            return first
+        return self._receive_ranges(key, size, first)
+
+    def _get_first_part(self, key: str) -> "dict | None":
+        # the first part tells the size, small objects need nothing else
+        try:
+            return self._request("get_object", Bucket=self.bucket, Key=key, Range=f"bytes=0-{self.part_size - 1}")
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "InvalidRange":
+                return {}
+            # not there yet, throttling was already waited out by _request
+            return None
+        except:
+            return None
+
+    @staticmethod
+    def _sent_at(response: dict) -> "float | None":
+        sent = response.get("Metadata", {}).get("sent")
+        return None if sent is None else float(sent)
+
+    def _receive_ranges(self, key: str, size: int, first: bytes) -> bytearray:
+        data = bytearray(size)
+        view = memoryview(data)
+        view[:len(first)] = first
+
+        def receive_range(offset):
+            end = min(offset + self.part_size, size)
+            body = self._request("get_object", Bucket=self.bucket, Key=key, Range=f"bytes={offset}-{end - 1}")["Body"]
+            for chunk in body.iter_chunks(1024 * 1024):
+                view[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+            if offset != end:
+                raise ConnectionError(f"range of {key} ended at {offset}, expected {end}")
+
+        list(self._executor().map(receive_range, range(len(first), size, self.part_size)))
+        return data
+
+    def _request(self, method: str, **kwargs) -> dict:
+        """
+        Calls client.method once the limiter lets it through. Throttled
+        requests slow the limiter down and, like dropped connections, are
+        retried after a jittered exponential backoff.
+        """
+        event = "s3:" + "".join(word.title() for word in method.split("_"))
+        for attempt in range(self.MAX_ATTEMPTS):
+            self.limiter.acquire()
+            self.metrics.event(event)
             try:
-                self.events.append("s3:GetObject")
-                return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
-            except:
-                self.backoff_sleep(i)
+                response = getattr(self.client, method)(**kwargs)
+            except ClientError as e:
+                if attempt + 1 == self.MAX_ATTEMPTS or not self._throttled(e):
+                    raise
+                self.metrics.event("s3:SlowDown")
+                self.limiter.throttled()
+            except (BotoConnectionError, HTTPClientError):
+                if attempt + 1 == self.MAX_ATTEMPTS:
+                    raise
+            else:
+                self.limiter.succeeded()
+                return response
+            time.sleep(random.uniform(0, min(0.05 * 2**attempt, 5.0)))
+
+    def _throttled(self, error: ClientError) -> bool:
+        return (error.response["Error"].get("Code") in self.THROTTLING_CODES
+                or error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 503)
 
-        raise TimeoutError("Exceeded poll limit while waiting for message")
+    def _executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers)
+        return self.executor
 
+    @measured("s3")
     def cleanup(self, key: str):
-        self.events.append("s3:DeleteObject")
-        self.client.delete_object(Bucket=self.bucket, Key=key)
+        self._request("delete_object", Bucket=self.bucket, Key=self.object_key(key))
 
 
 class EFSCommunicator(Communicator):
     mount_path: str
-
-    def __init__(self, mount_path: str):
+    fanout: int
+    watch: bool
+    watcher: "DirectoryWatch | None"
+    directories: set[str]
+    zero_copy: bool
+    block_size: int
+    chunks: int
+
+    # Longest wait on inotify before checking for the file anyway, seconds
+    WATCH_INTERVAL = 1.0
+    # Manifest of a chunked message: total size, number of chunk files
+    MANIFEST = struct.Struct(">QI")
+
+    def __init__(self, mount_path: str, fanout=256, watch=True, zero_copy=False, block_size=8*MEGABYTE, chunks=1):
+        """
+        Messages go into one of fanout subdirectories of mount_path picked by
+        the hash of the key, so no directory holds more than a share of the
+        messages in flight. fanout 0 keeps them in mount_path itself, both
+        sides need the same fanout.
+
+        receive only looks for its own file. With watch it sleeps on inotify
+        until the file is renamed into place, except on NFS (EFS) where
+        writes from other machines don't generate events and it polls.
+
+        Files are written block_size bytes at a time. With zero_copy receive
+        returns a memoryview of the file mapped into memory instead of
+        reading it into bytes. chunks > 1 splits large messages over up to
+        that many files written and read in parallel, listed by a manifest
+        that is written first so the receiver can start on the chunks that
+        are there. Both sides need the same chunks, zero_copy doesn't apply.
+        """
         super().__init__()
         self.mount_path = mount_path
-
+        self.fanout = fanout
+        self.watch = watch and not remote_filesystem(mount_path)
+        self.zero_copy = zero_copy
+        self.block_size = block_size
+        self.chunks = chunks
+        # shared by all receives, created on first use
+        self.watcher = None
+        self.executor = None
+        # subdirectories known to exist
+        self.directories = set()
+
+    def path(self, key: str) -> str:
+        if not self.fanout:
+            return os.path.join(self.mount_path, key)
+        width = len(f"{self.fanout - 1:x}")
+        return os.path.join(self.mount_path, f"{HashRing.position(key) % self.fanout:0{width}x}", key)
+
+    @measured("efs")
     def send(self, key: str, data: bytes):
-        with open(os.path.join(self.mount_path, key+"-tmp"), "wb") as f:
-            self.events.append("efs:write")
-            f.write(data)
-
-        os.rename(os.path.join(self.mount_path, key+"-tmp"),os.path.join(self.mount_path, key))
-
-    def receive(self, key: str) -> bytes:
-        for i in range(self.poll_limit):
-            try:
-                self.events.append("efs:listdir")
-                files = os.listdir(self.mount_path)
-                if key in files:
-                    with open(os.path.join(self.mount_path, key), "rb") as f:
-                        self.events.append("efs:read")
-                        data = f.read()
-                        if data:
-                            return data
-            except:
-                pass
-
-            self.backoff_sleep(i)
-
-        raise TimeoutError("Exceeded poll limit while waiting for message")
+        path = self.path(key)
+        self._makedirs(os.path.dirname(path))
+        view = memoryview(data).cast("B")
+        if self.chunks <= 1:
+            self._write(path, view)
+            return
+
+        count = max(1, min(self.chunks, -(-len(view) // self.block_size)))
+        part = -(-len(view) // count)
+        self._write(path, self.MANIFEST.pack(len(view), count))
+        list(self._executor().map(lambda i: self._write(f"{path}.{i}", view[i * part:(i + 1) * part]), range(count)))
+
+    def _write(self, path: str, view):
+        with open(path+"-tmp", "wb", buffering=0) as f:
+            self.metrics.event("efs:write")
+            for offset in range(0, len(view), self.block_size):
+                block = view[offset:offset + self.block_size]
+                while block:
+                    block = block[f.write(block):]
+
+        os.rename(path+"-tmp", path)
+
+    @measured("efs")
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        path = self.path(key)
+        until = self.until(deadline)
+        if self.chunks <= 1:
+            return self._wait_for(path, self._read, until)
+
+        size, count = self.MANIFEST.unpack(self._wait_for(path, self._read, until))
+        data = bytearray(size)
+        view = memoryview(data)
+        part = -(-size // count)
+
+        def read_chunk(i):
+            chunk = view[i * part:(i + 1) * part]
+            self._wait_for(f"{path}.{i}", lambda path: self._read_into(path, chunk), until)
+
+        list(self._executor().map(read_chunk, range(count)))
+        return data
+
+    def _wait_for(self, path: str, read, until: "float | None"):
+        watch = self._watch(os.path.dirname(path))
+        if watch:
+            return self._wait_watched(path, read, watch, until)
+        # the sender's last write is its send, close enough with rename right after
+        return self.poll(lambda: read(path), until, lambda _: self._modified(path))
+
+    def _wait_watched(self, path: str, read, watch: DirectoryWatch, until: "float | None"):
+        while True:
+            generation = watch.generation
+            data = read(path)
+            if data is not None:
+                return data
+
+            remaining = self.WATCH_INTERVAL if until is None else until - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"no message at {path} before the deadline")
+            # looks again every WATCH_INTERVAL in case an event went missing
+            watch.wait(generation, min(remaining, self.WATCH_INTERVAL))
+
+    def _read(self, path: str) -> "bytes | memoryview | None":
+        # send renames complete files into place, so an open that works reads the whole message
+        try:
+            self.metrics.event("efs:open")
+            with open(path, "rb") as f:
+                self.metrics.event("efs:read")
+                if not self.zero_copy:
+                    return f.read()
+                if os.fstat(f.fileno()).st_size == 0:
+                    # empty files can't be mapped
+                    return b""
+                # the mapping outlives the file, cleanup can remove it
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except OSError:
+            # not there yet, or an NFS handle gone stale by a rename
+            return None
+
+    def _modified(self, path: str) -> "float | None":
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
 
+    def _read_into(self, path: str, view) -> "bool | None":
+        try:
+            self.metrics.event("efs:open")
+            with open(path, "rb", buffering=0) as f:
+                self.metrics.event("efs:read")
+                received = 0
+                while received < len(view):
+                    count = f.readinto(view[received:received + self.block_size])
+                    if not count:
+                        raise ValueError(f"{path} is shorter than its manifest says")
+                    received += count
+                return True
+        except OSError:
+            return None
+
+    def _watch(self, directory: str) -> "DirectoryWatch | None":
+        if not self.watch:
+            return None
+        try:
+            self._makedirs(directory)
+            if self.watcher is None:
+                self.watcher = DirectoryWatch()
+            self.watcher.add(directory)
+            return self.watcher
+        except (OSError, AttributeError):
+            # no inotify here (AttributeError: libc without inotify_init1)
+            self.watch = False
+            return None
+
+    def _makedirs(self, directory: str):
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.chunks)
+        return self.executor
+
+    @measured("efs")
     def cleanup(self, key: str):
-        self.events.append("efs:delete")
-        os.remove(os.path.join(self.mount_path, key))
+        path = self.path(key)
+        if self.chunks > 1:
+            with open(path, "rb") as f:
+                _, count = self.MANIFEST.unpack(f.read(self.MANIFEST.size))
+            for i in range(count):
+                os.remove(f"{path}.{i}")
+        self.metrics.event("efs:delete")
+        os.remove(path)
 
 
 class DynamoDBCommunicator(Communicator):
-    def __init__(self, table_name: str):
+    chunk_size: int
+    max_workers: int
+    chunks: dict[str, int]
+
+    # Items per BatchWriteItem and keys per BatchGetItem. A BatchGetItem
+    # response holds at most 16 MB, so gets stay well below the 100 allowed
+    WRITE_BATCH = 25
+    GET_BATCH = 40
+
+    def __init__(self, table_name: str, resource=None, chunk_size=350_000, max_workers=16):
+        """
+        Payloads larger than chunk_size (items are limited to 400 KB) are
+        written as chunk items {key}#0, {key}#1, ... with BatchWriteItem, and
+        then a manifest item under key that lists how many there are. The
+        receiver finds the manifest and reads the chunks with BatchGetItem,
+        max_workers batches at a time. resource replaces the boto3 DynamoDB
+        resource, e.g. with one whose endpoint_url points at DynamoDB Local.
+        """
         super().__init__()
-        self.dynamodb = boto3.resource("dynamodb")
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.dynamodb = resource or boto3.resource("dynamodb", config=Config(max_pool_connections=max(max_workers, 10)))
         self.table = self.dynamodb.Table(table_name)
-
+        # unlike resources, clients can be shared by threads. This one
+        # converts attribute values like the resource does
+        self.client = self.dynamodb.meta.client
+        self.executor = None
+        # number of chunks of the keys sent or received, for cleanup
+        self.chunks = {}
+
+    @measured("dynamodb")
     def send(self, key: str, data: bytes):
-        self.events.append("dynamodb:PutItem")
-        self.table.put_item(Item={"id": key, "message": data})
+        if len(data) <= self.chunk_size:
+            self.chunks[key] = 0
+            self.metrics.event("dynamodb:PutItem")
+            self.table.put_item(Item={"id": key, "message": data, "sent": repr(time.time())})
+            return
+
+        view = memoryview(data).cast("B")
+        items = [
+            {"id": f"{key}#{i}", "message": bytes(view[offset:offset + self.chunk_size])}
+            for i, offset in enumerate(range(0, len(view), self.chunk_size))
+        ]
+        batches = [items[i:i + self.WRITE_BATCH] for i in range(0, len(items), self.WRITE_BATCH)]
+        list(self._executor().map(self._write_batch, [[{"PutRequest": {"Item": item}} for item in batch] for batch in batches]))
+
+        # the manifest goes last, receivers only find complete messages
+        self.chunks[key] = len(items)
+        self.metrics.event("dynamodb:PutItem")
+        self.table.put_item(Item={"id": key, "chunks": len(items), "size": len(data), "sent": repr(time.time())})
+
+    @measured("dynamodb")
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        item = self.poll(lambda: self._get_item(key), self.until(deadline), self._sent_at)
+        if "message" in item:
+            self.chunks[key] = 0
+            return bytes(item["message"])
+        return self._receive_chunks(key, int(item["chunks"]), int(item["size"]))
+
+    def _get_item(self, key: str) -> "dict | None":
+        try:
+            self.metrics.event("dynamodb:GetItem")
+            return self.table.get_item(Key={"id": key})["Item"]
+        except:
+            return None
+
+    @staticmethod
+    def _sent_at(item: dict) -> "float | None":
+        # tells how long DynamoDB took to show the item
+        return float(item["sent"]) if "sent" in item else None
+
+    def _receive_chunks(self, key: str, chunks: int, size: int) -> bytearray:
+        self.chunks[key] = chunks
+        data = bytearray(size)
+        view = memoryview(data)
+
+        def get_batch(numbers):
+            for item in self._get_batch([f"{key}#{i}" for i in numbers]):
+                i = int(item["id"].rpartition("#")[2])
+                message = item["message"].value
+                view[i * self.chunk_size:i * self.chunk_size + len(message)] = message
+
+        numbers = range(chunks)
+        list(self._executor().map(get_batch, [numbers[i:i + self.GET_BATCH] for i in range(0, chunks, self.GET_BATCH)]))
+        return data
+
+    def _write_batch(self, requests: list):
+        table = self.table.name
+        for i in range(self.poll_limit):
+            self.metrics.event("dynamodb:BatchWriteItem")
+            requests = self.client.batch_write_item(RequestItems={table: requests})["UnprocessedItems"].get(table)
+            if not requests:
+                return
+            # throttled, try the rest again
+            self.backoff_sleep(i)
 
-    def receive(self, key: str) -> bytes:
+        raise TimeoutError("Exceeded poll limit while writing chunks")
+
+    def _get_batch(self, ids: list[str]) -> list[dict]:
+        table = self.table.name
+        request = {table: {"Keys": [{"id": id} for id in ids], "ConsistentRead": True}}
+        items = []
         for i in range(self.poll_limit):
-            try:
-                self.events.append("dynamodb:GetItem")
-                return bytes(self.table.get_item(Key={"id": key})["Item"]["message"])
-            except:
-                self.backoff_sleep(i)
+            self.metrics.event("dynamodb:BatchGetItem")
+            response = self.client.batch_get_item(RequestItems=request)
+            items += response["Responses"].get(table, [])
+            request = response["UnprocessedKeys"]
+            if not request:
+                break
+            # throttled or over the 16 MB response limit, ask for the rest
+            self.backoff_sleep(i)
+        else:
+            raise TimeoutError("Exceeded poll limit while reading chunks")
+
+        if len(items) != len(ids):
+            raise ValueError(f"chunks of {ids[0]} missing")
+        return items
 
-        raise TimeoutError("Exceeded poll limit while waiting for message")
+    def _executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers)
+        return self.executor
 
+    @measured("dynamodb")
     def cleanup(self, key: str):
-        self.events.append("dynamodb:DeleteItem")
+        chunks = self.chunks.pop(key, None)
+        if chunks is None:
+            # somebody else's message, its manifest tells how many chunks it has
+            self.metrics.event("dynamodb:GetItem")
+            item = self.table.get_item(Key={"id": key}).get("Item", {})
+            chunks = int(item.get("chunks", 0))
+
+        self.metrics.event("dynamodb:DeleteItem")
         self.table.delete_item(Key={"id": key})
+        requests = [{"DeleteRequest": {"Key": {"id": f"{key}#{i}"}}} for i in range(chunks)]
+        list(self._executor().map(self._write_batch, [requests[i:i + self.WRITE_BATCH] for i in range(0, chunks, self.WRITE_BATCH)]))
 
 
 class RedisCommunicator(Communicator):
-    def __init__(self, host: str, port=6379):
+    blocking: bool
+
+    # Stream field that holds the message
+    FIELD = b"message"
+
+    def __init__(self, host: str, port=6379, blocking=True, timeout: "float | None" = 900.0):
+        """
+        With blocking, send appends the message to a stream under key and
+        receive waits for it with XREAD BLOCK. Redis answers the waiting
+        XREAD as soon as the XADD arrives, so there are no empty polls. The
+        stream keeps only the latest message, sending again to a key
+        replaces it like SET does. It stays until cleanup, like with GET, so
+        any number of receivers can read it. Without a deadline receive gives up after timeout
+        seconds, None waits forever. blocking=False keeps the plain SET / GET
+        polling, both sides need the same mode.
+        """
         super().__init__()
         import redis
         self.redis = redis.Redis(host=host, port=port, db=0)
+        self.blocking = blocking
+        self.timeout = timeout
 
+    @measured("redis")
     def send(self, key: str, data: bytes):
-        self.events.append("redis:set")
+        if self.blocking:
+            self.metrics.event("redis:xadd")
+            # exact trim, the stream never holds an older message
+            self.redis.xadd(key, {self.FIELD: data}, maxlen=1, approximate=False)
+            return
+
+        self.metrics.event("redis:set")
         self.redis.set(key, data)
 
-    def receive(self, key: str) -> bytes:
-        for i in range(self.poll_limit):
-            self.events.append("redis:get")
-            value = self.redis.get(key)
-            if value is not None:
-                return value
+    @measured("redis")
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        if self.blocking:
+            return self._receive_blocking(key, self.until(deadline))
 
-            self.backoff_sleep(i)
+        def get():
+            self.metrics.event("redis:get")
+            return self.redis.get(key)
 
-        raise TimeoutError("Exceeded poll limit while waiting for message")
+        # values are nothing but the message, so adaptive polling has no send times to learn from here
+        return self.poll(get, self.until(deadline))
 
+    def _receive_blocking(self, key: str, until: "float | None") -> bytes:
+        while True:
+            if until is None:
+                # BLOCK 0 waits forever
+                block = 0
+            else:
+                block = int((until - time.monotonic()) * 1000)
+                if block <= 0:
+                    raise TimeoutError(f"no message for {key} before the deadline")
+
+            self.metrics.event("redis:xread")
+            # from the start of the stream, so a message sent before we got here counts too
+            response = self.redis.xread({key: "0-0"}, count=1, block=block)
+            if response:
+                _, entries = response[0]
+                _, fields = entries[0]
+                return fields[self.FIELD]
+
+    @measured("redis")
     def cleanup(self, key: str):
-        self.events.append("redis:delete")
+        self.metrics.event("redis:delete")
         self.redis.delete(key)
 
 
 class RelayCommunicator(Communicator):
-    def __init__(self, host: str, port=12345):
+    """
+    Relay client, one connection for any number of channels.
+
+    Every channel is subscribed once, a background reader hands incoming
+    messages to the threads waiting in receive for that channel, so several
+    threads can receive from different channels at the same time. Cleaning
+    up the last channel closes the connection, the next send or receive
+    opens a new one.
+    """
+    host: str
+    port: int
+    protocol: int
+    client: "socket.socket | None"
+    subscriptions: set[str]
+    inbox: dict[str, deque]
+    waiters: dict[str, Condition]
+    reader: "Thread | None"
+    error: "Exception | None"
+
+    # Seconds to wait for the server to answer a HELLO before falling back to v1
+    HELLO_TIMEOUT = 5
+    # Bytes read at a time until the channel of a v1 message is known
+    PREFIX_SIZE = 4096
+
+    def __init__(self, host: str, port=12345, protocol=PROTOCOL_VERSION):
         super().__init__()
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect((host, port))
-
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self._connect()
+
+        # Guards client, subscriptions, inbox and waiters
+        self.lock = Lock()
+        # Keeps messages of concurrent sends from interleaving
+        self.send_lock = Lock()
+        self.subscriptions = set()
+        # Messages received for a channel, until a receive takes them
+        self.inbox = {}
+        self.waiters = {}
+        self.reader = None
+        self.error = None
+
+    @measured("relay")
     def send(self, key: str, data: bytes):
-        self._socket_send_message(self._build_message("publish", key, data))
-
-    def receive(self, key: str) -> bytes:
-        self._socket_send_message(self._build_message("subscribe", key, b""))
-
-        message = self._socket_receive_message()
-        try:
-            msg = self._parse_message(message)
-        except Exception as e:
-            print("ERROR decoding data:", message)
-            raise e
-
-        return msg["message"]
-
+        self._socket_send_message("publish", key, data)
+
+    @measured("relay")
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        until = self.until(deadline)
+        with self.lock:
+            if self.client is None:
+                self._connect()
+            subscribe = key not in self.subscriptions
+            if subscribe:
+                self.subscriptions.add(key)
+                self.inbox[key] = deque()
+                self.waiters[key] = Condition(self.lock)
+            # cleanup may drop them from the dicts while we wait
+            inbox, waiter = self.inbox[key], self.waiters[key]
+            if self.reader is None:
+                self.reader = Thread(target=self._read_messages, args=(self.client,), daemon=True)
+                self.reader.start()
+
+        if subscribe:
+            self._socket_send_message("subscribe", key, b"")
+
+        with self.lock:
+            while not inbox and self.error is None:
+                if self.waiters.get(key) is not waiter:
+                    raise ConnectionError(f"{key} was cleaned up while waiting for a message")
+                if until is None:
+                    waiter.wait()
+                    continue
+                remaining = until - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"no message on {key} before the deadline")
+                waiter.wait(remaining)
+            if not inbox:
+                raise ConnectionError("relay connection closed") from self.error
+            return inbox.popleft()
+
+    @measured("relay")
     def cleanup(self, key: str):
-        self.client.close()
-
-    def _parse_message(self, message: bytes) -> dict:
-        split = message.split(b"#", 2)
-        action = split[0].decode("utf-8")
-        channel = split[1].decode("utf-8")
-        data = split[2]
-
-        return {
-            "action": action,
-            "channel": channel,
-            "message": data
-        }
-
-    def _build_message(self, action: str, channel: str, data: bytes) -> bytes:
-        return action.encode('utf-8') + b"#" + channel.encode('utf-8') + b"#" + data
+        """Unsubscribe from the channel, messages already on their way are dropped. The last one closes the connection"""
+        with self.lock:
+            subscribed = key in self.subscriptions
+            self.subscriptions.discard(key)
+            self.inbox.pop(key, None)
+            waiter = self.waiters.pop(key, None)
+            if waiter is not None:
+                waiter.notify_all()
+            error = self.error
+            client = self._detach() if not self.subscriptions else None
+        if client is not None:
+            self._shutdown(client)
+        elif subscribed and error is None:
+            # otherwise the server keeps forwarding publishes on the channel to us
+            self._socket_send_message("unsubscribe", key, b"")
+
+    def close(self):
+        """Close the connection, the next send or receive opens a new one"""
+        with self.lock:
+            client = self._detach()
+        if client is not None:
+            self._shutdown(client)
+
+    def _connect(self):
+        self.client = socket.create_connection((self.host, self.port))
+        self.protocol = self._negotiate(self.protocol)
+        self.error = None
+
+    def _detach(self) -> "socket.socket | None":
+        """Forget the connection and its channels, the caller holds lock and closes the returned socket"""
+        client, self.client = self.client, None
+        self.error = ConnectionError("relay communicator closed")
+        for waiter in self.waiters.values():
+            waiter.notify_all()
+        self.subscriptions.clear()
+        self.inbox.clear()
+        self.waiters.clear()
+        self.reader = None
+        return client
+
+    @staticmethod
+    def _shutdown(client: socket.socket):
+        try:
+            # wakes the reader blocked in recv, close alone doesn't
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.close()
+
+    def _read_messages(self, client: socket.socket):
+        while True:
+            try:
+                channel, message = self._socket_receive_message(client)
+                if channel is None:
+                    raise ConnectionError("relay server closed the connection")
+            except Exception as e:
+                with self.lock:
+                    if self.client is client:
+                        self.error = e
+                        for waiter in self.waiters.values():
+                            waiter.notify_all()
+                return
+
+            with self.lock:
+                if self.client is client and channel in self.subscriptions:
+                    self.inbox[channel].append(message)
+                    self.waiters[channel].notify()
+
+    def _negotiate(self, protocol: int) -> int:
+        if protocol == 1:
+            return 1
+
+        self.client.settimeout(self.HELLO_TIMEOUT)
+        try:
+            self.client.sendall(hello(protocol))
+            version = parse_hello(recvall(self.client, V1_HEADER_SIZE) or b"")
+        except OSError:
+            version = None
+        self.client.settimeout(None)
+
+        if version is None:
+            # servers before v2 drop the connection on a HELLO
+            print("Relay server does not support protocol v2, using v1")
+            self.client.close()
+            self.client = socket.create_connection((self.host, self.port))
+            return 1
+        return version
+
+    def _socket_send_message(self, action: str, channel: str, data: bytes):
+        # header and payload go out in one sendmsg, the payload is never copied
+        with self.send_lock:
+            with self.lock:
+                if self.client is None:
+                    self._connect()
+                client = self.client
+            header = frame_header(self.protocol, action, channel.encode("utf-8"), len(data))
+            send_buffers(client, [header, data])
+
+    def _socket_receive_message(self, client: socket.socket) -> "tuple[str | None, bytearray]":
+        """Receive the next message, only its payload ends up in the returned buffer"""
+        if self.protocol == 1:
+            data = recvall(client, V1_HEADER_SIZE)
+
+            if not data:
+                return None, b""
+
+            return self._receive_v1_message(client, int(data))
+
+        header = recvall(client, FRAME.size)
+        if header is None:
+            return None, b""
+
+        _, channel_length, size = parse_frame_header(header)
+        # the channel is received on its own, so is the payload
+        channel = recvall(client, channel_length)
+        if channel is None:
+            return None, b""
+        payload = self._receive_payload(client, size)
+        if payload is None:
+            return None, b""
+        return channel.decode("utf-8"), payload
+
+    def _receive_v1_message(self, client: socket.socket, size: int) -> "tuple[str | None, bytearray]":
+        # read up to the second '#', whatever follows it is the start of the payload
+        prefix = bytearray()
+        while prefix.count(b"#") < 2:
+            data = client.recv(min(size - len(prefix), self.PREFIX_SIZE))
+            if not data:
+                return None, b""
+            prefix += data
+            if len(prefix) == size and prefix.count(b"#") < 2:
+                raise ValueError(f"ERROR decoding data: {bytes(prefix[:64])}")
+
+        first = prefix.find(b"#")
+        start = prefix.find(b"#", first + 1) + 1
+        payload = self._receive_payload(client, size - start, memoryview(prefix)[start:])
+        if payload is None:
+            return None, b""
+        return prefix[first+1:start-1].decode("utf-8"), payload
+
+    def _receive_payload(self, client: socket.socket, size: int, received=b"") -> "bytearray | None":
+        payload = bytearray(size)
+        payload[:len(received)] = received
+        with memoryview(payload) as view:
+            if recv_into(client, view, len(received)) < size:
+                return None
+        return payload
+
+
+class ShardedRelayCommunicator(Communicator):
+    """
+    Relay client for several independent relay servers.
+
+    Every key is mapped to one of the servers with consistent hashing, so
+    publisher and subscriber of a key always meet on the same one, and
+    adding a server moves only about 1/N of the keys. Endpoints are
+    "host", "host:port" or (host, port), connections are opened on first use.
+    """
+    ring: HashRing
+    endpoints: dict[str, tuple[str, int]]
+    communicators: dict[str, RelayCommunicator]
+
+    def __init__(self, endpoints: list, port=12345, virtual_nodes=128, protocol=PROTOCOL_VERSION):
+        super().__init__()
+        self.protocol = protocol
+        self.endpoints = {}
+        for endpoint in endpoints:
+            if isinstance(endpoint, str):
+                host, _, endpoint_port = endpoint.partition(":")
+                endpoint = (host, int(endpoint_port or port))
+            self.endpoints[f"{endpoint[0]}:{endpoint[1]}"] = tuple(endpoint)
+
+        self.ring = HashRing(list(self.endpoints), virtual_nodes)
+        self.communicators = {}
+        self.lock = Lock()
 
-    def _socket_send_message(self, data: bytes):
-        self.client.send(str(len(data)).rjust(16).encode("utf-8"))
-        self.client.send(data)
+    def send(self, key: str, data: bytes):
+        self._get_communicator(key).send(key, data)
 
-    def _socket_receive_message(self) -> bytes:
-        message = b""
-        data = self.client.recv(16)
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        if deadline is None and self.timeout is not None:
+            deadline = time.time() + self.timeout
+        return self._get_communicator(key).receive(key, deadline)
 
-        if not data:
-            return b""
+    def cleanup(self, key: str):
+        self._get_communicator(key).cleanup(key)
 
-        size = int(data)
-        while len(message) < size:
-            bytes_to_receive = min(size - len(message), BUFF_SIZE)
-            data = self.client.recv(bytes_to_receive)
-            message += data
+    def close(self):
+        for communicator in self.communicators.values():
+            communicator.close()
 
-        return message
+    def _get_communicator(self, key: str) -> RelayCommunicator:
+        endpoint = self.ring.node(key)
+        with self.lock:
+            if endpoint not in self.communicators:
+                host, port = self.endpoints[endpoint]
+                self.communicators[endpoint] = RelayCommunicator(host, port, self.protocol)
+                # receive passes on a deadline from our timeout
+                self.communicators[endpoint].timeout = None
+                # counted as one, whichever server a key went to
+                self.communicators[endpoint].metrics = self.metrics
+            return self.communicators[endpoint]
 
 
 class P2PCommunicator(Communicator):
-    STOP: Event
     server: socket.socket
     socket: socket.socket
     host: str
     port: int
-
-    def __init__(self, host: str, port=12345):
+    protocol: int
+    connect_timeout: float
+    peer: "str | None"
+    pool: PeerPool
+    streams: int
+    chunk_size: int
+    stripes: "list[P2PCommunicator]"
+    relay: "Communicator | None"
+    punch_timeout: float
+    channels: "tuple[str, str] | None"
+    transport: str
+    udp_options: dict
+    reused: bool
+
+    # Seconds to wait for the peer's HELLO, or its rejoin on a pooled connection
+    HELLO_TIMEOUT = 5
+    # Seconds a connect attempt may stay pending before it is started over
+    ATTEMPT_TIMEOUT = 1
+    # Seconds to wait before retrying a refused connect
+    RETRY_INTERVAL = 0.05
+    # Longest wait between UDP probes to the p2p server, the first ones go out faster
+    PROBE_INTERVAL = 0.2
+
+    def __init__(self, host: str, port=12345, protocol=PROTOCOL_VERSION, connect_timeout=60.0,
+                 peer: "str | None" = None, pool: "PeerPool | None" = None, streams=1, chunk_size=4*MEGABYTE,
+                 relay: "Communicator | None" = None, punch_timeout=10.0, transport="tcp",
+                 udp_options: "dict | None" = None):
+        """
+        Peers running bulletin versions before protocol v2 need protocol=1 on both sides.
+        connect_timeout bounds the whole connection setup, rendezvous included.
+
+        peer names the link between the two sides, both have to pass the same
+        name. Then the rendezvous uses it instead of the key, and cleanup keeps
+        the connection in pool (the process wide peer_pool by default) for the
+        next communicator with the same peer, whatever its keys.
+
+        With streams > 1 both sides punch that many connections and payloads
+        larger than chunk_size are split into chunks spread over all of them.
+        Both sides need the same streams.
+
+        With a relay communicator, a peer that can't be reached directly
+        within punch_timeout seconds of the rendezvous is talked to over two
+        relay channels instead, named after the key and both public
+        addresses. usage counts p2p:direct and p2p:relay.
+
+        transport="udp" punches UDP instead of TCP and runs a reliable
+        UDPStream over it, udp_options (mss, window, loss) go to UDPStream.
+        Both sides need the same transport. UDP links are not pooled.
+        """
         super().__init__()
-        self.STOP = Event()
         self.host = host
         self.port = port
+        self.protocol = protocol
+        self.connect_timeout = connect_timeout
+        self.peer = peer
+        self.pool = pool if pool is not None else peer_pool
+        self.streams = streams
+        self.chunk_size = chunk_size
+        self.stripes = []
+        self.executor = None
+        self.relay = relay
+        self.punch_timeout = punch_timeout
+        # (send, receive) relay channels once the relay is used instead of a direct connection
+        self.channels = None
+        if transport not in ("tcp", "udp"):
+            raise ValueError(f"unknown transport {transport!r}, expected tcp or udp")
+        self.transport = transport
+        self.udp_options = udp_options or {}
         self.server = None
         self.socket = None
+        # socket came from the pool
+        self.reused = False
+
+    @property
+    def identity(self) -> tuple:
+        return (self.host, self.port, self.peer)
 
     def _connect(self, key: str):
+        if self.streams == 1:
+            self._connect_stream(key)
+            return
+
+        # one punched connection per stream, all set up at once under their own keys
+        self.stripes = [self] + [
+            P2PCommunicator(self.host, self.port, self.protocol, self.connect_timeout,
+                            None if self.peer is None else f"{self.peer}/{i}", self.pool,
+                            relay=self.relay, punch_timeout=self.punch_timeout,
+                            transport=self.transport, udp_options=self.udp_options)
+            for i in range(1, self.streams)]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.streams)
+        try:
+            list(self.executor.map(lambda i: self.stripes[i]._connect_stream(f"{key}/{i}" if i else key), range(self.streams)))
+        except BaseException:
+            for stripe in self.stripes:
+                if stripe.socket:
+                    stripe.socket.close()
+                    stripe.socket = None
+            self.stripes = []
+            raise
+        self.protocol = min(stripe.protocol for stripe in self.stripes)
+        for stripe in self.stripes[1:]:
+            self.metrics.merge(stripe.metrics)
+            stripe.metrics.reset()
+
+        relayed = [stripe for stripe in self.stripes if stripe.channels]
+        if relayed:
+            # both sides see the same paths, so they agree on carrying everything over the relay
+            self.channels = relayed[0].channels
+            for stripe in self.stripes:
+                if stripe.socket:
+                    stripe.socket.close()
+                    stripe.socket = None
+            self.stripes = []
+
+    def _connect_stream(self, key: str, reuse=True):
+        self.reused = False
+        if self.peer is not None:
+            connection = self.pool.get(self.identity) if reuse and self.transport == "tcp" else None
+            if connection:
+                # the peer may have given up on its end meanwhile, both rejoin so a stale offer can't confirm it
+                self.socket = connection.socket
+                self.protocol = connection.protocol
+                try:
+                    self._rejoin()
+                    self.reused = True
+                    self.metrics.event("p2p:reuse")
+                    return
+                except (OSError, ConnectionError, ValueError):
+                    self.metrics.event("p2p:stale")
+                    self.socket.close()
+                    self.socket = None
+            key = self.peer
+
         #
-        # TCP hole punching
+        # TCP (or UDP) hole punching
         #
 
+        self.metrics.event("p2p:rendezvous")
+        deadline = time.monotonic() + self.connect_timeout
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if self.transport == "udp" else None
+        try:
+            priv_addr, pub_addr, data = self._rendezvous(key.encode('utf-8'), deadline, udp)
+        except BaseException:
+            if udp is not None:
+                udp.close()
+            raise
+        pubdata, privdata = data.split(b'|')
+        client_pub_addr = string_to_addr(pubdata)
+        client_priv_addr = string_to_addr(privdata)
+        print("client public is %s and private is %s, peer public is %s private is %s" % (pub_addr, priv_addr, client_pub_addr, client_priv_addr))
+
+        if self.relay is not None:
+            deadline = min(deadline, time.monotonic() + self.punch_timeout)
+        try:
+            if udp is not None:
+                self.socket = UDPStream.punch(udp, [client_pub_addr, client_priv_addr], deadline, **self.udp_options)
+            else:
+                self.socket = self._punch(priv_addr, [(client_pub_addr, client_priv_addr)], deadline)[client_pub_addr]
+            self._negotiate()
+        except (OSError, ConnectionError) as e:
+            if udp is not None and self.socket is None:
+                udp.close()
+            if self.relay is None:
+                raise
+            # a peer whose HELLO fails gives up on the direct path too, so both end up here
+            print("no direct path to peer %s (%s), using the relay" % (client_pub_addr, e))
+            if self.socket:
+                self.socket.close()
+                self.socket = None
+            me, peer = addr_to_string(pub_addr).decode(), addr_to_string(client_pub_addr).decode()
+            self.channels = (f"p2p/{key}/{me}>{peer}", f"p2p/{key}/{peer}>{me}")
+            self.metrics.event("p2p:relay")
+            return
+
+        self.socket.settimeout(None)
+        self.metrics.event("p2p:direct")
+
+    @classmethod
+    def group(cls, host: str, group: str, rank: int, size: int, port=12345, protocol=PROTOCOL_VERSION,
+              connect_timeout=60.0) -> "dict[int, P2PCommunicator]":
+        """
+        Connects rank to every other rank of the group with a single
+        rendezvous. The server hands out all addresses at once and the links
+        are punched in parallel, so a full mesh takes about as long as one
+        link. Returns a connected communicator per peer rank.
+        """
+        this = cls(host, port, protocol, connect_timeout)
+        deadline = time.monotonic() + connect_timeout
+        priv_addr, _, data = this._rendezvous(b"%s|%d|%d" % (group.encode('utf-8'), rank, size), deadline)
+        members = [tuple(string_to_addr(addr) for addr in member.split(b'|')) for member in data.split(b';')]
+        print("client private is %s, rank %s of group %s" % (priv_addr, rank, group))
+
+        peers = {r: member for r, member in enumerate(members) if r != rank}
+        sockets = this._punch(priv_addr, list(peers.values()), deadline)
+        communicators = {}
+        for r, (pub, _) in peers.items():
+            communicators[r] = cls(host, port, protocol, connect_timeout)
+            communicators[r].socket = sockets[pub]
+            communicators[r].metrics.event("p2p:group")
+
+        # every HELLO goes out before any is awaited, otherwise ranks waiting on each other could go round in a circle
+        for communicator in communicators.values():
+            communicator._send_hello()
+        for communicator in communicators.values():
+            communicator._receive_hello()
+            communicator.socket.settimeout(None)
+        return communicators
+
+    def _rendezvous(self, registration: bytes, deadline: float,
+                    udp: "socket.socket | None" = None) -> "tuple[tuple, tuple, bytes]":
+        """
+        Registers with the p2p server, returns our private and public address
+        and the server's reply about the peers. With a udp socket, it is bound
+        to the same address as the TCP connection and the public address is
+        the one the server sees its datagrams come from.
+        """
         print("client start")
 
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.settimeout(self.connect_timeout)
         self.server.connect((self.host, self.port))
         priv_addr = self.server.getsockname()
 
         # 1. client->server. send client private_ip+port
-        send_msg(self.server, addr_to_string(priv_addr) + b"|" + key.encode('utf-8'))
+        if udp is None:
+            send_msg(self.server, addr_to_string(priv_addr) + b"|" + registration)
+        else:
+            send_msg(self.server, addr_to_string(priv_addr) + b"|" + registration + b"|udp")
+            # 2. the server learns our UDP public address from a datagram, repeated until it answers over TCP
+            udp.bind(priv_addr)
+            probe = b"BLTN|" + addr_to_string(priv_addr) + b"|" + registration
+            interval = 0.005
+            while True:
+                udp.sendto(probe, self.server.getpeername())
+                # the first probe may overtake the registration, the server drops it then
+                if select.select([self.server], [], [], interval)[0]:
+                    break
+                interval = min(interval * 2, self.PROBE_INTERVAL)
+                if time.monotonic() >= deadline:
+                    raise TimeoutError("p2p server got none of our UDP probes within %s seconds" % self.connect_timeout)
         # 4. receive our public_ip+port
         data = recv_msg(self.server)
         print("client %s %s - received data: %s" % (priv_addr[0], priv_addr[1], data))
@@ -254,135 +1206,286 @@ class P2PCommunicator(Communicator):
         # 5. reply back to server with what we received from them
         send_msg(self.server, addr_to_string(pub_addr))
 
-        # 7. receive peer address for the peer that the public server matched us with
-        data = recv_msg(self.server)
-        pubdata, privdata = data.split(b'|')
-        client_pub_addr = string_to_addr(pubdata)
-        client_priv_addr = string_to_addr(privdata)
-        print("client public is %s and private is %s, peer public is %s private is %s" % (pub_addr, priv_addr, client_pub_addr, client_priv_addr))
-
-        # try to both connect to the peer and accept connection from peer. whichever works faster. or works at all
-        threads = {
-            # '0_accept': Thread(target=accept, args=(priv_addr[1],)),
-            '1_accept': Thread(target=self.accept, args=(client_pub_addr[1],)),
-            '2_connect': Thread(target=self.connect, args=(priv_addr, client_pub_addr,)),
-            # '3_connect': Thread(target=connect, args=(priv_addr, client_priv_addr,)),
-        }
-        for name in sorted(threads.keys()):
-            print('start thread %s' % name)
-            threads[name].start()
-
-        # Join all threads
-        while threads or not self.STOP.is_set():
-            keys = list(threads.keys())
-            time.sleep(0.01)
-            for name in keys:
-                # try:
-                #     # threads[name].join(5) # wait for 5 sec for thread to finish
-                #     # threads[name].join(0.1) # wait for 0.1 sec for thread to finish
-                # except TimeoutError:
-                #     continue
-                if not threads[name].is_alive():
-                    threads.pop(name)
-
-        if self.STOP.is_set():
-            print("STOP is set, connection to peer established")
-            # print(self.socket)
-            # self.socket.settimeout(900)
-            # remove timeout
-            if self.socket:
-                self.socket.settimeout(None)
-
-        print("THREADS ENDED")
+        # 7. receive the address of the peers that the public server matched us with
+        self.server.settimeout(max(deadline - time.monotonic(), 0.001))
+        try:
+            data = recv_msg(self.server)
+        except socket.timeout:
+            raise TimeoutError("no peer arrived within %s seconds" % self.connect_timeout)
+        finally:
+            self.server.close()
+        if data is None:
+            raise ConnectionError("rendezvous server closed the connection, no peer arrived in time")
+        return priv_addr, pub_addr, bytes(data)
+
+    def _punch(self, local_addr, peers: "list[tuple]", deadline: float) -> "dict[tuple, socket.socket]":
+        """
+        TCP simultaneous open with every peer at once: accept on our private
+        port and connect from it to each peer's public address, all
+        non-blocking on one selector. For each peer the first socket to come
+        up wins and the other attempt is closed right away. Both sides of a
+        link use the same pair of ports either way, so they end up on the
+        same connection. peers are (public, private) address pairs, the
+        result is keyed by public address.
+        """
+        selector = selectors.DefaultSelector()
+        listener = self._bound_socket(local_addr)
+        listener.listen(len(peers))
+        selector.register(listener, selectors.EVENT_READ)
+        # accepted connections come from the public address, or from the private one without NAT in between
+        known = {pub: pub for pub, _ in peers}
+        for pub, priv in peers:
+            known.setdefault(priv, pub)
+        connected = {}
+        # public address -> (socket, started) of pending connects, and when to start the missing ones
+        attempts = {}
+        retry_at = {pub: time.monotonic() for pub, _ in peers}
 
+        try:
+            while len(connected) < len(peers):
+                now = time.monotonic()
+                if now >= deadline:
+                    missing = [pub for pub, _ in peers if pub not in connected]
+                    raise TimeoutError("could not connect to peers %s within %s seconds" % (missing, self.connect_timeout))
+
+                for pub, (attempt, started) in list(attempts.items()):
+                    if now - started >= self.ATTEMPT_TIMEOUT:
+                        # SYN probably dropped by the peer's NAT before it punched its hole, send a new one
+                        selector.unregister(attempt)
+                        attempt.close()
+                        del attempts[pub]
+                        retry_at[pub] = now
+
+                for pub, at in list(retry_at.items()):
+                    if at > now:
+                        continue
+                    del retry_at[pub]
+                    attempt = self._bound_socket(local_addr)
+                    error = attempt.connect_ex(pub)
+                    if error in (0, errno.EINPROGRESS):
+                        selector.register(attempt, selectors.EVENT_WRITE, pub)
+                        attempts[pub] = (attempt, now)
+                    else:
+                        # e.g. EADDRNOTAVAIL while the peer's connect is being accepted
+                        attempt.close()
+                        retry_at[pub] = now + self.RETRY_INTERVAL
+
+                wake = min([deadline, *retry_at.values()] + [started + self.ATTEMPT_TIMEOUT for _, started in attempts.values()])
+                for event, _ in selector.select(max(wake - now, 0)):
+                    if event.fileobj is listener:
+                        try:
+                            conn, addr = listener.accept()
+                        except BlockingIOError:
+                            continue
+                        pub = known.get(addr)
+                        if pub is None or pub in connected:
+                            conn.close()
+                            continue
+                        print("accept from %s connected!" % (addr,))
+                        connected[pub] = conn
+                        retry_at.pop(pub, None)
+                        if pub in attempts:
+                            attempt, _ = attempts.pop(pub)
+                            selector.unregister(attempt)
+                            attempt.close()
+                        continue
+
+                    pub = event.data
+                    if pub not in attempts or attempts[pub][0] is not event.fileobj:
+                        # lost to an accept handled earlier in this round
+                        continue
+                    attempt, _ = attempts.pop(pub)
+                    selector.unregister(attempt)
+                    if attempt.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        print("connect from %s to %s success!" % (local_addr, pub))
+                        connected[pub] = attempt
+                    else:
+                        # refused until the peer listens
+                        attempt.close()
+                        retry_at[pub] = time.monotonic() + self.RETRY_INTERVAL
+
+            result, connected = connected, {}
+            return result
+        finally:
+            selector.close()
+            listener.close()
+            for attempt, _ in attempts.values():
+                attempt.close()
+            for conn in connected.values():
+                conn.close()
+
+    @staticmethod
+    def _bound_socket(local_addr) -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.setblocking(False)
+        s.bind(local_addr)
+        return s
+
+    def _negotiate(self):
+        """Both peers say HELLO right after connecting and use the lower version"""
+        self._send_hello()
+        self._receive_hello()
+
+    def _rejoin(self):
+        """Offer a fresh nonce on a pooled connection and ack the peer's offer, only a peer that is here now acks ours"""
+        nonce = int.from_bytes(os.urandom(8), "big")
+        self.socket.settimeout(self.HELLO_TIMEOUT)
+        self.socket.sendall(FRAME.pack(PROTOCOL_VERSION, ACTIONS["rejoin"], REJOIN_OFFER, nonce))
+        offered = acked = False
+        while not (offered and acked):
+            header = recvall(self.socket, FRAME.size)
+            if header is None:
+                raise ConnectionError("peer closed the pooled connection")
+            action, kind, echoed = parse_frame_header(header)
+            if action != "rejoin":
+                raise ConnectionError(f"peer sent {action} instead of rejoining")
+            if kind == REJOIN_OFFER:
+                offered = True
+                self.socket.sendall(FRAME.pack(PROTOCOL_VERSION, ACTIONS["rejoin"], REJOIN_ACK, echoed))
+            elif echoed == nonce:
+                acked = True
+        self.socket.settimeout(None)
+
+    def _send_hello(self):
+        if self.protocol == 1:
+            return
+
+        self.socket.settimeout(self.HELLO_TIMEOUT)
+        self.socket.sendall(hello(self.protocol))
+
+    def _receive_hello(self):
+        if self.protocol == 1:
+            return
+
+        version = parse_hello(recvall(self.socket, V1_HEADER_SIZE) or b"")
+        if version is None:
+            raise ConnectionError("peer did not answer HELLO, it needs protocol=1")
+        self.protocol = min(self.protocol, version)
+
+    @measured("p2p")
     def send(self, key: str, data: bytes):
-        if not self.socket:
+        if not self.socket and not self.channels:
             self._connect(key)
 
-        self.socket.send(str(len(data)).rjust(16).encode("utf-8"))
-        self.socket.send(data)
-
-    def receive(self, key: str) -> bytes:
-        if not self.socket:
+        if self.channels:
+            self.relay.send(self.channels[0], data)
+            return
+        if self.protocol == 1:
+            header = str(len(data)).rjust(V1_HEADER_SIZE).encode("utf-8")
+        elif len(self.stripes) > 1 and len(data) > self.chunk_size:
+            self._send_striped(data)
+            return
+        else:
+            header = FRAME.pack(self.protocol, ACTIONS["data"], 0, len(data))
+        send_buffers(self.socket, [header, data])
+
+    def _send_striped(self, data: bytes):
+        self.socket.sendall(FRAME.pack(self.protocol, ACTIONS["stripe"], 0, len(data)))
+        view = memoryview(data).cast("B")
+        offsets = range(0, len(view), self.chunk_size)
+
+        def send_stripe(i):
+            sock = self.stripes[i].socket
+            # chunks go round robin, stream i sends chunks i, i+streams, ...
+            for offset in offsets[i::len(self.stripes)]:
+                chunk = view[offset:offset + self.chunk_size]
+                send_buffers(sock, [STRIPE.pack(offset, len(chunk)), chunk])
+            sock.sendall(STRIPE.pack(len(view), 0))
+
+        list(self.executor.map(send_stripe, range(len(self.stripes))))
+
+    @measured("p2p")
+    def receive(self, key: str, deadline: "float | None" = None) -> bytes:
+        until = self.until(deadline)
+        if not self.socket and not self.channels:
             self._connect(key)
 
-        message = b""
-        data = self.socket.recv(16)
-
-        if not data:
-            return b""
-
-        size = int(data)
-        while len(message) < size:
-            bytes_to_receive = min(size - len(message), BUFF_SIZE)
-            data = self.socket.recv(bytes_to_receive)
-            message += data
-
-        return message
-
+        data = self._receive(until)
+        if data is None and self.reused and not self.stripes:
+            # the peer dropped the pooled connection after rejoining, it meets us through the rendezvous server next
+            self.metrics.event("p2p:stale")
+            self.socket.close()
+            self.socket = None
+            self._connect_stream(key, reuse=False)
+            data = self._receive(until)
+        if data is None and self.reused:
+            raise ConnectionError("peer closed the pooled connection")
+        return data if data is not None else b""
+
+    def _receive(self, until: "float | None") -> "bytes | None":
+        """Next message, None on EOF before it"""
+        if self.channels:
+            return self.relay.receive(self.channels[1], None if until is None else time.time() + until - time.monotonic())
+        self._wait_readable(until)
+        if self.protocol == 1:
+            data = recvall(self.socket, V1_HEADER_SIZE)
+
+            if not data:
+                return None
+
+            size = int(data)
+        else:
+            header = recvall(self.socket, FRAME.size)
+            if header is None:
+                return None
+
+            action, channel_length, size = parse_frame_header(header)
+            recvall(self.socket, channel_length)
+            if action == "stripe":
+                return self._receive_striped(size)
+
+        data = recvall(self.socket, size)
+        if data is None and self.reused:
+            raise ConnectionError("peer closed the pooled connection in the middle of a message")
+        return data or b""
+
+    def _wait_readable(self, until: "float | None"):
+        # waits for the start of the next message only, a timeout in the middle would lose our place in the stream
+        if until is None:
+            return
+        remaining = max(until - time.monotonic(), 0)
+        if isinstance(self.socket, UDPStream):
+            readable = self.socket.readable(remaining)
+        else:
+            readable, _, _ = select.select([self.socket], [], [], remaining)
+        if not readable:
+            raise TimeoutError("no message from the peer before the deadline")
+
+    def _receive_striped(self, size: int) -> bytearray:
+        data = bytearray(size)
+        view = memoryview(data)
+
+        def receive_stripe(i):
+            sock = self.stripes[i].socket
+            while True:
+                header = recvall(sock, STRIPE.size)
+                if header is None:
+                    raise ConnectionError("peer closed stream %s in the middle of a striped message" % i)
+                offset, length = STRIPE.unpack(header)
+                if length == 0:
+                    return
+                if offset + length > size:
+                    raise ValueError("stripe chunk at %s+%s is past the end of the message" % (offset, length))
+                if recv_into(sock, view[offset:offset + length]) < length:
+                    raise ConnectionError("peer closed stream %s in the middle of a striped message" % i)
+
+        list(self.executor.map(receive_stripe, range(len(self.stripes))))
+        return data
+
+    @measured("p2p")
     def cleanup(self, key: str):
-        self.socket.close()
-
-    def accept(self, port):
-        print("accept %s" % port)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        s.bind(('', port))
-        s.listen(1)
-        s.settimeout(5)
-        while not self.STOP.is_set():
-            try:
-                s.settimeout(1)
-                conn, addr = s.accept()
-            except socket.timeout:
-                print("Accept timeout, retrying...")
-                continue
-            else:
-                print("Accept %s connected!" % port)
-
-                if not self.STOP.is_set():
-                    self.STOP.set()
-                    self.socket = conn
-
-                # if STOP.is_set():
-                #     conn.close()
-                #     break
-
-                # STOP.set()
-                # global accept_socket
-                # accept_socket = conn
-                # print(f"Got accept on port={port}")
-
-    def connect(self, local_addr, addr):
-        print("connect from %s to %s" % (local_addr, addr))
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        s.bind(local_addr)
-        while not self.STOP.is_set():
-            try:
-                s.settimeout(1)
-                s.connect(addr)
-                print("connect from %s to %s success!" % (local_addr, addr))
-                # send_msg(s, addr_to_string(local_addr))
-                if not self.STOP.is_set():
-                    self.STOP.set()
-                    self.socket = s
-            except socket.error:
-                continue
-            # except Exception as exc:
-            #     logger.exception("unexpected exception encountered")
-            #     break
-            # else:
-                # print("connected from %s to %s success!" % (local_addr, addr))
-
-                # if STOP.is_set():
-                #     s.close()
-                #     break
-
-                # STOP.set()
-                # global connect_socket
-                # connect_socket = s
-                # print(f"Got super socket in connect local_addr={local_addr} addr={addr}")
-
+        for stripe in self.stripes[1:]:
+            stripe.cleanup(key)
+        self.stripes = []
+        if self.channels:
+            self.relay.cleanup(self.channels[1])
+            self.channels = None
+        if self.socket is None:
+            return
+        if self.peer is not None and self.transport == "tcp":
+            self.pool.put(self.identity, PeerConnection(self.socket, self.protocol))
+        else:
+            self.socket.close()
+        self.socket = None
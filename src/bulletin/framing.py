@@ -0,0 +1,96 @@
+import struct
+
+#
+# Wire formats of relay and P2P messages
+#
+# v1: 16 byte ASCII decimal length, then action#channel#data
+# v2: FRAME header (version, action code, channel length, payload length),
+#     then the UTF-8 channel name and the payload
+#
+# Clients that speak v2 open the connection with a 16 byte HELLO frame
+# carrying the highest version they support, the other side answers with
+# the version both will use. A v1 header never starts with a version byte,
+# it's ASCII digits or spaces, so v1 clients keep working unchanged.
+#
+# Striped P2P messages announce their total size with a "stripe" FRAME on
+# the first stream, then each stream carries STRIPE chunks (offset, length,
+# bytes) and ends its share with a chunk of length 0.
+#
+# Peers reusing a pooled P2P connection both send a "rejoin" FRAME offering
+# a fresh nonce (in the payload length field) and answer the other's offer
+# with an ack echoing its nonce. An offer left over from an earlier
+# invocation is never acked back, so it can't vouch for a connection the
+# other side already gave up on.
+#
+
+PROTOCOL_VERSION = 2
+V1_HEADER_SIZE = 16
+FRAME = struct.Struct(">BBHQ")
+STRIPE = struct.Struct(">QQ")
+HELLO_MAGIC = b"BLTN"
+
+ACTIONS = {
+    "data": 0,
+    "publish": 1,
+    "subscribe": 2,
+    "hello": 3,
+    "stripe": 4,
+    "unsubscribe": 5,
+    "rejoin": 6,
+}
+ACTION_NAMES = {code: name for name, code in ACTIONS.items()}
+
+# Kinds of rejoin frames, in the channel length field
+REJOIN_OFFER = 0
+REJOIN_ACK = 1
+
+
+def hello(version=PROTOCOL_VERSION) -> bytes:
+    # same size as a v1 header, so a server can tell them apart with one read
+    return FRAME.pack(version, ACTIONS["hello"], 0, len(HELLO_MAGIC)) + HELLO_MAGIC
+
+
+def parse_hello(header) -> "int | None":
+    """Version offered by a HELLO frame, None if header is a v1 length"""
+    if len(header) != V1_HEADER_SIZE or header[0] < 2 or header[1] != ACTIONS["hello"] \
+            or header[FRAME.size:] != HELLO_MAGIC:
+        return None
+    return header[0]
+
+
+def frame_header(protocol: int, action: str, channel: bytes, size: int) -> bytes:
+    """Everything sent before a payload of the given size"""
+    if protocol == 1:
+        prefix = action.encode("utf-8") + b"#" + channel + b"#"
+        return str(len(prefix) + size).ljust(V1_HEADER_SIZE).encode("utf-8") + prefix
+
+    return FRAME.pack(PROTOCOL_VERSION, ACTIONS[action], len(channel), size) + channel
+
+
+def parse_frame_header(header) -> tuple[str, int, int]:
+    """Return action, channel length and payload length of a v2 header"""
+    version, action, channel_length, size = FRAME.unpack_from(header)
+    if version != PROTOCOL_VERSION or action not in ACTION_NAMES:
+        raise ValueError(f"malformed frame header {bytes(header[:FRAME.size])!r}")
+    return ACTION_NAMES[action], channel_length, size
+
+
+def parse_frame(frame) -> tuple[str, str, memoryview]:
+    """Split a whole v2 frame into action, channel and a view of the payload"""
+    view = memoryview(frame)
+    action, channel_length, size = parse_frame_header(view)
+    start = FRAME.size + channel_length
+    if len(view) != start + size:
+        raise ValueError("truncated frame")
+    return action, str(view[FRAME.size:start], "utf-8"), view[start:]
+
+
+def parse_v1(message) -> tuple[str, str, memoryview]:
+    """Split a v1 message body into action, channel and a view of the data"""
+    first = message.find(b"#")
+    second = message.find(b"#", first + 1)
+    if first == -1 or second == -1:
+        raise ValueError("malformed message")
+
+    view = memoryview(message)
+    return str(view[:first], "utf-8"), str(view[first+1:second], "utf-8"), view[second+1:]
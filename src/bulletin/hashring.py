@@ -0,0 +1,51 @@
+import hashlib
+from bisect import bisect
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes.
+
+    Every node is placed on the ring virtual_nodes times. A key belongs to
+    the first virtual node at or after its own position, so adding or
+    removing one of N nodes only moves about 1/N of the keys. Positions
+    come from md5, which unlike hash() is the same in every process.
+    """
+    nodes: list[str]
+    virtual_nodes: int
+    positions: list[int]
+    owners: list[str]
+
+    def __init__(self, nodes: list[str], virtual_nodes=128):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        self.virtual_nodes = virtual_nodes
+        self.nodes = []
+        self.positions = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.virtual_nodes):
+            position = self.position(f"{node}#{i}")
+            index = bisect(self.positions, position)
+            self.positions.insert(index, position)
+            self.owners.insert(index, node)
+
+    def remove(self, node: str):
+        self.nodes.remove(node)
+        kept = [(p, o) for p, o in zip(self.positions, self.owners) if o != node]
+        self.positions = [p for p, _ in kept]
+        self.owners = [o for _, o in kept]
+
+    def node(self, key: str) -> str:
+        index = bisect(self.positions, self.position(key)) % len(self.positions)
+        return self.owners[index]
+
+    @staticmethod
+    def position(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
@@ -0,0 +1,231 @@
+import functools
+import json
+import math
+import os
+import time
+from collections import deque
+from threading import Lock, get_ident
+
+#
+# What communicators did, in constant memory
+#
+# Metrics counts events (requests to the backend, as usage reports them) and
+# keeps count, bytes and a latency histogram per operation (send, receive and
+# cleanup of a backend). A ChromeTrace attached to it gets a span per
+# operation.
+#
+
+
+class Histogram:
+    """
+    Latencies in logarithmic buckets, BUCKETS_PER_DOUBLING of them per power
+    of two from MIN_SECONDS up, so percentiles are within about 5%.
+    """
+    counts: list[int]
+
+    # Buckets per power of two
+    BUCKETS_PER_DOUBLING = 8
+    # Lower end of the first bucket, shorter latencies go into it
+    MIN_SECONDS = 1e-6
+    # 2**32 microseconds, longer latencies go into the last bucket
+    BUCKETS = 32 * BUCKETS_PER_DOUBLING
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        bucket = 0
+        if seconds > self.MIN_SECONDS:
+            bucket = min(int(math.log2(seconds / self.MIN_SECONDS) * self.BUCKETS_PER_DOUBLING), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "Histogram"):
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> "float | None":
+        """Latency percent (0 to 100) of the recorded ones are below, None when there are none"""
+        if not self.count:
+            return None
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                # geometric middle of the bucket, within what was actually seen
+                middle = self.MIN_SECONDS * 2 ** ((bucket + 0.5) / self.BUCKETS_PER_DOUBLING)
+                return min(max(middle, self.min), self.max)
+        return self.max
+
+
+class OperationStats:
+    count: int
+    errors: int
+    bytes: int
+    latency: Histogram
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def merge(self, other: "OperationStats"):
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.latency.merge(other.latency)
+
+    def summary(self) -> dict:
+        latency = self.latency
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "seconds": latency.total,
+            "mean": latency.total / latency.count if latency.count else None,
+            "p50": latency.percentile(50),
+            "p90": latency.percentile(90),
+            "p99": latency.percentile(99),
+            "max": latency.max if latency.count else None,
+        }
+
+
+class ChromeTrace:
+    """
+    Timeline of operations in the Chrome trace event format, for
+    chrome://tracing or https://ui.perfetto.dev. Keeps the last max_events.
+    Timestamps are wall clock, so traces of several processes line up.
+    """
+    spans: "deque[dict]"
+
+    def __init__(self, max_events=100_000):
+        self.spans = deque(maxlen=max_events)
+        self.lock = Lock()
+        self.pid = os.getpid()
+
+    def add(self, name: str, start: float, seconds: float, **args):
+        """A span of seconds from start, a time.time() timestamp"""
+        span = {"name": name, "cat": name.partition(":")[0], "ph": "X", "ts": start * 1e6, "dur": seconds * 1e6,
+                "pid": self.pid, "tid": get_ident(), "args": args}
+        with self.lock:
+            self.spans.append(span)
+
+    def events(self) -> list[dict]:
+        with self.lock:
+            return list(self.spans)
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, f)
+
+
+class Metrics:
+    """
+    Event counters and per operation stats, safe to share between threads and
+    communicators. tracer, when set, gets a span for every operation.
+    """
+    counters: dict[str, int]
+    operations: dict[str, OperationStats]
+    tracer: "ChromeTrace | None"
+
+    def __init__(self, tracer: "ChromeTrace | None" = None):
+        self.lock = Lock()
+        self.counters = {}
+        self.operations = {}
+        self.tracer = tracer
+
+    def event(self, name: str, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def record(self, name: str, start: float, size=0, error=False, key: "str | None" = None):
+        """Operation name that started at start, a time.perf_counter() timestamp, and moved size bytes"""
+        seconds = time.perf_counter() - start
+        with self.lock:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = OperationStats()
+            stats.count += 1
+            if error:
+                # failed receives are mostly timeouts, they would skew the latencies
+                stats.errors += 1
+            else:
+                stats.bytes += size
+                stats.latency.add(seconds)
+
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.add(name, time.time() - seconds, seconds, key=key, bytes=size, error=error)
+
+    def counts(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+    def summary(self) -> dict:
+        """Event counts and count, bytes and latency percentiles (seconds) of every operation"""
+        with self.lock:
+            return {
+                "events": dict(self.counters),
+                "operations": {name: stats.summary() for name, stats in self.operations.items()},
+            }
+
+    def merge(self, other: "Metrics"):
+        # copied first, holding both locks at once could deadlock two merges the other way round
+        with other.lock:
+            counters = dict(other.counters)
+            operations = []
+            for name, stats in other.operations.items():
+                copy = OperationStats()
+                copy.merge(stats)
+                operations.append((name, copy))
+        with self.lock:
+            for name, count in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + count
+            for name, stats in operations:
+                if name not in self.operations:
+                    self.operations[name] = OperationStats()
+                self.operations[name].merge(stats)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.operations = {}
+
+
+def measured(backend: str):
+    """
+    Records the calls of a communicator's send, receive or cleanup in its
+    metrics as backend:method, with the bytes sent or received.
+    """
+    def decorate(method):
+        operation = f"{backend}:{method.__name__}"
+        sends = method.__name__ == "send"
+
+        @functools.wraps(method)
+        def wrapper(self, key, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = method(self, key, *args, **kwargs)
+            except BaseException:
+                self.metrics.record(operation, start, error=True, key=key)
+                raise
+            data = (args[0] if args else kwargs["data"]) if sends else result
+            # memoryviews of other formats than bytes count items
+            size = data.nbytes if isinstance(data, memoryview) else len(data or b"")
+            self.metrics.record(operation, start, size, key=key)
+            return result
+        return wrapper
+    return decorate
@@ -19,20 +19,44 @@ def addr_to_string(addr):
     return '{}:{}'.format(addr[0], str(addr[1])).encode('utf-8')
 
 
+# Max buffers per sendmsg call
+IOV_MAX = 64
+
+
+def send_buffers(sock, buffers):
+    # sendall for a list of buffers, written with sendmsg without joining them
+    views = [memoryview(b) for b in buffers if len(b)]
+    while views:
+        sent = sock.sendmsg(views[:IOV_MAX])
+        while sent:
+            if sent < len(views[0]):
+                views[0] = views[0][sent:]
+                break
+            sent -= len(views.pop(0))
+
+
 def send_msg(sock, msg):
     # Prefix each message with a 4-byte length (network byte order)
-    msg = struct.pack('>I', len(msg)) + msg
-    sock.sendall(msg)
+    send_buffers(sock, [struct.pack('>I', len(msg)), msg])
+
+
+def recv_into(sock, view, received=0):
+    # Fill view from received on, returns the byte count it ends up holding,
+    # less than len(view) if EOF is hit
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            break
+        received += count
+    return received
 
 
 def recvall(sock, n):
     # Helper function to recv n bytes or return None if EOF is hit
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
+    data = bytearray(n)
+    with memoryview(data) as view:
+        if recv_into(sock, view) < n:
             return None
-        data += packet
     return data
 
 
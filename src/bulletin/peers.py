@@ -0,0 +1,105 @@
+import socket
+import time
+from threading import Lock
+
+
+class PeerConnection:
+    socket: socket.socket
+    protocol: int
+    last_used: float
+
+    def __init__(self, sock: socket.socket, protocol: int):
+        self.socket = sock
+        self.protocol = protocol
+        self.last_used = time.monotonic()
+
+        # lets alive() notice peers that went away without closing the connection
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+    def alive(self) -> bool:
+        """Peek without blocking: EOF or a socket error means the peer is gone, unread data is fine"""
+        try:
+            return self.socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+
+class PeerPool:
+    """
+    Idle punched P2P connections, keyed by peer identity.
+
+    A P2PCommunicator that names its peer checks a connection out of the pool
+    instead of doing a rendezvous and hole punch, and puts it back on
+    cleanup. The pool is a module global, so it outlives the communicators
+    and survives warm Lambda invocations. Connections idle for longer than
+    idle_timeout, or found dead when checked out, are closed.
+    """
+    connections: "dict[tuple, list[PeerConnection]]"
+    idle_timeout: float
+    counters: dict[str, int]
+
+    def __init__(self, idle_timeout=300.0):
+        self.idle_timeout = idle_timeout
+        self.connections = {}
+        self.lock = Lock()
+        self.counters = {
+            "reused": 0,
+            "dead": 0,
+            "evicted": 0,
+        }
+
+    def get(self, identity: tuple) -> "PeerConnection | None":
+        with self.lock:
+            self._evict_idle()
+            idle = self.connections.get(identity, [])
+            while idle:
+                # most recently used first, it is the least likely to be stale
+                connection = idle.pop()
+                if connection.alive():
+                    self.counters["reused"] += 1
+                    return connection
+                self.counters["dead"] += 1
+                connection.socket.close()
+            self.connections.pop(identity, None)
+            return None
+
+    def put(self, identity: tuple, connection: PeerConnection):
+        connection.last_used = time.monotonic()
+        with self.lock:
+            self._evict_idle()
+            self.connections.setdefault(identity, []).append(connection)
+
+    def close(self):
+        with self.lock:
+            for idle in self.connections.values():
+                for connection in idle:
+                    connection.socket.close()
+            self.connections.clear()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(len(idle) for idle in self.connections.values())
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        for identity in list(self.connections):
+            idle = self.connections[identity]
+            kept = [c for c in idle if c.last_used >= cutoff]
+            for connection in idle:
+                if connection.last_used < cutoff:
+                    self.counters["evicted"] += 1
+                    connection.socket.close()
+            if kept:
+                self.connections[identity] = kept
+            else:
+                del self.connections[identity]
+
+
+# Shared by every P2PCommunicator in the process
+peer_pool = PeerPool()
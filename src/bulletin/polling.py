@@ -0,0 +1,126 @@
+import random
+from abc import ABC, abstractmethod
+from collections import deque
+from threading import Lock
+
+
+class PollingStrategy(ABC):
+    """
+    How long a receive sleeps between polls for a message that isn't there yet.
+
+    Communicators ask for one interval after every empty poll and, where the
+    backend tells when a message was sent, report how long it took to show
+    up, for strategies that learn from it. The wall clock limit is up to the
+    communicator.
+    """
+
+    @abstractmethod
+    def interval(self, attempt: int, elapsed: float) -> float:
+        """Seconds to sleep after empty poll number attempt (from 0), elapsed seconds into the receive"""
+
+    def observe(self, lag: float):
+        """A message showed up lag seconds after it was sent"""
+
+
+class FixedPolling(PollingStrategy):
+    def __init__(self, interval=0.01):
+        self.fixed = interval
+
+    def interval(self, attempt: int, elapsed: float) -> float:
+        return self.fixed
+
+
+class ExponentialPolling(PollingStrategy):
+    """
+    initial * factor**attempt, at most maximum. With jitter, a random part of
+    up to that fraction is taken off, so receivers that started together
+    don't keep polling in lockstep.
+    """
+
+    def __init__(self, initial=0.001, factor=1.5, maximum: "float | None" = 1.0, jitter=0.5):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def interval(self, attempt: int, elapsed: float) -> float:
+        interval = self.initial * self.factor ** attempt
+        if self.maximum is not None:
+            interval = min(interval, self.maximum)
+        return interval * (1 - random.uniform(0, self.jitter))
+
+
+class AdaptivePolling(PollingStrategy):
+    """
+    Learns how long the backend takes to show a message after it was sent
+    and polls at a fraction of that.
+
+    Keeps the last window lags and polls every quantile of them divided by
+    dense_polls, so polling adds about that fraction to the delay the
+    backend has anyway. How long the sender takes to send is none of its
+    business: a receive that has been waiting for a while (the sender is
+    still computing) backs off to backoff times the time waited so far, at
+    most maximum, and nothing is slept up front, so early messages are
+    still found right away. Until it has seen warmup lags it behaves like
+    fallback.
+    """
+    lags: "deque[float]"
+
+    # Shortest sleep, seconds
+    MIN_INTERVAL = 0.0005
+
+    def __init__(self, quantile=0.9, dense_polls=10, backoff=0.1, window=64, warmup=8, maximum=1.0,
+                 fallback: "PollingStrategy | None" = None):
+        self.quantile = quantile
+        self.dense_polls = dense_polls
+        self.backoff = backoff
+        self.warmup = warmup
+        self.maximum = maximum
+        self.fallback = fallback or ExponentialPolling()
+        self.lags = deque(maxlen=window)
+        self.lock = Lock()
+        # seconds between polls, None during warmup
+        self.step = None
+
+    def interval(self, attempt: int, elapsed: float) -> float:
+        step = self.step
+        if step is None:
+            return self.fallback.interval(attempt, elapsed)
+        return min(max(step, elapsed * self.backoff), self.maximum)
+
+    def observe(self, lag: float):
+        with self.lock:
+            self.lags.append(lag)
+            if len(self.lags) < self.warmup:
+                return
+            lags = sorted(self.lags)
+            self.step = max(lags[int(self.quantile * (len(lags) - 1))] / self.dense_polls, self.MIN_INTERVAL)
+
+
+def legacy_polling() -> ExponentialPolling:
+    """The curve receive always used: 1 ms, 2x every 50 polls, no limit, no jitter"""
+    return ExponentialPolling(initial=0.001, factor=2**(1/50), maximum=None, jitter=0.0)
+
+
+adaptive: "dict[str, AdaptivePolling]" = {}
+adaptive_lock = Lock()
+
+
+def polling_strategy(name: str, backend: str, **options) -> PollingStrategy:
+    """
+    Strategy by name: fixed, exponential, adaptive or legacy. Adaptive ones
+    are shared by all communicators of backend in the process, so what they
+    learned survives warm Lambda invocations.
+    """
+    if name == "fixed":
+        return FixedPolling(**options)
+    if name == "exponential":
+        return ExponentialPolling(**options)
+    if name == "legacy":
+        return legacy_polling()
+    if name == "adaptive":
+        with adaptive_lock:
+            if backend not in adaptive:
+                adaptive[backend] = AdaptivePolling(**options)
+            return adaptive[backend]
+    raise ValueError(f"unknown polling strategy {name}")
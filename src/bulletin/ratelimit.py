@@ -0,0 +1,82 @@
+import time
+from threading import Lock
+
+
+class TokenBucket:
+    """
+    Client side request rate limit that adapts to throttling.
+
+    acquire blocks until a token is available. Tokens come in at rate per
+    second, at most burst of them wait unused. throttled halves the rate (at
+    most once per COOLDOWN, requests in flight all report the same episode)
+    and drops the saved up tokens, every succeeded adds RECOVERY tokens per
+    second back until max_rate is reached again.
+    """
+    rate: float
+    max_rate: float
+    min_rate: float
+    burst: float
+    tokens: float
+    counters: dict[str, int]
+
+    # Seconds after a decrease during which further throttling is ignored
+    COOLDOWN = 0.1
+    # Tokens per second added back per successful request
+    RECOVERY = 1.0
+
+    def __init__(self, max_rate=3500.0, burst=None, min_rate=1.0):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.burst = burst if burst is not None else max_rate / 10
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.decreased = 0.0
+        self.lock = Lock()
+        self.counters = {
+            "throttled": 0,
+            "waited": 0,
+        }
+
+    def acquire(self):
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            # the debt is paid off by the time the tokens come in
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if wait:
+                self.counters["waited"] += 1
+        if wait:
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.counters["throttled"] += 1
+            now = time.monotonic()
+            if now - self.decreased < self.COOLDOWN:
+                return
+            self._refill()
+            self.decreased = now
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.rate + self.RECOVERY, self.max_rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+
+limiters: "dict[str, TokenBucket]" = {}
+limiters_lock = Lock()
+
+
+def shared_limiter(name: str, **options) -> TokenBucket:
+    """The process wide TokenBucket for name (e.g. an S3 bucket), created with options on first use"""
+    with limiters_lock:
+        if name not in limiters:
+            limiters[name] = TokenBucket(**options)
+        return limiters[name]
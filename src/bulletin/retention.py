@@ -0,0 +1,124 @@
+import mmap
+import tempfile
+import time
+from collections import OrderedDict
+
+MEGABYTE = 1000*1000
+
+
+class ChannelHistory:
+    messages: list
+    size: int
+    spilled: int
+    expires: float
+
+    def __init__(self):
+        self.messages = []
+        self.size = 0
+        self.spilled = 0
+        self.expires = 0.0
+
+
+class MessageHistory:
+    """
+    Messages published to channels nobody subscribed to yet.
+
+    Keeps at most max_bytes in memory and max_spill_bytes in spill files.
+    When over budget, the least recently published channels are evicted
+    first. A channel expires ttl seconds after its last publish, ttls
+    overrides that for channels starting with a given prefix. Messages of at
+    least spill_threshold bytes are received straight into unlinked
+    temporary files mapped with mmap, so they don't take up process memory
+    and are sent back from the page cache.
+    """
+    channels: "OrderedDict[str, ChannelHistory]"
+    held_bytes: int
+    spilled_bytes: int
+    counters: dict[str, int]
+
+    def __init__(self, max_bytes=512*MEGABYTE, max_spill_bytes=4000*MEGABYTE, ttl=600.0,
+                 ttls: "dict[str, float] | None" = None, spill_threshold=16*MEGABYTE, spill_dir: "str | None" = None):
+        self.max_bytes = max_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+
+        # least recently published first
+        self.channels = OrderedDict()
+        self.held_bytes = 0
+        self.spilled_bytes = 0
+        self.counters = {
+            "spilled_messages": 0,
+            "evicted_messages": 0,
+            "evicted_bytes": 0,
+            "expired_messages": 0,
+            "expired_bytes": 0,
+        }
+
+    def __contains__(self, channel: str) -> bool:
+        return channel in self.channels
+
+    def allocate(self, size: int) -> "bytearray | mmap.mmap":
+        """Buffer to receive a message of the given size into, before it is appended"""
+        if size < self.spill_threshold:
+            return bytearray(size)
+
+        with tempfile.TemporaryFile(dir=self.spill_dir) as f:
+            f.truncate(size)
+            # the mapping keeps its own descriptor, the file is gone once it's released
+            return mmap.mmap(f.fileno(), size)
+
+    def append(self, channel: str, message: "bytearray | mmap.mmap"):
+        history = self.channels.pop(channel, None) or ChannelHistory()
+        # re-insert as most recently published
+        self.channels[channel] = history
+
+        history.messages.append(message)
+        history.expires = time.time() + self.ttl_for(channel)
+        if isinstance(message, mmap.mmap):
+            history.spilled += len(message)
+            self.spilled_bytes += len(message)
+            self.counters["spilled_messages"] += 1
+        else:
+            history.size += len(message)
+            self.held_bytes += len(message)
+
+        # evict least recently published channels holding the kind of bytes over budget
+        while self.held_bytes > self.max_bytes:
+            self._drop(next(c for c, h in self.channels.items() if h.size), "evicted")
+        while self.spilled_bytes > self.max_spill_bytes:
+            self._drop(next(c for c, h in self.channels.items() if h.spilled), "evicted")
+
+    def pop(self, channel: str) -> list:
+        history = self.channels.pop(channel)
+        self.held_bytes -= history.size
+        self.spilled_bytes -= history.spilled
+        return history.messages
+
+    def expire(self, now: "float | None" = None):
+        now = now or time.time()
+        for channel in [c for c, h in self.channels.items() if h.expires <= now]:
+            self._drop(channel, "expired")
+
+    def ttl_for(self, channel: str) -> float:
+        prefixes = [p for p in self.ttls if channel.startswith(p)]
+        if prefixes:
+            return self.ttls[max(prefixes, key=len)]
+        return self.ttl
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "channels": len(self.channels),
+            "messages": sum(len(h.messages) for h in self.channels.values()),
+            "held_bytes": self.held_bytes,
+            "spilled_bytes": self.spilled_bytes,
+            **self.counters,
+        }
+
+    def _drop(self, channel: str, reason: str):
+        messages = self.pop(channel)
+        self.counters[f"{reason}_messages"] += len(messages)
+        self.counters[f"{reason}_bytes"] += sum(len(m) for m in messages)
+        print(f"[R] {reason} {len(messages)} message(s) of channel '{channel}'")
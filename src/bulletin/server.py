@@ -1,10 +1,20 @@
+import os
+import time
+import heapq
 import socket
+import struct
+import selectors
 import threading
+import zlib
 import traceback
 import logging
 from abc import ABC, abstractmethod
+from collections import deque
+from itertools import islice
 
-from .p2p_utils import string_to_addr, addr_to_string, send_msg, recv_msg, P2PClient
+from .p2p_utils import string_to_addr, addr_to_string, recvall, recv_into, send_buffers, P2PClient
+from .retention import MessageHistory
+from .framing import PROTOCOL_VERSION, V1_HEADER_SIZE, FRAME, hello, parse_hello, frame_header, parse_frame_header, parse_frame, parse_v1
 
 MEGABYTE = 1000*1000
 BUFF_SIZE = 1*MEGABYTE
@@ -23,8 +33,23 @@ class Server(ABC):
 
 
 class RelayServer(Server):
+    """
+    Relay server with a thread per client. Messages published to channels
+    nobody subscribed to yet are kept in history until the first subscribe.
+    """
     channels: dict[str, list[socket.socket]]
-    message_history: dict[str, list[str]]
+    message_history: MessageHistory
+    protocols: dict[socket.socket, int]
+    send_locks: dict[socket.socket, threading.Lock]
+    lock: threading.Lock
+
+    # Seconds between history expiry runs
+    HOUSEKEEPING_INTERVAL = 5
+
+    def __init__(self, address="0.0.0.0", port=12345, history: "MessageHistory | None" = None):
+        super().__init__(address, port)
+        self.message_history = history or MessageHistory()
+        self.history_stats = None
 
     def run(self):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -34,8 +59,15 @@ class RelayServer(Server):
 
         # Clients grouped by channel
         self.channels = {}
-        # Message history for each channel
-        self.message_history = {}
+        # Protocol version negotiated with each client
+        self.protocols = {}
+        # Keeps messages to a client from interleaving, taken without holding lock
+        self.send_locks = {}
+        # Guards channels, message_history, protocols and send_locks, shared by all client threads.
+        # Never held while sending, a client that stops reading only holds up messages to itself
+        self.lock = threading.Lock()
+
+        threading.Thread(target=self.expire_history, daemon=True).start()
 
         print(f"[*] Server started on {self.address}:{self.port}. Waiting for connections...")
         while True:
@@ -49,84 +81,159 @@ class RelayServer(Server):
         print(f"[+] {self.client_name(client_address)} connected.")
 
         channel = ""
+        try:
+            protocol = self.negotiate(client_socket)
+            with self.lock:
+                self.protocols[client_socket] = protocol
+                self.send_locks[client_socket] = threading.Lock()
 
-        while True:
-            try:
-                message = self.socket_receive_message(client_socket)
-                if message:
-                    try:
-                        msg = self._parse_message(message)
-                    except Exception as e:
-                        print(f"[E] decode error for", message)
-                        raise e
-
-                    action = msg['action']
-
-                    if action == 'subscribe':
-                        channel = msg['channel']
-                        if channel not in self.channels:
-                            self.channels[channel] = []
-                        self.channels[channel].append(client_socket)
+            while True:
+                message = self.socket_receive_message(client_socket, protocol)
+                if not message:
+                    break
+                try:
+                    msg = self._parse_message(message, protocol)
+                except Exception as e:
+                    print(f"[E] decode error for", bytes(message[:64]))
+                    raise e
+
+                action = msg['action']
+
+                if action == 'subscribe':
+                    channel = msg['channel']
+                    # publishes that find us subscribed wait for the send lock, so the history goes out first
+                    with self.send_locks[client_socket]:
+                        with self.lock:
+                            if channel not in self.channels:
+                                self.channels[channel] = []
+                            if client_socket not in self.channels[channel]:
+                                self.channels[channel].append(client_socket)
+                            history = self.message_history.pop(channel) if channel in self.message_history else []
                         print(f"[J] {self.client_name(client_address)} joined channel '{channel}'")
-                        self.send_history(channel, client_socket, self.message_history)
+                        for message in history:
+                            self.socket_send_message(client_socket, channel, message)
 
-                    elif action == 'publish':
-                        channel = msg['channel']
-                        message = self._build_message(msg['action'], msg['channel'], msg['message'])
-                        print(f"[P] {self.client_name(client_address)} -> {channel}")
+                elif action == 'unsubscribe':
+                    channel = msg['channel']
+                    with self.lock:
+                        subscribers = self.channels.get(channel, [])
+                        if client_socket in subscribers:
+                            subscribers.remove(client_socket)
+                        if not subscribers:
+                            self.channels.pop(channel, None)
+                    print(f"[L] {self.client_name(client_address)} left channel '{channel}'")
+
+                elif action == 'publish':
+                    channel = msg['channel']
+                    print(f"[P] {self.client_name(client_address)} -> {channel}")
+                    subscribers = []
+                    with self.lock:
                         if channel in self.channels:
-                            self.relay_message(channel, client_socket, message, self.channels)
+                            subscribers = [c for c in self.channels[channel] if c != client_socket]
                         else:
-                            if channel not in self.message_history:
-                                self.message_history[channel] = []
-                            self.message_history[channel].append(message)
+                            self.message_history.append(channel, self.keep(msg['message']))
+                    self.relay_message(channel, client_socket, msg['message'], subscribers)
+        except Exception as e:
+            print("[E] Error:", e)
+            traceback.print_exc()
+        finally:
+            self.close_client(client_socket, client_address)
 
-                else:
-                    break
-            except Exception as e:
-                print("[E] Error:", e)
-                traceback.print_exc()
-                break
+    def keep(self, message: memoryview):
+        """Copy of a message for history, big ones go to a spill file instead of staying in memory"""
+        kept = self.message_history.allocate(len(message))
+        kept[:] = message
+        return kept
+
+    def expire_history(self):
+        while True:
+            time.sleep(self.HOUSEKEEPING_INTERVAL)
+            with self.lock:
+                self.housekeeping()
+
+    def housekeeping(self):
+        self.message_history.expire()
+        stats = self.message_history.stats()
+        if stats != self.history_stats:
+            print("[R] history:", stats)
+            self.history_stats = stats
+
+    def close_client(self, client_socket, client_address):
+        with self.lock:
+            for channel, subscribers in list(self.channels.items()):
+                if client_socket in subscribers:
+                    subscribers.remove(client_socket)
+                if not subscribers:
+                    del self.channels[channel]
+            self.protocols.pop(client_socket, None)
+            self.send_locks.pop(client_socket, None)
+        client_socket.close()
+        print(f"[-] {self.client_name(client_address)} disconnected.")
+
+    def negotiate(self, s) -> int:
+        """Answer a HELLO if the client starts with one, otherwise it speaks v1"""
+        header = s.recv(V1_HEADER_SIZE, socket.MSG_PEEK | socket.MSG_WAITALL)
+        version = parse_hello(header)
+        if version is None:
+            return 1
+
+        recvall(s, V1_HEADER_SIZE)
+        protocol = min(version, PROTOCOL_VERSION)
+        s.sendall(hello(protocol))
+        return protocol
 
     def client_name(self, client_address):
         return f"{client_address[0]}:{client_address[1]}"
 
-    def socket_send_message(self, socket, data):
-        socket.send(str(len(data)).ljust(16).encode("utf-8"))
-        socket.send(data)
+    def socket_send_message(self, socket, channel, data):
+        header = frame_header(self.protocols[socket], "publish", channel.encode("utf-8"), len(data))
+        send_buffers(socket, [header, data])
 
-    def socket_receive_message(self, s):
-        message = b""
-        data = s.recv(16)
+    def socket_receive_message(self, s, protocol=1):
+        """Receive a v1 message body or a whole v2 frame into one buffer"""
+        if protocol == 1:
+            data = recvall(s, V1_HEADER_SIZE)
 
-        if not data:
-            return b""
+            if not data:
+                return b""
 
-        size = int(data)
-        while len(message) < size:
-            bytes_to_receive = min(size - len(message), BUFF_SIZE)
-            data = s.recv(bytes_to_receive)
-            message += data
+            message = bytearray(int(data))
+            received = 0
+        else:
+            header = recvall(s, FRAME.size)
+            if header is None:
+                return b""
 
-        return message
+            _, channel_length, payload_length = parse_frame_header(header)
+            message = bytearray(FRAME.size + channel_length + payload_length)
+            message[:FRAME.size] = header
+            received = FRAME.size
 
-    def relay_message(self, channel, sender_socket, message, channels):
-        for client in channels[channel]:
-            if client != sender_socket:
-                self.socket_send_message(client, message)
+        with memoryview(message) as view:
+            if recv_into(s, view, received) < len(message):
+                return b""
 
-    def send_history(self, channel, client_socket, message_history):
-        if channel in message_history:
-            for message in message_history[channel]:
-                self.socket_send_message(client_socket, message)
+        return message
 
-            del message_history[channel]
+    def relay_message(self, channel, sender_socket, message, subscribers):
+        for client in subscribers:
+            send_lock = self.send_locks.get(client)
+            if send_lock is None:
+                # disconnected since
+                continue
+            with send_lock:
+                try:
+                    self.socket_send_message(client, channel, message)
+                except (OSError, KeyError):
+                    # its own thread notices and cleans up, the publisher carries on
+                    pass
 
-    def _parse_message(self, message: bytes) -> dict:
-        split = message.split(b"#", 2)
-        action = split[0].decode("utf-8")
-        channel = split[1].decode("utf-8")
-        data = split[2]
+    def _parse_message(self, message, protocol=1) -> dict:
+        # Views into message, the payload is never copied
+        if protocol == 1:
+            action, channel, data = parse_v1(message)
+        else:
+            action, channel, data = parse_frame(message)
 
         return {
             "action": action,
@@ -134,58 +241,1206 @@ class RelayServer(Server):
             "message": data
         }
 
-    def _build_message(self, action: str, channel: str, data: bytes) -> bytes:
-        return action.encode('utf-8') + b"#" + channel.encode('utf-8') + b"#" + data
+class RelayConnection:
+    """State of a single client connection in EventLoopRelayServer"""
+    sock: socket.socket
+    address: tuple
+    protocol: "int | None"
+    header: bytearray
+    header_received: int
+    size: "int | None"
+    action: "str | None"
+    channel_length: "int | None"
+    channel: "str | None"
+    prefix: "bytearray | None"
+    message: "bytearray | None"
+    message_received: int
+    stream: "list[RelayConnection] | None"
+    stream_remaining: int
+    stream_source: "RelayConnection | None"
+    deferred: deque
+    deferred_bytes: int
+    outgoing: deque
+    queued: int
+    blocked: set
+    blocked_on: set
+    channels: set[str]
+    open: bool
+    paused: bool
+    events: int
+    replay: bytearray
+
+    def __init__(self, sock: socket.socket, address: tuple):
+        self.sock = sock
+        self.address = address
+        # Wire format version, None until the first header tells
+        self.protocol = None
+        self.header = bytearray(V1_HEADER_SIZE)
+        self.header_received = 0
+        # Size of the message being received, None while reading the header
+        self.size = None
+        # Known from a v2 header before the channel name is read
+        self.action = None
+        self.channel_length = None
+        # Channel of the buffered message
+        self.channel = None
+        # Start of the message, read until action and channel are known
+        self.prefix = None
+        # Whole message, when it is buffered before relaying
+        self.message = None
+        self.message_received = 0
+        # Subscribers the message is forwarded to chunk by chunk
+        self.stream = None
+        self.stream_remaining = 0
+        # Publisher currently streaming to this connection, other messages wait in deferred
+        self.stream_source = None
+        self.deferred = deque()
+        self.deferred_bytes = 0
+        self.outgoing = deque()
+        self.queued = 0
+        # Publishers waiting for this connection's queue to drain
+        self.blocked = set()
+        # Subscribers whose full queues keep this connection from reading
+        self.blocked_on = set()
+        self.channels = set()
+        self.open = True
+        self.paused = False
+        self.events = 0
+        self.replay = bytearray()
+
+
+class EventLoopRelayServer(RelayServer):
+    """
+    Relay server handling all clients on a single selector loop.
+
+    Speaks the same wire protocols as RelayServer, but never blocks on a
+    client: reads and writes are non-blocking and partially sent messages
+    are kept in a per-connection outgoing queue.
+
+    Large publishes to a channel with subscribers are forwarded cut-through:
+    every chunk goes out as soon as it arrives.
+
+    Each subscriber has its own outgoing queue of at most queue_limit bytes.
+    When a publish finds a subscriber's queue full, the overflow policy
+    either pauses the publisher until the queue drains ("block") or drops
+    the slow subscriber ("disconnect"). Streams always pause the publisher.
+    """
+    channels: dict[str, list[RelayConnection]]
+    parked: set[RelayConnection]
+    selector: selectors.BaseSelector
+
+    # Max recv calls per readiness event, so one fast publisher can't starve others
+    READS_PER_EVENT = 16
+    # Bytes read at a time until the action and channel of a message are known
+    PREFIX_SIZE = 4096
+    # Publishes at least this big are streamed to subscribers instead of buffered
+    STREAM_THRESHOLD = BUFF_SIZE
+    # Max buffers per sendmsg call
+    IOV_MAX = 64
+
+    queue_limit: int
+    overflow: str
+
+    def __init__(self, address="0.0.0.0", port=12345, queue_limit=8*BUFF_SIZE, overflow="block",
+                 history: "MessageHistory | None" = None):
+        super().__init__(address, port, history)
+        if overflow not in ("block", "disconnect"):
+            raise ValueError("overflow must be 'block' or 'disconnect'")
+        self.queue_limit = queue_limit
+        self.overflow = overflow
+
+    def run(self):
+        self.serve(self.create_server_socket())
+
+    def create_server_socket(self) -> socket.socket:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.address, self.port))
+        server.listen(socket.SOMAXCONN)
+        server.setblocking(False)
+        return server
+
+    def serve(self, server: socket.socket):
+        self.setup(server)
+
+        print(f"[*] Server started on {self.address}:{self.port}. Waiting for connections...")
+        housekeeping = time.time() + self.HOUSEKEEPING_INTERVAL
+        while True:
+            for key, mask in self.selector.select(timeout=self.HOUSEKEEPING_INTERVAL):
+                if key.data is None:
+                    self.accept(key.fileobj)
+                else:
+                    self.handle_event(key.data, mask)
+
+            if time.time() >= housekeeping:
+                self.housekeeping()
+                housekeeping = time.time() + self.HOUSEKEEPING_INTERVAL
+
+    def setup(self, server: socket.socket):
+        self.channels = {}
+        self.history_stats = None
+        # Publishers waiting for a stream to their subscribers to end
+        self.parked = set()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(server, selectors.EVENT_READ)
+
+    def handle_event(self, conn: RelayConnection, mask: int):
+        try:
+            if mask & selectors.EVENT_READ:
+                self.handle_readable(conn)
+            if mask & selectors.EVENT_WRITE and conn.open:
+                self.handle_writable(conn)
+        except Exception as e:
+            print("[E] Error:", e)
+            traceback.print_exc()
+            self.close_connection(conn)
+
+    def accept(self, server: socket.socket):
+        try:
+            client_socket, client_address = server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # e.g. EMFILE, keep serving existing clients
+            print("[E] accept failed:", e)
+            return
+
+        client_socket.setblocking(False)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.add_connection(client_socket, client_address)
+        print(f"[+] {self.client_name(client_address)} connected.")
+
+    def add_connection(self, client_socket: socket.socket, client_address: tuple) -> RelayConnection:
+        conn = RelayConnection(client_socket, client_address)
+        self.update_events(conn)
+        return conn
+
+    def update_events(self, conn: RelayConnection):
+        """Watch for reads unless paused, and for writes while output is queued"""
+        events = 0
+        if conn.open and not conn.paused and not conn.blocked_on:
+            events |= selectors.EVENT_READ
+        if conn.open and conn.outgoing:
+            events |= selectors.EVENT_WRITE
+
+        if events == conn.events:
+            return
+        if conn.events == 0:
+            self.selector.register(conn.sock, events, conn)
+        elif events == 0:
+            self.selector.unregister(conn.sock)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def recv(self, conn: RelayConnection, size: int) -> "bytes | None":
+        """Read up to size bytes, None if nothing is available"""
+        if conn.replay:
+            data = bytes(conn.replay[:size])
+            del conn.replay[:size]
+            return data
+
+        try:
+            return conn.sock.recv(size)
+        except (BlockingIOError, InterruptedError):
+            return None
+
+    def recv_into(self, conn: RelayConnection, view: memoryview) -> "int | None":
+        if conn.replay:
+            n = min(len(view), len(conn.replay))
+            view[:n] = conn.replay[:n]
+            del conn.replay[:n]
+            return n
+
+        try:
+            return conn.sock.recv_into(view, min(len(view), BUFF_SIZE))
+        except (BlockingIOError, InterruptedError):
+            return None
+
+    def handle_readable(self, conn: RelayConnection):
+        for _ in range(self.READS_PER_EVENT):
+            if not conn.open or conn.paused or conn.blocked_on:
+                return
+
+            if conn.size is None:
+                header_size = self.header_size(conn)
+                n = self.recv_into(conn, memoryview(conn.header)[conn.header_received:header_size])
+                if n is None:
+                    return
+                if n == 0:
+                    self.close_connection(conn)
+                    return
+
+                conn.header_received += n
+                if conn.header_received == header_size:
+                    conn.header_received = 0
+                    self.handle_header(conn)
+
+            elif conn.prefix is not None:
+                data = self.recv(conn, min(conn.size - len(conn.prefix), self.PREFIX_SIZE))
+                if data is None:
+                    return
+                if not data:
+                    self.close_connection(conn)
+                    return
+
+                conn.prefix += data
+                if self.parse_prefix(conn) is not None:
+                    self.begin_message(conn)
+
+            elif conn.stream is not None:
+                data = self.recv(conn, min(conn.stream_remaining, BUFF_SIZE))
+                if data is None:
+                    return
+                if not data:
+                    self.close_connection(conn)
+                    return
+
+                conn.stream_remaining -= len(data)
+                self.forward_chunk(conn, data)
+                if conn.stream_remaining == 0:
+                    self.end_stream(conn)
+
+            else:
+                n = self.recv_into(conn, memoryview(conn.message)[conn.message_received:])
+                if n is None:
+                    return
+                if n == 0:
+                    self.close_connection(conn)
+                    return
+
+                conn.message_received += n
+                if conn.message_received == len(conn.message):
+                    self.finish_message(conn)
+
+    def header_size(self, conn: RelayConnection) -> int:
+        return FRAME.size if conn.protocol == 2 else V1_HEADER_SIZE
+
+    def handle_header(self, conn: RelayConnection):
+        if conn.protocol is None:
+            # first header on the connection, a HELLO switches to v2
+            version = parse_hello(conn.header)
+            conn.protocol = 1 if version is None else min(version, PROTOCOL_VERSION)
+            if version is not None:
+                self.send_buffers(conn, hello(conn.protocol))
+                return
+
+        if conn.protocol == 1:
+            conn.size = int(conn.header)
+            if conn.size == 0:
+                conn.size = None
+                return
+        else:
+            conn.action, conn.channel_length, payload_length = parse_frame_header(conn.header)
+            conn.size = conn.channel_length + payload_length
+
+        conn.prefix = bytearray()
+        if self.parse_prefix(conn) is not None:
+            self.begin_message(conn)
+
+    def parse_prefix(self, conn: RelayConnection) -> "tuple[str, str, int] | None":
+        """Return action, channel and where the payload starts, None until enough of the message is read"""
+        prefix = conn.prefix
+        if conn.protocol == 2:
+            if len(prefix) < conn.channel_length:
+                return None
+            return conn.action, prefix[:conn.channel_length].decode("utf-8"), conn.channel_length
+
+        first = prefix.find(b"#")
+        second = prefix.find(b"#", first + 1)
+        if first == -1 or second == -1:
+            if len(prefix) < conn.size:
+                return None
+            raise ValueError("malformed message")
+
+        return prefix[:first].decode("utf-8"), prefix[first+1:second].decode("utf-8"), second + 1
+
+    def begin_message(self, conn: RelayConnection):
+        """Action and channel of the incoming message are known, decide how to relay it"""
+        action, channel, start = self.parse_prefix(conn)
+        payload_size = conn.size - start
+
+        subscribers = [c for c in self.channels.get(channel, []) if c is not conn]
+        if action == 'publish' and conn.size >= self.STREAM_THRESHOLD and subscribers \
+                and all(self.can_stream_to(c) for c in subscribers):
+            if any(c.stream_source is not None for c in subscribers):
+                # chunks of two messages must not interleave, wait for the
+                # other stream to end instead of buffering the whole message
+                conn.paused = True
+                self.parked.add(conn)
+                self.update_events(conn)
+                return
+
+            print(f"[S] {self.client_name(conn.address)} -> {channel} (streaming)")
+            prefix, conn.prefix = conn.prefix, None
+            conn.stream = subscribers
+            conn.stream_remaining = conn.size - len(prefix)
+            headers = {}
+            for subscriber in subscribers:
+                subscriber.stream_source = conn
+                if subscriber.protocol not in headers:
+                    headers[subscriber.protocol] = self.frame_header(subscriber, channel, payload_size)
+                self.send_buffers(subscriber, headers[subscriber.protocol], memoryview(prefix)[start:])
+                self.check_backlog(subscriber, conn, always=True)
+            if conn.stream_remaining == 0:
+                self.end_stream(conn)
+            return
+
+        prefix, conn.prefix = conn.prefix, None
+        if action == 'publish' and not subscribers:
+            # likely ends up in history, large messages go straight to a spill file
+            conn.message = self.message_history.allocate(payload_size)
+        else:
+            conn.message = bytearray(payload_size)
+        # only the payload is kept, it goes out again behind a header for each subscriber's protocol
+        conn.message[:len(prefix) - start] = memoryview(prefix)[start:]
+        conn.message_received = len(prefix) - start
+        conn.action = action
+        conn.channel = channel
+        if conn.message_received == payload_size:
+            self.finish_message(conn)
+
+    def can_stream_to(self, conn: RelayConnection) -> bool:
+        return True
+
+    def forward_chunk(self, conn: RelayConnection, data: bytes):
+        # a stream is always flow controlled, the overflow policy only applies between messages
+        for subscriber in conn.stream:
+            if subscriber.open:
+                self.send_buffers(subscriber, data)
+                self.check_backlog(subscriber, conn, always=True)
+
+    def end_stream(self, conn: RelayConnection):
+        subscribers, conn.stream = conn.stream, None
+        conn.size = None
+        for subscriber in subscribers:
+            subscriber.stream_source = None
+            if subscriber.open:
+                while subscriber.deferred:
+                    buffers = subscriber.deferred.popleft()
+                    subscriber.deferred_bytes -= sum(len(b) for b in buffers)
+                    self.send_buffers(subscriber, *buffers)
+                self.stream_finished(subscriber)
+
+        for publisher in list(self.parked):
+            self.parked.discard(publisher)
+            publisher.paused = False
+            self.update_events(publisher)
+            self.begin_message(publisher)
+
+    def stream_finished(self, conn: RelayConnection):
+        """Called for each subscriber once a stream to it is complete"""
+        pass
+
+    def backlog(self, conn: RelayConnection) -> int:
+        return conn.queued + conn.deferred_bytes
+
+    def admit(self, conn: RelayConnection) -> bool:
+        """Apply the disconnect policy before queueing more data for a subscriber"""
+        if self.overflow == "disconnect" and self.backlog(conn) > self.queue_limit:
+            print(f"[D] {self.client_name(conn.address)} too slow, {self.backlog(conn)} bytes queued, disconnecting")
+            self.close_connection(conn)
+            return False
+        return True
+
+    def check_backlog(self, conn: RelayConnection, publisher: "RelayConnection | None", always=False):
+        """Apply the block policy after queueing data from publisher"""
+        if (always or self.overflow == "block") and publisher is not None and publisher.open \
+                and self.backlog(conn) > self.queue_limit:
+            conn.blocked.add(publisher)
+            publisher.blocked_on.add(conn)
+            self.update_events(publisher)
+
+    def unblock(self, conn: RelayConnection):
+        """Let publishers blocked on conn read again"""
+        for publisher in conn.blocked:
+            publisher.blocked_on.discard(conn)
+            if not publisher.blocked_on:
+                self.update_events(publisher)
+        conn.blocked.clear()
+
+    def finish_message(self, conn: RelayConnection):
+        message, conn.message = conn.message, None
+        action, channel = conn.action, conn.channel
+        conn.size = conn.action = conn.channel = None
+        self.handle_message(conn, action, channel, message)
+
+    def handle_message(self, conn: RelayConnection, action: str, channel: str, message: bytearray):
+        if action == 'subscribe':
+            if channel not in self.channels:
+                self.channels[channel] = []
+            if conn not in self.channels[channel]:
+                self.channels[channel].append(conn)
+            conn.channels.add(channel)
+            print(f"[J] {self.client_name(conn.address)} joined channel '{channel}'")
+            self.send_history(channel, conn, self.message_history)
+
+        elif action == 'unsubscribe':
+            # in ShardedRelayServer the connection was handed to the channel's owner for this, like for subscribe
+            subscribers = self.channels.get(channel, [])
+            if conn in subscribers:
+                subscribers.remove(conn)
+            if not subscribers:
+                self.channels.pop(channel, None)
+            conn.channels.discard(channel)
+            print(f"[L] {self.client_name(conn.address)} left channel '{channel}'")
+
+        elif action == 'publish':
+            # The received payload buffer is forwarded as is
+            print(f"[P] {self.client_name(conn.address)} -> {channel}")
+            if channel in self.channels:
+                self.relay_message(channel, conn, message, self.channels)
+            else:
+                self.message_history.append(channel, message)
+
+    def send_history(self, channel, conn, message_history):
+        if channel in message_history:
+            for message in message_history.pop(channel):
+                self.socket_send_message(conn, channel, message)
+
+    def handle_writable(self, conn: RelayConnection):
+        while conn.outgoing:
+            buffers = list(islice(conn.outgoing, self.IOV_MAX))
+            try:
+                sent = conn.sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+
+            conn.queued -= sent
+            partial = sent < sum(len(b) for b in buffers)
+            while sent:
+                if sent < len(conn.outgoing[0]):
+                    conn.outgoing[0] = conn.outgoing[0][sent:]
+                    break
+                sent -= len(conn.outgoing.popleft())
+            if partial:
+                break
+
+        self.update_events(conn)
+        if conn.blocked and self.backlog(conn) <= self.queue_limit // 2:
+            self.unblock(conn)
+
+    def frame_header(self, conn: RelayConnection, channel: str, size: int) -> bytes:
+        return frame_header(conn.protocol, "publish", channel.encode("utf-8"), size)
+
+    def socket_send_message(self, conn: RelayConnection, channel, data):
+        self.enqueue(conn, self.frame_header(conn, channel, len(data)), data)
+
+    def relay_message(self, channel, sender, message, channels):
+        # one header per protocol spoken by the subscribers
+        headers = {}
+        for client in list(channels[channel]):
+            if client != sender:
+                if client.protocol not in headers:
+                    headers[client.protocol] = self.frame_header(client, channel, len(message))
+                self.enqueue(client, headers[client.protocol], message, publisher=sender)
+
+    def enqueue(self, conn: RelayConnection, *buffers, publisher: "RelayConnection | None" = None):
+        """Queue a whole message, after the stream the connection is receiving if any"""
+        if not self.admit(conn):
+            return
+
+        if conn.stream_source is not None:
+            conn.deferred.append(buffers)
+            conn.deferred_bytes += sum(len(b) for b in buffers)
+        else:
+            self.send_buffers(conn, *buffers)
+        self.check_backlog(conn, publisher)
+
+    def send_buffers(self, conn: RelayConnection, *buffers):
+        idle = not conn.outgoing
+        for buffer in buffers:
+            if len(buffer):
+                conn.outgoing.append(memoryview(buffer))
+                conn.queued += len(buffer)
+
+        if not idle:
+            return
+        # write right away, only what the socket doesn't take stays queued
+        try:
+            self.handle_writable(conn)
+        except OSError as e:
+            print("[E] Error:", e)
+            self.close_connection(conn)
+
+    def close_connection(self, conn: RelayConnection):
+        if not conn.open:
+            return
+        conn.open = False
+
+        for channel in conn.channels:
+            subscribers = self.channels.get(channel, [])
+            if conn in subscribers:
+                subscribers.remove(conn)
+            if not subscribers:
+                self.channels.pop(channel, None)
+
+        self.update_events(conn)
+        conn.sock.close()
+        conn.outgoing.clear()
+        conn.deferred.clear()
+        self.parked.discard(conn)
+        self.unblock(conn)
+        for subscriber in conn.blocked_on:
+            subscriber.blocked.discard(conn)
+        conn.blocked_on.clear()
+        print(f"[-] {self.client_name(conn.address)} disconnected.")
+
+        if conn.stream is not None:
+            # subscribers got a truncated message, they can't recover the framing
+            for subscriber in conn.stream:
+                self.close_connection(subscriber)
+
+
+class RemoteSubscriber:
+    """Placeholder for a subscriber whose socket was handed off to another worker"""
+    conn_id: int
+    worker: int
+    channels: set[str]
+    protocol: int
+
+    def __init__(self, conn_id: int, worker: int, channels: set[str], protocol: int):
+        self.conn_id = conn_id
+        self.worker = worker
+        self.channels = channels
+        self.protocol = protocol
+
+
+class WorkerLink:
+    """Unix socket between two relay worker processes"""
+    sock: socket.socket
+    worker: int
+    incoming: bytearray
+    fds: deque
+    outgoing: deque
+
+    def __init__(self, sock: socket.socket, worker: int):
+        self.sock = sock
+        self.worker = worker
+        self.incoming = bytearray()
+        # file descriptors received with SCM_RIGHTS, consumed in order by handoffs
+        self.fds = deque()
+        # [view, socket to pass or None]
+        self.outgoing = deque()
+
+
+class ShardedRelayServer(EventLoopRelayServer):
+    """
+    Relay server running one EventLoopRelayServer per worker process.
+
+    All workers listen on the same port with SO_REUSEPORT, so the kernel
+    spreads new connections across them. Every channel is owned by a single
+    worker (crc32 of the channel name modulo worker count). When a client
+    sends a message for a channel owned by another worker, its socket is
+    passed to the owner with SCM_RIGHTS together with the start of the
+    message, so relay_message and send_history on the owner see all of the
+    channel's subscribers. Subscriptions the client still holds on the previous worker
+    are kept as RemoteSubscriber entries and delivered over the worker link.
+    """
+    workers: int
+    index: int
+    links: dict[int, WorkerLink]
+    connections: dict[int, RelayConnection]
+    remote: dict[int, RemoteSubscriber]
+
+    LINK_HEADER = struct.Struct(">BQ")
+    HANDOFF, DELIVER, CLOSED = 1, 2, 3
+    HANDOFF_HEADER = struct.Struct(">QBHQ")
+    CONN_ID = struct.Struct(">Q")
+
+    def __init__(self, address="0.0.0.0", port=12345, workers=os.cpu_count(), queue_limit=8*BUFF_SIZE, overflow="block",
+                 history: "MessageHistory | None" = None):
+        super().__init__(address, port, queue_limit, overflow, history)
+        self.workers = workers
+        self.index = 0
+        self.links = {}
+        self.connections = {}
+        self.remote = {}
+        self.next_conn_id = 0
+
+    def run(self):
+        pairs = {}
+        for i in range(self.workers):
+            for j in range(i + 1, self.workers):
+                pairs[(i, j)] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        pids = []
+        for index in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.index = index
+                # history budgets are split between workers
+                self.message_history.max_bytes //= self.workers
+                self.message_history.max_spill_bytes //= self.workers
+                for (i, j), (a, b) in pairs.items():
+                    if i == index:
+                        self.links[j] = WorkerLink(a, j)
+                        b.close()
+                    elif j == index:
+                        self.links[i] = WorkerLink(b, i)
+                        a.close()
+                    else:
+                        a.close()
+                        b.close()
+                try:
+                    self.serve(self.create_server_socket())
+                finally:
+                    os._exit(1)
+            pids.append(pid)
+
+        for a, b in pairs.values():
+            a.close()
+            b.close()
+
+        print(f"[*] Started {self.workers} relay workers")
+        try:
+            for _ in pids:
+                os.wait()
+        except KeyboardInterrupt:
+            for pid in pids:
+                os.kill(pid, 15)
+
+    def create_server_socket(self) -> socket.socket:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind((self.address, self.port))
+        server.listen(socket.SOMAXCONN)
+        server.setblocking(False)
+        return server
+
+    def setup(self, server: socket.socket):
+        super().setup(server)
+        for link in self.links.values():
+            link.sock.setblocking(False)
+            self.selector.register(link.sock, selectors.EVENT_READ, link)
+
+    def channel_owner(self, channel: str) -> int:
+        return zlib.crc32(channel.encode("utf-8")) % self.workers
+
+    def add_connection(self, client_socket: socket.socket, client_address: tuple, conn_id=None) -> RelayConnection:
+        conn = super().add_connection(client_socket, client_address)
+        if conn_id is None:
+            # unique across workers
+            conn_id = self.next_conn_id * self.workers + self.index
+            self.next_conn_id += 1
+        conn.id = conn_id
+        conn.migrated = False
+        conn.pending_handoff = None
+        self.connections[conn_id] = conn
+        return conn
+
+    def handle_event(self, conn, mask: int):
+        if isinstance(conn, WorkerLink):
+            if mask & selectors.EVENT_READ:
+                self.handle_link_readable(conn)
+            if mask & selectors.EVENT_WRITE:
+                self.handle_link_writable(conn)
+        else:
+            super().handle_event(conn, mask)
+
+    def begin_message(self, conn: RelayConnection):
+        owner = self.channel_owner(self.parse_prefix(conn)[1])
+        if owner == self.index:
+            super().begin_message(conn)
+        elif conn.stream_source is not None:
+            # finish receiving the stream before the socket moves
+            conn.pending_handoff = owner
+            conn.paused = True
+            self.update_events(conn)
+        else:
+            self.handoff(conn, owner)
+
+    def stream_finished(self, conn: RelayConnection):
+        owner = conn.pending_handoff
+        if owner is not None:
+            conn.pending_handoff = None
+            conn.paused = False
+            self.handoff(conn, owner)
+
+    def can_stream_to(self, conn) -> bool:
+        return isinstance(conn, RelayConnection) and super().can_stream_to(conn)
+
+    def enqueue(self, conn, *buffers, publisher=None):
+        if isinstance(conn, RemoteSubscriber):
+            self.link_send(self.links[conn.worker], self.DELIVER, [self.CONN_ID.pack(conn.conn_id), *buffers])
+        else:
+            super().enqueue(conn, *buffers, publisher=publisher)
+
+    def handoff(self, conn: RelayConnection, owner: int):
+        """Pass the client socket, its unsent output and the bytes read so far to the owner worker"""
+        print(f"[H] {self.client_name(conn.address)} handed off to worker {owner}")
+        address = self.client_name(conn.address).encode("utf-8")
+        # the queued views go onto the link as they are, streamed payloads aren't copied
+        pending = list(conn.outgoing)
+        pending_length = sum(len(b) for b in pending)
+        replay = bytes(conn.header[:self.header_size(conn)]) + conn.prefix
+
+        # Subscriptions on this worker now deliver through the link, the
+        # placeholder also forwards deliveries addressed to us by others
+        stub = RemoteSubscriber(conn.id, owner, conn.channels, conn.protocol)
+        for channel in conn.channels:
+            subscribers = self.channels[channel]
+            subscribers[subscribers.index(conn)] = stub
+        self.remote[conn.id] = stub
+
+        conn.open = False
+        self.update_events(conn)
+        self.unblock(conn)
+        del self.connections[conn.id]
+
+        header = self.HANDOFF_HEADER.pack(conn.id, conn.protocol, len(address), pending_length)
+        self.link_send(self.links[owner], self.HANDOFF, [header, address, *pending, replay], conn.sock)
+
+    def accept_handoff(self, sock: socket.socket, body: memoryview):
+        conn_id, protocol, address_length, pending_length = self.HANDOFF_HEADER.unpack_from(body)
+        offset = self.HANDOFF_HEADER.size
+        host, port = bytes(body[offset:offset + address_length]).decode("utf-8").rsplit(":", 1)
+        offset += address_length
+        pending = body[offset:offset + pending_length]
+        replay = bytearray(body[offset + pending_length:])
+
+        sock.setblocking(False)
+        conn = self.add_connection(sock, (host, int(port)), conn_id)
+        conn.protocol = protocol
+        conn.migrated = True
+
+        # Client came back, replace its placeholders with the real connection
+        stub = self.remote.pop(conn_id, None)
+        if stub:
+            for channel in stub.channels:
+                subscribers = self.channels.get(channel, [])
+                if stub in subscribers:
+                    subscribers[subscribers.index(stub)] = conn
+                    conn.channels.add(channel)
+
+        if pending:
+            self.enqueue(conn, bytes(pending))
+        # the socket may have nothing more to read, process the replayed bytes right away
+        conn.replay = replay
+        self.handle_event(conn, selectors.EVENT_READ)
+
+    def deliver(self, body: memoryview):
+        (conn_id,) = self.CONN_ID.unpack_from(body)
+        if conn_id in self.connections:
+            self.enqueue(self.connections[conn_id], bytes(body[self.CONN_ID.size:]))
+        elif conn_id in self.remote:
+            # moved on again
+            stub = self.remote[conn_id]
+            self.link_send(self.links[stub.worker], self.DELIVER, [bytes(body)])
+
+    def close_connection(self, conn: RelayConnection):
+        if not conn.open:
+            return
+        super().close_connection(conn)
+        self.connections.pop(conn.id, None)
+        if conn.migrated:
+            for link in self.links.values():
+                self.link_send(link, self.CLOSED, [self.CONN_ID.pack(conn.id)])
+        self.drop_remote(conn.id)
+
+    def drop_remote(self, conn_id: int):
+        stub = self.remote.pop(conn_id, None)
+        if not stub:
+            return
+        for channel in stub.channels:
+            subscribers = self.channels.get(channel, [])
+            if stub in subscribers:
+                subscribers.remove(stub)
+            if not subscribers:
+                self.channels.pop(channel, None)
+
+    def link_send(self, link: WorkerLink, kind: int, buffers: list, sock: "socket.socket | None" = None):
+        if not link.outgoing:
+            self.selector.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, link)
+        length = sum(len(b) for b in buffers)
+        link.outgoing.append([memoryview(self.LINK_HEADER.pack(kind, length)), sock])
+        for b in buffers:
+            if len(b):
+                link.outgoing.append([memoryview(b), None])
+
+    def handle_link_writable(self, link: WorkerLink):
+        while link.outgoing:
+            view, sock = link.outgoing[0]
+            try:
+                if sock is not None:
+                    sent = socket.send_fds(link.sock, [view], [sock.fileno()])
+                else:
+                    sent = link.sock.send(view)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            if sock is not None:
+                # the descriptor went out with the first byte, drop our copy
+                sock.close()
+                link.outgoing[0][1] = None
+            if sent < len(view):
+                link.outgoing[0][0] = view[sent:]
+                return
+            link.outgoing.popleft()
+
+        self.selector.modify(link.sock, selectors.EVENT_READ, link)
+
+    def handle_link_readable(self, link: WorkerLink):
+        try:
+            data, fds, _, _ = socket.recv_fds(link.sock, BUFF_SIZE, 16)
+        except (BlockingIOError, InterruptedError):
+            return
+
+        if not data:
+            print(f"[E] link to worker {link.worker} closed")
+            self.selector.unregister(link.sock)
+            return
+
+        link.fds.extend(fds)
+        link.incoming += data
+
+        header_size = self.LINK_HEADER.size
+        offset = 0
+        while len(link.incoming) - offset >= header_size:
+            kind, length = self.LINK_HEADER.unpack_from(link.incoming, offset)
+            if len(link.incoming) - offset - header_size < length:
+                break
+            body = memoryview(link.incoming)[offset + header_size:offset + header_size + length]
+            offset += header_size + length
+
+            if kind == self.HANDOFF:
+                self.accept_handoff(socket.socket(fileno=link.fds.popleft()), body)
+            elif kind == self.DELIVER:
+                self.deliver(body)
+            elif kind == self.CLOSED:
+                self.drop_remote(self.CONN_ID.unpack_from(body)[0])
+            body.release()
+
+        del link.incoming[:offset]
+
+
+class RendezvousConnection:
+    """Client of P2PServer going through the handshake"""
+    sock: socket.socket
+    address: tuple
+    incoming: bytearray
+    outgoing: bytearray
+    state: str
+    priv: "tuple | None"
+    key: "bytes | None"
+    rank: "int | None"
+    size: "int | None"
+    public: tuple
+    probe: "bytes | None"
+    deadline: float
+    close_when_sent: bool
+
+    def __init__(self, sock: socket.socket, address: tuple, deadline: float):
+        self.sock = sock
+        self.address = address
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        # "address": waiting for private address and key
+        # "probe": UDP client, waiting for its datagram
+        # "confirm": waiting for the client to echo its public address
+        # "waiting": handshake done, waiting for the peer
+        self.state = "address"
+        self.priv = None
+        self.key = None
+        # set for group members, key is then the group id
+        self.rank = None
+        self.size = None
+        # address the peer should punch to, the UDP one for UDP clients
+        self.public = address
+        # UDP clients: the probe datagram that will tell us their UDP address
+        self.probe = None
+        self.deadline = deadline
+        self.close_when_sent = False
+
 
 # Inspired by https://github.com/dwoz/python-nat-hole-punching/blob/master/util.py
 class P2PServer(Server):
-    clients: dict[str, socket.socket]
+    """
+    Rendezvous server for P2P hole punching.
 
-    def __init__(self, address="0.0.0.0", port=12345):
+    All handshakes run concurrently on one selector loop, so a slow client
+    only delays itself. A client that doesn't finish its handshake within
+    handshake_timeout seconds, or whose peer doesn't show up within
+    pairing_ttl seconds, is disconnected.
+
+    Clients sending "priv|key" are paired by key. Clients sending
+    "priv|group|rank|size" wait until all size ranks of the group are there,
+    then each gets the public and private address of every rank in one
+    reply, "pub|priv;pub|priv;..." in rank order.
+
+    Clients sending "priv|key|udp" punch UDP instead of TCP. They also send
+    "BLTN|priv|key" datagrams from their UDP socket to the same port, and
+    the public address they are told and paired with is the one those come
+    from.
+    """
+    list: dict[bytes, RendezvousConnection]
+    groups: dict[bytes, dict[int, RendezvousConnection]]
+    probes: dict[bytes, RendezvousConnection]
+    connections: set[RendezvousConnection]
+    deadlines: list[tuple[float, int, RendezvousConnection]]
+    selector: selectors.BaseSelector
+
+    handshake_timeout: float
+    pairing_ttl: float
+
+    # Longest rendezvous message accepted, they are just addresses and a key
+    MAX_MESSAGE = 64 * 1024
+
+    def __init__(self, address="0.0.0.0", port=12345, handshake_timeout=10.0, pairing_ttl=300.0):
         super().__init__(address, port)
-        self.clients = {}
+        self.handshake_timeout = handshake_timeout
+        self.pairing_ttl = pairing_ttl
+        # Clients waiting for their peer, by key
         self.list = {}
+        # Group members waiting for the rest of their group, by group id and rank
+        self.groups = {}
+        # UDP clients waiting for their probe datagram, by its contents
+        self.probes = {}
+        self.connections = set()
+        # Heap of (deadline, sequence, connection), stale entries are skipped
+        self.deadlines = []
+        self.sequence = 0
+        self.pairings = 0
+        self.meshes = 0
 
     def run(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((self.address, self.port))
-        s.listen(1)
-        s.settimeout(30)
+        s.listen(socket.SOMAXCONN)
+        s.setblocking(False)
 
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
-        logger = logging.getLogger()
+        self.logger = logging.getLogger()
 
-        logger.info('server - listening on %s:%s', self.address, self.port)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.bind((self.address, self.port))
+        udp.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(s, selectors.EVENT_READ)
+        self.selector.register(udp, selectors.EVENT_READ, "udp")
+
+        self.logger.info('server - listening on %s:%s (tcp and udp)', self.address, self.port)
 
         while True:
+            timeout = self.deadlines[0][0] - time.time() if self.deadlines else None
+            for key, mask in self.selector.select(timeout=None if timeout is None else max(timeout, 0)):
+                if key.data is None:
+                    self.accept(s)
+                    continue
+                if key.data == "udp":
+                    self.handle_datagrams(udp)
+                    continue
+
+                conn = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self.handle_readable(conn)
+                    if mask & selectors.EVENT_WRITE and conn in self.connections:
+                        self.handle_writable(conn)
+                except OSError as e:
+                    self.logger.info('client %s error: %s', conn.address, e)
+                    self.close(conn)
+
+            self.expire()
+
+    def accept(self, s: socket.socket):
+        for _ in range(64):
             try:
-                conn, addr = s.accept()
-            except socket.timeout:
-                continue
+                sock, addr = s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.info('accept failed: %s', e)
+                return
+
+            sock.setblocking(False)
+            conn = RendezvousConnection(sock, addr, 0)
+            self.set_deadline(conn, self.handshake_timeout)
+            self.connections.add(conn)
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+            self.logger.info('connection address: %s', addr)
 
-            logger.info('connection address: %s', addr)
-            data = recv_msg(conn)
-            addr_str, key = data.split(b'|')
-            priv_addr = string_to_addr(addr_str)
-            send_msg(conn, addr_to_string(addr))
-            data = recv_msg(conn)
-            data_addr = string_to_addr(data)
-
-            if data_addr != addr:
-                logger.info('client reply did not match')
-                conn.close()
+    def set_deadline(self, conn: RendezvousConnection, seconds: float):
+        conn.deadline = time.time() + seconds
+        self.sequence += 1
+        heapq.heappush(self.deadlines, (conn.deadline, self.sequence, conn))
+
+    def expire(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, conn = heapq.heappop(self.deadlines)
+            if conn not in self.connections or conn.deadline != deadline:
                 continue
+            if conn.state == "waiting" and conn.rank is not None:
+                self.logger.info('server - group %s incomplete within %ss, %s of %s ranks arrived',
+                                 conn.key, self.pairing_ttl, len(self.groups.get(conn.key, {})), conn.size)
+            elif conn.state == "waiting":
+                self.logger.info('server - no peer for key %s within %ss', conn.key, self.pairing_ttl)
+            else:
+                self.logger.info('server - handshake with %s timed out', conn.address)
+            self.close(conn)
 
-            logger.info('client reply matches')
-            logger.info('server - received data: %s', data)
+    def handle_readable(self, conn: RendezvousConnection):
+        data = conn.sock.recv(4096)
+        if not data:
+            self.close(conn)
+            return
 
-            if key not in self.list:
-                self.list[key] = P2PClient(conn, addr, priv_addr)
+        conn.incoming += data
+        while len(conn.incoming) >= 4 and conn in self.connections:
+            (length,) = struct.unpack_from('>I', conn.incoming)
+            if length > self.MAX_MESSAGE:
+                self.close(conn)
+                return
+            if len(conn.incoming) < 4 + length:
+                break
+            message = bytes(conn.incoming[4:4 + length])
+            del conn.incoming[:4 + length]
+            self.handle_message(conn, message)
+
+    def handle_message(self, conn: RendezvousConnection, data: bytes):
+        if conn.state == "address":
+            fields = data.split(b'|')
+            try:
+                if len(fields) == 3 and fields[2] == b"udp":
+                    conn.probe = b"BLTN|" + fields[0] + b"|" + fields[1]
+                elif len(fields) == 4:
+                    conn.rank, conn.size = int(fields[2]), int(fields[3])
+                elif len(fields) != 2:
+                    raise ValueError("expected priv|key, priv|key|udp or priv|group|rank|size")
+                conn.priv = string_to_addr(fields[0])
+            except ValueError as e:
+                self.logger.info('client %s sent a malformed address: %s', conn.address, e)
+                self.close(conn)
+                return
+            if conn.rank is not None and not 0 <= conn.rank < conn.size:
+                self.close(conn)
+                return
+            conn.key = fields[1]
+            if conn.probe is not None:
+                # UDP and TCP clients of the same key don't pair
+                conn.key = b"udp|" + conn.key
+                conn.state = "probe"
+                self.probes[conn.probe] = conn
+                return
+            conn.state = "confirm"
+            self.send(conn, addr_to_string(conn.address))
+
+        elif conn.state == "confirm":
+            if string_to_addr(data) != conn.public:
+                self.logger.info('client reply did not match')
+                self.close(conn)
+                return
+
+            self.logger.info('client reply matches')
+            self.logger.info('server - received data: %s', data)
+            if conn.rank is None:
+                self.pair(conn)
             else:
-                c1, c2 = self.list[key], P2PClient(conn, addr, priv_addr)
-                logger.info('server - send client info to: %s', c1.pub)
-                send_msg(c1.conn, c2.peer_msg())
-                logger.info('server - send client info to: %s', c2.pub)
-                send_msg(c2.conn, c1.peer_msg())
-                self.list.pop(key)
+                self.join_group(conn)
+
+        else:
+            # nothing more is expected before the peer arrives
+            self.close(conn)
+
+    def handle_datagrams(self, udp: socket.socket):
+        for _ in range(64):
+            try:
+                data, addr = udp.recvfrom(self.MAX_MESSAGE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.info('udp receive failed: %s', e)
+                return
+
+            # clients repeat their probe until they hear back over TCP, later copies find nothing
+            conn = self.probes.pop(data, None)
+            if conn is None:
+                continue
+            self.logger.info('udp address of %s is %s', conn.address, addr)
+            conn.public = addr
+            conn.state = "confirm"
+            self.send(conn, addr_to_string(addr))
+
+    def pair(self, conn: RendezvousConnection):
+        if conn.key not in self.list:
+            conn.state = "waiting"
+            self.set_deadline(conn, self.pairing_ttl)
+            self.list[conn.key] = conn
+            return
+
+        c1, c2 = self.list.pop(conn.key), conn
+        c1_client = P2PClient(c1.sock, c1.public, c1.priv)
+        c2_client = P2PClient(c2.sock, c2.public, c2.priv)
+        self.logger.info('server - send client info to: %s', c1.address)
+        self.send(c1, c2_client.peer_msg(), close=True)
+        self.logger.info('server - send client info to: %s', c2.address)
+        self.send(c2, c1_client.peer_msg(), close=True)
+        self.pairings += 1
+
+    def join_group(self, conn: RendezvousConnection):
+        members = self.groups.setdefault(conn.key, {})
+        other = next(iter(members.values()), None)
+        if conn.rank in members or (other and other.size != conn.size):
+            self.logger.info('server - rank %s of group %s is taken or has the wrong size', conn.rank, conn.key)
+            self.close(conn)
+            return
+
+        members[conn.rank] = conn
+        if len(members) < conn.size:
+            conn.state = "waiting"
+            self.set_deadline(conn, self.pairing_ttl)
+            return
+
+        del self.groups[conn.key]
+        reply = b";".join(
+            P2PClient(m.sock, m.public, m.priv).peer_msg() for _, m in sorted(members.items()))
+        self.logger.info('server - send group %s info to %s ranks', conn.key, conn.size)
+        for member in members.values():
+            self.send(member, reply, close=True)
+        self.meshes += 1
+
+    def send(self, conn: RendezvousConnection, msg: bytes, close=False):
+        # Prefix each message with a 4-byte length (network byte order)
+        conn.outgoing += struct.pack('>I', len(msg)) + msg
+        conn.close_when_sent = close
+        self.handle_writable(conn)
+
+    def handle_writable(self, conn: RendezvousConnection):
+        try:
+            sent = conn.sock.send(conn.outgoing)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            # also reached from datagrams and other clients' messages, only this connection ends
+            self.logger.info('client %s error: %s', conn.address, e)
+            self.close(conn)
+            return
+        del conn.outgoing[:sent]
+
+        if not conn.outgoing and conn.close_when_sent:
+            self.close(conn)
+        elif conn.outgoing:
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        else:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def close(self, conn: RendezvousConnection):
+        if conn not in self.connections:
+            return
+        self.connections.discard(conn)
+        if conn.key is not None and self.list.get(conn.key) is conn:
+            del self.list[conn.key]
+        if conn.probe is not None and self.probes.get(conn.probe) is conn:
+            del self.probes[conn.probe]
+        members = self.groups.get(conn.key) if conn.rank is not None else None
+        if members and members.get(conn.rank) is conn:
+            # the rank can register again
+            del members[conn.rank]
+            if not members:
+                del self.groups[conn.key]
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
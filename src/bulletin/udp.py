@@ -0,0 +1,447 @@
+import random
+import select
+import socket
+import struct
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Thread, current_thread
+
+#
+# Reliable byte stream over a punched UDP socket
+#
+# Every packet starts with PACKET (type, sequence number, cumulative ack).
+# DATA and FIN use the sequence number, ACK carries the next sequence
+# number expected, in place of the sequence number the receive window (how
+# many segments past it there is room for) and, as SACK entries in its
+# body, the sequence numbers received beyond it. PROBE asks for an ACK.
+#
+
+PACKET = struct.Struct(">BII")
+SACK = struct.Struct(">I")
+
+PUNCH, PUNCH_ACK, DATA, ACK, FIN, PROBE = range(6)
+
+
+class Segment:
+    packet: bytes
+    sent_at: float
+    retries: int
+    retransmitted: bool
+
+    def __init__(self, packet: bytes, sent_at: float):
+        self.packet = packet
+        self.sent_at = sent_at
+        # timeouts in a row, they back off the timer
+        self.retries = 0
+        # sent more than once, its ACK says nothing about the round trip time
+        self.retransmitted = False
+
+
+class UDPStream:
+    """
+    Reliable, ordered byte stream between two punched UDP sockets.
+
+    Data is cut into segments of at most mss bytes and up to window of them
+    are in flight. The receiver acknowledges cumulatively plus whatever it got
+    out of order, and holds on to that until the gap is filled. A segment is
+    sent again when its timer runs out, or right away once a segment sent
+    after it and at least three sequence numbers further was acknowledged.
+
+    The receiver advertises how much room its buffer has left, and the sender
+    stops at a closed window and probes it until a reader makes room, so a
+    slow reader holds the sender up without being taken for a lost peer. Both
+    sides send a PROBE when they have been quiet for KEEPALIVE_INTERVAL, a
+    peer that isn't heard from for idle_timeout seconds is considered gone.
+
+    Behaves like a blocking socket (sendmsg, sendall, recv_into, settimeout,
+    close), so P2PCommunicator uses it in place of a TCP connection. loss is
+    the fraction of outgoing packets dropped on purpose, to test on loopback.
+    """
+    sock: socket.socket
+    peer: tuple
+    peers: set
+    unacked: "OrderedDict[int, Segment]"
+    pending: "dict[int, bytes | None]"
+    buffer: bytearray
+    error: "Exception | None"
+
+    # Seconds between PUNCH packets while punching
+    PUNCH_INTERVAL = 0.05
+    # Retransmission timer bounds, seconds
+    INITIAL_RTO = 0.2
+    MIN_RTO = 0.01
+    MAX_RTO = 2.0
+    # Timeouts in a row after which the peer is considered gone
+    MAX_RETRIES = 12
+    # Segments acknowledged later than this many newer ones are considered lost
+    REORDERING = 3
+    # Seconds close waits for unacknowledged data
+    LINGER = 5.0
+    # Longest time the background thread sleeps, so it notices close
+    TICK = 0.1
+    # Seconds without sending anything after which a PROBE goes out, also the longest gap between window probes
+    KEEPALIVE_INTERVAL = 1.0
+
+    def __init__(self, sock: socket.socket, peer: tuple, peers: list, mss=1200, window=256, loss=0.0,
+                 idle_timeout=15.0):
+        self.sock = sock
+        self.sock.setblocking(False)
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option, 4 * 1024 * 1024)
+            except OSError:
+                pass
+        self.peer = peer
+        self.peers = set(peers) | {peer}
+        self.mss = mss
+        self.window = window
+        self.loss = loss
+        self.idle_timeout = idle_timeout
+        self.timeout = None
+        self.last_sent = self.last_heard = time.monotonic()
+
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.closed = False
+        self.error = None
+
+        # sender
+        self.next_seq = 0
+        self.unacked = OrderedDict()
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = self.INITIAL_RTO
+        # sequence numbers below send_limit fit into the peer's receive window
+        self.send_limit = window
+        # unanswered probes of a closed window, they back off
+        self.probes = 0
+        self.probed_at = 0.0
+
+        # receiver, at most max_buffer bytes wait for recv_into
+        self.expected = 0
+        self.pending = {}
+        self.buffer = bytearray()
+        self.max_buffer = 4 * window * mss
+        self.eof = False
+        # right edge of the window last advertised
+        self.advertised = 0
+
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def punch(cls, sock: socket.socket, peers: list, deadline: float, loss=0.0, **options) -> "UDPStream":
+        """
+        Sends PUNCH to every address of the peer until a packet of the peer
+        shows both directions work: its PUNCH_ACK, or data it sends once it
+        got ours. Answers the peer's PUNCHes along the way.
+        """
+        sock.setblocking(False)
+        peers = list(dict.fromkeys(peers))
+        next_punch = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                raise TimeoutError("no UDP packet from peer %s before the deadline" % (peers,))
+            if now >= next_punch:
+                for addr in peers:
+                    if random.random() >= loss:
+                        sock.sendto(PACKET.pack(PUNCH, 0, 0), addr)
+                next_punch = now + cls.PUNCH_INTERVAL
+
+            readable, _, _ = select.select([sock], [], [], max(min(next_punch, deadline) - now, 0))
+            while readable:
+                try:
+                    packet, addr = sock.recvfrom(65535)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionRefusedError:
+                    # ICMP unreachable from a candidate address that isn't listening yet
+                    continue
+                if addr not in peers or len(packet) < PACKET.size:
+                    continue
+                kind = packet[0]
+                if kind == PUNCH:
+                    if random.random() >= loss:
+                        sock.sendto(PACKET.pack(PUNCH_ACK, 0, 0), addr)
+                elif kind in (PUNCH_ACK, DATA, ACK):
+                    return cls(sock, addr, peers, loss=loss, **options)
+
+    #
+    # socket interface
+    #
+
+    def settimeout(self, timeout: "float | None"):
+        self.timeout = timeout
+
+    def sendmsg(self, buffers) -> int:
+        total = 0
+        for buffer in buffers:
+            view = memoryview(buffer).cast("B")
+            for offset in range(0, len(view), self.mss):
+                self._send_segment(DATA, view[offset:offset + self.mss])
+            total += len(view)
+        return total
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def recv_into(self, view) -> int:
+        update = None
+        with self.changed:
+            self._wait(lambda: self.buffer or self.eof)
+            count = min(len(view), len(self.buffer))
+            view[:count] = self.buffer[:count]
+            del self.buffer[:count]
+            # tell the sender about the room once the window was closed or opened by half
+            edge = self.expected + self._receive_window()
+            if edge > self.advertised and (self.advertised <= self.expected
+                                           or edge - self.advertised >= self.max_buffer // self.mss // 2):
+                update = self._ack_packet([])
+        if update:
+            self._transmit(update)
+        return count
+
+    def readable(self, timeout: float) -> bool:
+        """Whether recv_into would return without blocking, after waiting up to timeout seconds"""
+        with self.changed:
+            return bool(self.changed.wait_for(lambda: self.buffer or self.eof or self.error is not None or self.closed, timeout))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.error is None:
+                self._send_segment(FIN, b"")
+                with self.changed:
+                    self.changed.wait_for(lambda: not self.unacked or self.error is not None, self.LINGER)
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            with self.changed:
+                self.changed.notify_all()
+            if self.thread is not current_thread():
+                self.thread.join()
+            self.sock.close()
+
+    #
+    # sending
+    #
+
+    def _wait(self, ready):
+        # called with the lock held, raises like a socket would
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not ready():
+            if self.error is not None:
+                raise ConnectionError("UDP peer %s is gone" % (self.peer,)) from self.error
+            if self.closed:
+                raise OSError("UDP stream is closed")
+            if deadline is None:
+                self.changed.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                self.changed.wait(remaining)
+
+    def _send_segment(self, kind: int, payload):
+        with self.changed:
+            # FIN takes no room at the receiver
+            self._wait(lambda: len(self.unacked) < self.window and (kind == FIN or self.next_seq < self.send_limit))
+            seq = self.next_seq
+            self.next_seq += 1
+            packet = PACKET.pack(kind, seq, 0) + payload
+            self.unacked[seq] = Segment(packet, time.monotonic())
+        self._transmit(packet)
+
+    def _transmit(self, packet: bytes, addr=None):
+        self.last_sent = time.monotonic()
+        if self.loss and random.random() < self.loss:
+            return
+        try:
+            self.sock.sendto(packet, addr or self.peer)
+        except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+            # same as a lost packet, the timer sends it again
+            pass
+
+    #
+    # background thread: incoming packets and retransmission timers
+    #
+
+    def _run(self):
+        while not self.closed:
+            try:
+                readable, _, _ = select.select([self.sock], [], [], self._next_timer())
+                if readable:
+                    self._receive_packets()
+                self._retransmit()
+                self._probe()
+            except (OSError, ValueError) as e:
+                if self.closed:
+                    return
+                with self.changed:
+                    self.error = e
+                    self.changed.notify_all()
+                return
+
+    def _next_timer(self) -> float:
+        with self.lock:
+            if self.unacked:
+                due = min(self._due(segment) for segment in self.unacked.values())
+            elif self.next_seq >= self.send_limit:
+                due = self._probe_due()
+            else:
+                return self.TICK
+            return min(max(due - time.monotonic(), 0), self.TICK)
+
+    def _due(self, segment: Segment) -> float:
+        return segment.sent_at + min(self.rto * 2 ** segment.retries, self.MAX_RTO)
+
+    def _retransmit(self):
+        resend = []
+        with self.changed:
+            now = time.monotonic()
+            for segment in self.unacked.values():
+                if self._due(segment) <= now:
+                    if segment.retries >= self.MAX_RETRIES:
+                        # _run records it and stops
+                        raise ConnectionError("peer stopped acknowledging")
+                    segment.retries += 1
+                    segment.retransmitted = True
+                    segment.sent_at = now
+                    resend.append(segment.packet)
+        for packet in resend:
+            self._transmit(packet)
+
+    def _probe_due(self) -> float:
+        return self.probed_at + min(self.rto * 2 ** self.probes, self.KEEPALIVE_INTERVAL)
+
+    def _probe(self):
+        # a closed window is probed until an ACK opens it, a window update from the reader may get lost.
+        # Probes don't count as retries, a peer that is gone doesn't answer anything and runs into idle_timeout
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_heard > self.idle_timeout:
+                raise ConnectionError("nothing from UDP peer %s for %s seconds" % (self.peer, self.idle_timeout))
+            probe = now - self.last_sent >= self.KEEPALIVE_INTERVAL
+            if not self.unacked and self.next_seq >= self.send_limit:
+                if now >= self._probe_due():
+                    self.probes += 1
+                    self.probed_at = now
+                    probe = True
+            else:
+                self.probes = 0
+        if probe:
+            self._transmit(PACKET.pack(PROBE, 0, 0))
+
+    def _receive_packets(self):
+        received = []
+        for _ in range(256):
+            try:
+                packet, addr = self.sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                continue
+            if addr not in self.peers or len(packet) < PACKET.size:
+                continue
+
+            self.last_heard = time.monotonic()
+            kind, seq, ack = PACKET.unpack_from(packet)
+            if kind == PUNCH:
+                # the peer missed our PUNCH_ACK
+                self._transmit(PACKET.pack(PUNCH_ACK, 0, 0), addr)
+            elif kind in (DATA, FIN):
+                received.append((kind, seq, packet[PACKET.size:]))
+            elif kind == ACK:
+                self._handle_ack(ack, seq, [s for (s,) in SACK.iter_unpack(packet[PACKET.size:])])
+            elif kind == PROBE:
+                with self.lock:
+                    answer = self._ack_packet([])
+                self._transmit(answer)
+
+        if received:
+            self._handle_data(received)
+
+    def _handle_data(self, received):
+        with self.changed:
+            sacks = []
+            for kind, seq, payload in received:
+                if seq >= self.expected and seq not in self.pending:
+                    if kind == DATA and seq >= self.expected + self._receive_window():
+                        # past the advertised window, which never shrinks, so the sender is out of line
+                        continue
+                    self.pending[seq] = None if kind == FIN else payload
+                if seq in self.pending:
+                    sacks.append(seq)
+            while self.expected in self.pending:
+                payload = self.pending.pop(self.expected)
+                if payload is None:
+                    self.eof = True
+                else:
+                    self.buffer += payload
+                self.expected += 1
+            self.changed.notify_all()
+            ack = self._ack_packet([seq for seq in sacks if seq >= self.expected])
+        self._transmit(ack)
+
+    def _receive_window(self) -> int:
+        # segments there is room for past expected. Data moving into the buffer moves expected along
+        # by as many segments, reads only add room, so the right edge of the window never moves back
+        return max(self.max_buffer - len(self.buffer), 0) // self.mss
+
+    def _ack_packet(self, sacks: list) -> bytes:
+        # called with the lock held
+        window = self._receive_window()
+        self.advertised = self.expected + window
+        sacks = sacks[:(self.mss - PACKET.size) // SACK.size]
+        return PACKET.pack(ACK, window, self.expected) + b"".join(SACK.pack(seq) for seq in sacks)
+
+    def _handle_ack(self, ack: int, window: int, sacks: list):
+        resend = []
+        with self.changed:
+            now = time.monotonic()
+            if ack + window > self.send_limit:
+                # ACKs may arrive out of order, the window only ever opens further
+                self.send_limit = ack + window
+                self.changed.notify_all()
+            acked = []
+            while self.unacked:
+                seq = next(iter(self.unacked))
+                if seq >= ack:
+                    break
+                acked.append(self.unacked.popitem(last=False))
+            for seq in sacks:
+                if seq in self.unacked:
+                    acked.append((seq, self.unacked.pop(seq)))
+            if not acked:
+                return
+
+            newest_seq, newest_sent = -1, 0.0
+            for seq, segment in acked:
+                if not segment.retransmitted:
+                    self._sample_rtt(now - segment.sent_at)
+                if segment.sent_at > newest_sent:
+                    newest_seq, newest_sent = seq, segment.sent_at
+
+            # anything sent before the newest acknowledged segment and far enough behind it is lost
+            for seq, segment in self.unacked.items():
+                if seq > newest_seq - self.REORDERING:
+                    break
+                if segment.sent_at < newest_sent:
+                    segment.retransmitted = True
+                    segment.sent_at = now
+                    resend.append(segment.packet)
+            self.changed.notify_all()
+        for packet in resend:
+            self._transmit(packet)
+
+    def _sample_rtt(self, rtt: float):
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
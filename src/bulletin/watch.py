@@ -0,0 +1,128 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+from threading import Condition
+
+#
+# Directory change notifications with Linux inotify, through libc
+#
+# inotify only sees changes made through the local kernel. On NFS (EFS)
+# files written by other machines don't show up, so remote_filesystem tells
+# the caller to poll there instead.
+#
+
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+REMOTE_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "fuse.s3fs", "9p")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+def filesystem_type(path: str) -> "str | None":
+    """Type of the filesystem path is on, from /proc/self/mounts (None where there is none)"""
+    try:
+        with open("/proc/self/mounts") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return None
+
+    path = os.path.realpath(path)
+    best, best_type = "", None
+    for fields in mounts:
+        # spaces in mount points are escaped as \040
+        mount_point = fields[1].replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) >= len(best):
+            best, best_type = mount_point, fields[2]
+    return best_type
+
+
+def remote_filesystem(path: str) -> bool:
+    return filesystem_type(path) in REMOTE_FILESYSTEMS
+
+
+class DirectoryWatch:
+    """
+    Wakes up threads when a file is created in, or renamed into, one of the
+    watched directories.
+
+    One inotify instance serves every thread: one of the waiting threads
+    reads it, the others wait for it to bump generation. Take generation
+    before checking for the file and pass it to wait, then a file that shows
+    up in between is either seen by the check or ends the wait. The instance
+    stays open, closing inotify takes milliseconds.
+    """
+    fd: int
+    directories: set[str]
+    generation: int
+
+    def __init__(self):
+        libc = _load_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = set()
+        self.changed = Condition()
+        self.generation = 0
+        self.reading = False
+
+    def add(self, path: str):
+        with self.changed:
+            if path in self.directories:
+                return
+            if _libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CREATE | IN_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), path)
+            self.directories.add(path)
+
+    def wait(self, generation: int, timeout: float):
+        """Returns once there were events after generation, or after timeout seconds"""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self.generation == generation:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                if self.reading:
+                    self.changed.wait(remaining)
+                    continue
+
+                self.reading = True
+                self.changed.release()
+                readable = []
+                try:
+                    readable, _, _ = select.select([self.fd], [], [], remaining)
+                    if readable:
+                        self._drain()
+                finally:
+                    self.changed.acquire()
+                    self.reading = False
+                    if readable:
+                        self.generation += 1
+                    # wakes the others, to take over reading if nothing happened
+                    self.changed.notify_all()
+
+    def _drain(self):
+        # which file changed doesn't matter, waiters check for theirs
+        while True:
+            try:
+                os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+    def close(self):
+        os.close(self.fd)
@@ -32,6 +32,7 @@ def lambda_handler(event, context) -> dict:
         communicator.cleanup(key+"-response")
     elif role == "receiver":
         communicator.cleanup(key)
+    communicator.close()
 
     return {
         "start": start,